@@ -1,92 +1,141 @@
 # These are all the libraries I use for this project. It includes:
 # 1. Kivy for the front-end design of the app
-# 2. Webbrowser and webdriver from Selenium to open and fill the Google Form and the Google Maps
-# 3. Docx for saving vitals in a Word form.
-# 4. Geopy for retrieving the position of the end user.
-
+# 2. Webbrowser to open Google Maps, and Requests (through submission.py) to fill the Google Form.
+#    Selenium is only used as a fallback when the form cannot be posted directly.
+# 3. SQLite (through records.py) for keeping every encounter, and Docx for exporting them to a Word form.
+# 4. Geopy for retrieving the position of the end user (through geocoding.py, only when no cache knows the place).
+# 5. NumPy (through matching.py) for finding the nearest hospitals quickly.
+# Everything except the screens is in the dispatch core (dispatch.py).
+# Heavy libraries (SciPy, Requests, Selenium, Geopy, Docx) are only imported when they are first used,
+# so starting the app to record or recall vitals does not pay for them. See startup_profile.py.
+
+import startup_profile
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
 from kivy.clock import Clock
 from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
-from kivy.uix.widget import Widget
-import webbrowser
-from docx import Document
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-import time
-from geopy.geocoders import Nominatim
-from math import radians, sin, cos, sqrt, atan2
+from kivy.uix.screenmanager import ScreenManager, Screen, NoTransition
 from kivy.uix.gridlayout import GridLayout
 from kivy.lang import Builder
 from kivy.uix.image import Image
-from time import sleep
+from kivy.core.window import Window
+from kivy.core.image import Image as CoreImage
+startup_profile.mark('kivy imports')
+import webbrowser
+from records import export_docx
+from dispatch import DispatchCore, directions_url
+from hospital_registry import capability_names
+from vitals_stream import required_capabilities
+from background import BackgroundWorker
 import os
+import subprocess
+import sys
+import time
+startup_profile.mark('app imports')
 
-Builder.load_file('Vital Signs and Patient-Hospital Matching App.kv')
-Builder.load_file('style.kv')
+#The app's files are found next to this script, wherever it is started from
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+Builder.load_file(os.path.join(APP_DIRECTORY, 'Vital Signs and Patient-Hospital Matching App.kv'))
+Builder.load_file(os.path.join(APP_DIRECTORY, 'style.kv'))
 
 
-#These are HeFRA (Health Facilities Regulatory Agency) certified hospitals. Below are hospitals I am using to test-run the app.
-#the input data is in a 2D list in the format ("name", lat, long, available beds, "Google form link"). These are HeFRA cerified hospitals.
-hospitals = [
-    ["Korle Bu Teaching Hospital", 5.5381, -0.2272, 2, "Google Form Link 1"],
-    ["Komfo Anokye Teaching Hospital", 6.698, -1.629, 2, "Google Form Link 2"],
-    ["Tamale Teaching Hospital", 9.393, -0.824, 15, "Google Form Link 3"],
-    # More hospitals here if needed
-]
+#The hospitals, matching, bed reservations, geocoding, submissions and patient records all live in the
+#dispatch core (dispatch.py), which has no user interface. The screens below only call it, the same way
+#the HTTP service (service.py) does.
+core = DispatchCore()
+startup_profile.mark('dispatch core')
 
 #Functions
 #All the functions I made specifically for this project.
-#The function below is the Haversine formula which calculates the position of the end-user from a place
-
-def haversine_distance(lat1, lon1, lat2, lon2):
-    # Convert latitudes and longitudes from degrees to radians for simplicity
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-
-    # This is the Haversine formula
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    distance = 6371 * c  # Radius of the Earth in kilometers (Ghana uses the metric system)
-
-    return distance
-
-#The function below gets the coordinates of the end user by using a prompt from the end user
-def get_coordinates(location_name):
-    geolocator = Nominatim(user_agent="my_app")
-    location = geolocator.geocode(location_name)
-    if location:
-        return location.latitude, location.longitude
-    else:
-        return None, None
+#haversine_distance now lives in matching.py together with the index that is checked against it.
+
+#Mass-casualty mode: each line is "location, priority" with priority 1 (immediate), 2 (urgent) or 3 (can wait).
+#Returns the assignments as text, one line per patient.
+def assign_mass_casualty(lines):
+    casualties = []
+    for line in lines:
+        location_name, _, priority = line.partition(',')
+        casualties.append((location_name.strip(), int(priority) if priority.strip().isdigit() else None))
+    summary = []
+    for location_name, hospital_name, distance, reason in core.assign_mass_casualty(casualties):
+        if hospital_name is None:
+            summary.append(f"{location_name}: {reason}")
+        else:
+            summary.append(f"{location_name}: {hospital_name} ({distance:.1f} km)")
+    return '\n'.join(summary)
 
 
-#This function retrieves the vital signs of the patient from a stored Word Document
+#This function retrieves the vital signs of the patient from the record store
 def recall_vital_signs(patient_name):
-    try:
-        # Open the saved Word document
-        doc = Document(f'{patient_name}_vital_signs.docx')
-        
-        # Print the vital signs information
-        print(f"Vital Signs for {patient_name}:")
-        for paragraph in doc.paragraphs:
-            print(paragraph.text)
-    except FileNotFoundError:
+    encounter = core.recall(patient_name)
+    if encounter is None:
         print(f"No vital signs found for {patient_name}.")
+        return None
+
+    # Print the vital signs information
+    print(f"Vital Signs for {patient_name}:")
+    print(format_encounter(encounter))
+    return encounter
+
+
+#The vital signs of one encounter as text, one per line
+def format_encounter(encounter):
+    return '\n'.join([
+        f"Patient Name: {encounter['patient_name']}",
+        f"Recorded: {time.strftime('%Y-%m-%d %H:%M', time.localtime(encounter['recorded_at']))}",
+        f"Blood pressure (mmHg): {encounter['bp']}",
+        f"Temperature: {encounter['temperature']}",
+        f"Pulse rate: {encounter['pulse_rate']}",
+        f"Oxygen Saturation: {encounter['oxygen_sat']}",
+        f"Respiratory rate: {encounter['respiratory_rate']}",
+        f"Summary of condition: {encounter['summary']}",
+    ])
+
+
+#Exports all encounters of a patient to a Word document and opens it with the default program
+def export_patient_record(patient_name):
+    doc_path = export_docx(core.history(patient_name), f'{patient_name}_vital_signs.docx')
+    open_file(doc_path)
+    return doc_path
+
+
+#Opens a file with the default program on Windows, macOS and Linux
+def open_file(path):
+    if sys.platform.startswith('win'):
+        os.startfile(path)
+    elif sys.platform == 'darwin':
+        subprocess.Popen(['open', path])
+    else:
+        subprocess.Popen(['xdg-open', path])
 
-options = Options()
-options.add_argument("--headless")
-options.add_argument("--disable-gpu")
 
+#Slow work (geocoding, sending the form, saving files) runs here so the screen never freezes
+worker = BackgroundWorker()
 
 #Now, the application itself, built using Kivy as stated earlier
 
 
 
+#The Ghana Health Service logo is read from disk once, and every screen that shows it shares the texture
+LOGO_PATH = os.path.join(APP_DIRECTORY, 'assets', 'Ghana_Health_logo.png')
+logo = {}
+
+def logo_image(**kwargs):
+    if 'texture' not in logo:
+        logo['texture'] = CoreImage(LOGO_PATH).texture
+    return Image(texture=logo['texture'], allow_stretch=True, keep_ratio=True, **kwargs)
+
+
+#How many suggestions the Recall Vitals screen shows while a name is typed
+SUGGESTIONS = 5
+
+
 class MainMenu(BoxLayout):
+    #Every screen is built the first time it is opened and then kept by the screen manager. Going back
+    #to a screen only clears its inputs and changes its texts, so navigating during a long shift does
+    #not create new widgets.
     def __init__(self, **kwargs):
         super(MainMenu, self).__init__(**kwargs)
         self.orientation = 'vertical'
@@ -94,26 +143,47 @@ class MainMenu(BoxLayout):
         self.padding = [40, 20, 40, 20]
         self.size_hint = (1, 1)
         self.pos_hint = {'center_x': 0.5, 'center_y': 0.5}
-        Clock.schedule_once(self.themainmenu, 1)
-
-    def themainmenu(self, instance):    
-        self.clear_widgets()
-        
+        self.reservation_id = None
+        self.redirect_event = None
+        self.screen_builders = {
+            'menu': self.build_main_menu,
+            'vitals': self.build_vitals_screen,
+            'location': self.build_location_screen,
+            'status': self.build_status_screen,
+            'message': self.build_message_screen,
+            'recall': self.build_recall_screen,
+            'record': self.build_record_screen,
+            'mass_casualty': self.build_mass_casualty_screen,
+            'casualty_results': self.build_casualty_results_screen,
+        }
+        self.screen_manager = ScreenManager(transition=NoTransition())
+        self.add_widget(self.screen_manager)
+        # The menu is built straight away, so it is on the very first frame
+        self.themainmenu(None)
+
+    #Shows a screen, building it the first time it is needed
+    def show_screen(self, name):
+        if self.redirect_event is not None:
+            self.redirect_event.cancel()
+            self.redirect_event = None
+        if not self.screen_manager.has_screen(name):
+            screen = Screen(name=name)
+            screen.add_widget(self.screen_builders[name]())
+            self.screen_manager.add_widget(screen)
+        self.screen_manager.current = name
+
+    def themainmenu(self, instance):
+        self.show_screen('menu')
+
+    def build_main_menu(self):
         # Main container
         main_container = BoxLayout(orientation='vertical', spacing=30)
-        
+
         # Header Section
         header = BoxLayout(orientation='vertical', size_hint=(1, 0.3))
-        self.image_widget = Image(
-            source='assets/Ghana_Health_logo.png',  # Update with actual image path
-            allow_stretch=True,
-            keep_ratio=True,
-            size_hint=(0.99, 2),
-            size=(200, 200)
-        )
-        header.add_widget(self.image_widget)
-        
-        self.title_label = Label(
+        header.add_widget(logo_image(size_hint=(0.99, 2), size=(200, 200)))
+
+        title_label = Label(
             text='[b]Vital Signs App[/b]',
             markup=True,
             font_size='50sp',
@@ -122,7 +192,7 @@ class MainMenu(BoxLayout):
             size_hint=(1, 1),
             height=60
         )
-        header.add_widget(self.title_label)
+        header.add_widget(title_label)
         main_container.add_widget(header)
 
         # Button Container
@@ -132,15 +202,16 @@ class MainMenu(BoxLayout):
             size_hint=(0.8, 0.6),
             pos_hint={'center_x': 0.5}
         )
-        
+
         # Custom Styled Buttons
         menu_items = [
             ('Record Vitals & Find A Hospital', self.collect_vitals),
             ('Recall Vitals', self.recall_vital_signs),
+            ('Mass Casualty Mode', self.mass_casualty),
             ('Exit Application', self.exit_app)
         ]
 
-        
+
         for text, callback in menu_items:
             btn = Button(
                 text=text,
@@ -157,7 +228,7 @@ class MainMenu(BoxLayout):
             button_container.add_widget(btn)
 
         main_container.add_widget(button_container)
-        
+
         # Footer Section
         footer = Label(
             text='[i]Medical Assistance System[/i]',
@@ -165,7 +236,7 @@ class MainMenu(BoxLayout):
             font_size='20sp',
             color=(0.4, 0.4, 0.4, 1),
             size_hint=(1, 0.1),
-            height=5 
+            height=5
         )
         main_container.add_widget(footer)
 
@@ -175,33 +246,26 @@ class MainMenu(BoxLayout):
             font_size='18sp',
             color=(0.4, 0.4, 0.4, 1),
             size_hint=(1, None),
-            height=10 
+            height=10
         )
         main_container.add_widget(footer)
-
-        self.add_widget(main_container)
-        
-
+        return main_container
 
     def collect_vitals(self, instance):
-        self.clear_widgets()
-        
+        self.show_screen('vitals')
+        for text_input in (self.patient_name_input, self.bp_input, self.temperature_input, self.pulse_rate_input,
+                           self.oxygen_sat_input, self.respiratory_rate_input, self.summary_input):
+            text_input.text = ''
+
+    def build_vitals_screen(self):
         layout = BoxLayout(orientation='vertical', spacing=10)  # Add spacing to the layout
-        self.add_widget(layout)
-
-        
-        # Add some empty space at the top
-        self.image_widget = Image(source='assets/Ghana_Health_logo.png', 
-                        allow_stretch=True, 
-                        keep_ratio=True, 
-                        size_hint=(1, 1)
-                        )
-        layout.add_widget(self.image_widget)
-        self.image_widget.pos_hint = {'center_x': 0.5, 'center_y': 0.5}
-        
-        self.vitals = Label(text="Patient's Details", font_size=64, font_name='Roboto', bold=True, color=(0.12, 0.46, 0.70, 1))
-        self.vitals.size_hint = (1, 0.8)
-        layout.add_widget(self.vitals)
+
+        image_widget = logo_image(size_hint=(1, 1), pos_hint={'center_x': 0.5, 'center_y': 0.5})
+        layout.add_widget(image_widget)
+
+        vitals = Label(text="Patient's Details", font_size=64, font_name='Roboto', bold=True, color=(0.12, 0.46, 0.70, 1))
+        vitals.size_hint = (1, 0.8)
+        layout.add_widget(vitals)
 
         self.patient_name_input = TextInput(multiline=False, hint_text='Enter Your Name', font_size=25)
         self.patient_name_input.pos_hint = {'center_x': 0.5, 'center_y': 0.5}  # Center the button
@@ -210,11 +274,6 @@ class MainMenu(BoxLayout):
         self.patient_name_input.height = 100
         layout.add_widget(self.patient_name_input)
 
-
-
-        spacer = Widget(size_hint_y=0.01)
-        self.add_widget(spacer)
-
         middle_layout = GridLayout(cols=2, spacing=5)
         layout.add_widget(middle_layout)
 
@@ -239,9 +298,6 @@ class MainMenu(BoxLayout):
         self.respiratory_rate_input = TextInput(multiline=False, hint_text='Respiratory Rate', font_size=25, size_hint=(1, 0.5))
         right_middle_layout.add_widget(self.respiratory_rate_input)
 
-        spacer = Widget(size_hint_y=0.09)
-        self.add_widget(spacer)      
-
         self.summary_input = TextInput(multiline=True, hint_text='Additional Information', font_size=30, )
         self.summary_input.pos_hint = {'top': 1, 'left': 0.5, 'center_x': 0.5}
         self.summary_input.size_hint = (0.5, 0.8)
@@ -253,24 +309,21 @@ class MainMenu(BoxLayout):
         left_bottom_layout = BoxLayout(orientation='vertical', spacing=10)
         bottom_layout.add_widget(left_bottom_layout)
 
-        self.back_button = Button(text='Main Menu', size_hint=(0.4, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
-        self.back_button.bind(on_press=self.themainmenu)
-        left_bottom_layout.add_widget(self.back_button)
+        back_button = Button(text='Main Menu', size_hint=(0.4, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
+        back_button.bind(on_press=self.themainmenu)
+        left_bottom_layout.add_widget(back_button)
 
         right_bottom_layout = BoxLayout(orientation='vertical', spacing=10)
         bottom_layout.add_widget(right_bottom_layout)
 
-        self.submit_button = Button(text='Find a Hospital', size_hint=(0.4, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
-        self.submit_button.bind(on_press=self.find_location)
-        right_bottom_layout.add_widget(self.submit_button)
-
-        spacer = Widget(size_hint_y=0.09)
-        self.add_widget(spacer)
+        submit_button = Button(text='Find a Hospital', size_hint=(0.4, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
+        submit_button.bind(on_press=self.find_location)
+        right_bottom_layout.add_widget(submit_button)
 
         return layout
 
     def find_location(self, instance):
-        
+
         self.patient_name = self.patient_name_input.text
         self.bp = self.bp_input.text
         self.temperature = self.temperature_input.text
@@ -278,24 +331,16 @@ class MainMenu(BoxLayout):
         self.oxygen_sat = self.oxygen_sat_input.text
         self.respiratory_rate = self.respiratory_rate_input.text
         self.summary = self.summary_input.text
-        
-        
-        # Clear the widgets
-        self.clear_widgets()
-
-        
-        
-        # Create a new layout to ask for the person's location
+
+        # Ask for the person's location
+        self.show_screen('location')
+        self.location_input.text = ''
+
+    def build_location_screen(self):
         layout = BoxLayout(orientation='vertical', spacing=30)
-        self.add_widget(layout)
 
-        self.image_widget = Image(source='assets/Ghana_Health_logo.png', 
-                        allow_stretch=True, 
-                        keep_ratio=True, 
-                        size_hint=(0.5, 0.5)
-                        )
-        layout.add_widget(self.image_widget)
-        self.image_widget.pos_hint = {'center_x': 0.5, 'center_y': 0.5}
+        image_widget = logo_image(size_hint=(0.5, 0.5), pos_hint={'center_x': 0.5, 'center_y': 0.5})
+        layout.add_widget(image_widget)
 
         label = Label(text='Your Location:', font_name='Roboto', bold=True, color=(0.12, 0.46, 0.70, 1), font_size=64)
         label.size_hint = (1, None)  # Make the label smaller
@@ -304,230 +349,265 @@ class MainMenu(BoxLayout):
         self.location_input = TextInput(multiline=False, hint_text='Enter Your Current Location', size_hint=(0.3, None), pos_hint={'center_x': 0.5, 'center_y': 0.9}, font_size=25)
         layout.add_widget(self.location_input)
 
-        self.get_hospital_button = Button(text='Find a Hospital', size_hint=(0.3, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
-        layout.add_widget(self.get_hospital_button)  # Add the button to the layout
-        self.get_hospital_button.bind(on_press=self.display_message)
-    
-        spacer = Widget(size_hint_y=0.4)
-        self.add_widget(spacer)
-    
+        get_hospital_button = Button(text='Find a Hospital', size_hint=(0.3, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
+        layout.add_widget(get_hospital_button)  # Add the button to the layout
+        get_hospital_button.bind(on_press=self.display_message)
+        return layout
+
     def display_message(self, instance):
-        self.clear_widgets()
+        self.show_screen('status')
+        self.status_label.text = '''You are being linked to the nearest HeFRA certified hospital.
+Please wait....'''
+
+        # The status label moves on when each stage really finishes, not on a timer
+        self.vitals_record = {
+            'patient_name': self.patient_name,
+            'bp': self.bp,
+            'temperature': self.temperature,
+            'pulse_rate': self.pulse_rate,
+            'oxygen_sat': self.oxygen_sat,
+            'respiratory_rate': self.respiratory_rate,
+            'summary': self.summary,
+        }
+        self.location_name = self.location_input.text
+        # A patient with low oxygen or in shock goes to the nearest hospital that can treat them
+        self.required_capabilities, self.capability_reasons = required_capabilities(self.vitals_record)
+        worker.submit(core.match_patient, self.location_name, self.required_capabilities, on_done=self.get_location,
+                      on_error=self.show_error)
+
+    def build_status_screen(self):
         layout = BoxLayout(orientation='vertical', spacing=30)
-        self.add_widget(layout)
-
-        self.image_widget = Image(source='assets/Ghana_Health_logo.png', 
-                allow_stretch=True, 
-                keep_ratio=True, 
-                size_hint=(0.5, 0.5)
-                )
-        layout.add_widget(self.image_widget)
-        self.image_widget.pos_hint = {'center_x': 0.5, 'center_y': 0.5}
-        label1 = Label(text='''You are being linked to the nearest HeFRA certified hospital. 
-Please wait....''', 
-                   font_name='Roboto', bold=True, 
-                   color=(0, 0, 0, 1), 
-                   font_size=35)
-        layout.add_widget(label1)
-        
-        def show_second_message(dt):
-            layout.remove_widget(label1)
-            label2 = Label(text='''Linked Successfully! 
-Your data is being sent to the hospital. Please wait....''', 
-                   font_name='Roboto', bold=True, 
-                   color=(0, 0, 0, 1), 
+
+        image_widget = logo_image(size_hint=(0.5, 0.5), pos_hint={'center_x': 0.5, 'center_y': 0.5})
+        layout.add_widget(image_widget)
+        self.status_label = Label(font_name='Roboto', bold=True,
+                   color=(0, 0, 0, 1),
                    font_size=35)
-            layout.add_widget(label2)
-            
-            def show_third_message(dt):
-                layout.remove_widget(label2)
-                label3 = Label(text='''Data Sent Successfully! 
-A Google Maps webpage will open to show you the fastest route. Please wait.... 
-Get well soon!''', 
-                           font_name='Roboto', bold=True, 
-                           color=(0, 0, 0, 1), 
-                           font_size=35)
-                layout.add_widget(label3)
-                Clock.schedule_once(self.get_location, 3)
-            
-            Clock.schedule_once(show_third_message, 3)
-        
-        Clock.schedule_once(show_second_message, 3)
-    
-    def get_location(self, instance):
-        current_location_name = self.location_input.text
-        current_latitude, current_longitude = get_coordinates(current_location_name)
-        if current_latitude is None and current_longitude is None:
-            self.clear_widgets()
-            layout = BoxLayout(orientation='vertical', spacing=30)
-            self.add_widget(layout)
-
-            self.image_widget = Image(source='Your Image Here', 
-                allow_stretch=True, 
-                keep_ratio=True, 
-                size_hint=(None, None)
-                )
-            layout.add_widget(self.image_widget)
-            self.image_widget.pos_hint = {'center_x': 0.5, 'center_y': 0.5}
-            label = Label(text='''Location not found
+        layout.add_widget(self.status_label)
+        return layout
+
+    #Called on the UI thread once the patient has been geocoded and matched to a hospital
+    def get_location(self, match):
+        if match is None:
+            self.show_redirect('''Location not found
 You are being redirected to the main menu
-Please wait.......''', 
-                      font_name='Roboto', bold=True, 
-                      color=(0, 0, 0, 1), 
-                      font_size=30)
-            layout.add_widget(label)
-            Clock.schedule_once(self.themainmenu, 3)
-        else:
-            # Variables for the ideal hospital
-            ideal_hospital = None
-            ideal_distance = float('inf')
-
-            # Find the ideal hospital
-            for hospital in hospitals:
-                hospital_name, hospital_latitude, hospital_longitude, available_beds, google_form_link = hospital
-                distance = haversine_distance(current_latitude, current_longitude, hospital_latitude, hospital_longitude)
-                    
-
-                if available_beds > 0 and distance < ideal_distance:
-                    ideal_distance = distance
-                    ideal_hospital = hospital_name
-                    ideal_google_link = google_form_link
-        #Use Google maps for directions to the place
-            if ideal_hospital:
-                destination_location = f"{ideal_hospital} Hospital"
-                url = f"https://www.google.com/maps/dir/{current_latitude},{current_longitude}/{destination_location}"
-                webbrowser.open(url)
-            else:
-                Clock.schedule_once(self.themainmenu, 0.5)
+Please wait.......''')
+            return
 
-                        #Form gets filled online in the hospital's Google Form Link
+        current_latitude, current_longitude, hospital, self.reservation_id = match
+        if hospital is None:
+            self.show_redirect('''No hospital with a free bed was found
+You are being redirected to the main menu
+Please wait.......''')
+            return
 
-            #Initialize web browser
+        hospital_name = hospital[0]
+        self.matched_hospital = hospital_name
+        self.status_label.text = '''Linked Successfully!
+Your data is being sent to the hospital. Please wait....''' + self.capability_note(hospital)
 
-            web = webdriver.Chrome(options=options)
-            web.get(ideal_google_link)
-            time.sleep(2)
+        #Use Google maps for directions to the place
+        worker.submit(webbrowser.open, directions_url(current_latitude, current_longitude, hospital_name))
+
+        worker.submit(core.submit_vitals, hospital, self.vitals_record, on_done=self.vitals_sent, on_error=self.show_error)
+
+    #Why this hospital was chosen when the vitals call for particular services, so the operator knows
+    #why it may not be the nearest one
+    def capability_note(self, hospital):
+        if not self.capability_reasons:
+            return ''
+        needs = ', '.join(capability_names(self.required_capabilities))
+        if core.offers(hospital, self.required_capabilities):
+            return f"\nThe patient needs {needs} ({'; '.join(self.capability_reasons)})"
+        return f"\nNo hospital with {needs} has a free bed, so the nearest hospital was chosen"
+
+    def vitals_sent(self, submission):
+        submission_key, delivered = submission
+        # The patient is on the way, so the reserved bed is now taken
+        core.confirm(self.reservation_id)
+        self.reservation_id = None
+        if delivered:
+            self.status_label.text = '''Data Sent Successfully!
+The fastest route to the hospital is open in Google Maps in your browser.
+Get well soon!'''
+        else:
+            self.status_label.text = '''The connection is slow. Your data is saved and will be sent
+to the hospital as soon as possible. Please go ahead to the hospital.
+Get well soon!'''
+        worker.submit(core.save_vital_signs, self.vitals_record, self.matched_hospital, self.location_name,
+                      on_done=self.vitals_saved, on_error=self.show_error)
 
-            #Enter details
+    #The record is saved; the message stays up for a few seconds before the main menu comes back
+    def vitals_saved(self, encounter_id):
+        self.redirect_event = Clock.schedule_once(self.themainmenu, 5)
 
-            enter_name = web.find_element("xpath", '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[1]/div/div/div[2]/div/div[1]/div/div[1]/input')
-            enter_name.send_keys(self.patient_name)
+    def build_message_screen(self):
+        layout = BoxLayout(orientation='vertical', spacing=30)
+        self.message_label = Label(font_name='Roboto', bold=True,
+                  color=(0, 0, 0, 1),
+                  font_size=30)
+        layout.add_widget(self.message_label)
+        return layout
 
-            enter_bp = web.find_element("xpath", '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[2]/div/div/div[2]/div/div[1]/div/div[1]/input')
-            enter_bp.send_keys(self.bp)
+    #Shows a short message and goes back to the main menu
+    def show_redirect(self, message):
+        self.show_screen('message')
+        self.message_label.text = message
+        self.redirect_event = Clock.schedule_once(self.themainmenu, 3)
+
+    def show_error(self, error):
+        print(f"Dispatch failed: {error!r}")
+        # Give back a bed reserved for a dispatch that did not go ahead
+        if self.reservation_id is not None:
+            core.release(self.reservation_id)
+            self.reservation_id = None
+        self.show_redirect('''An error occured.
+Redirecting to main menu''')
 
-            enter_temp = web.find_element("xpath", '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[3]/div/div/div[2]/div/div[1]/div/div[1]/input')
-            enter_temp.send_keys(self.temperature)
+    def recall_vital_signs(self, instance):
+        self.show_screen('recall')
+        self.recall_name_input.text = ''
+        self.show_suggestions(self.recall_name_input, '')
+        # The name index is built on the worker; suggestions appear once it is ready
+        if core.patient_index is None:
+            worker.submit(core.build_patient_index, on_done=self.patient_index_ready,
+                          on_error=lambda error: print(f"Patient index failed: {error!r}"))
+
+    def build_recall_screen(self):
+        layout = BoxLayout(orientation='vertical', spacing = 80)
 
-            enter_pulse = web.find_element("xpath", '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[4]/div/div/div[2]/div/div[1]/div/div[1]/input')
-            enter_pulse.send_keys(self.pulse_rate)
+        title_label = Label(text='Patient Name', font_size=64, font_name='Roboto', bold=True, color=(0.12, 0.46, 0.70, 1))
+        title_label.size_hint = (1, 0.4)
+        layout.add_widget(title_label)
+        self.recall_name_input = TextInput(multiline=False, hint_text='Enter Your Name', size_hint=(0.3, 0.3), pos_hint={'center_x': 0.5, 'center_y': 0.9})
+        self.recall_name_input.bind(text=self.show_suggestions)
+        layout.add_widget(self.recall_name_input)
+
+        # Matching patient names appear here while the name is typed. The buttons are made once;
+        # the ones not needed are hidden.
+        suggestions_layout = BoxLayout(orientation='vertical', spacing=2, size_hint=(0.3, 1), pos_hint={'center_x': 0.5})
+        layout.add_widget(suggestions_layout)
+        self.suggestion_buttons = []
+        for number in range(SUGGESTIONS):
+            button = Button(background_normal='', background_color=(0.9, 0.93, 0.97, 1), color=(0, 0, 0, 1))
+            button.bind(on_press=self.pick_suggestion)
+            suggestions_layout.add_widget(button)
+            self.suggestion_buttons.append(button)
 
-            enter_oxygensat = web.find_element("xpath", '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[5]/div/div/div[2]/div/div[1]/div/div[1]/input')
-            enter_oxygensat.send_keys(self.oxygen_sat)
+        bottom_layout = GridLayout(cols=2, spacing=1)
+        layout.add_widget(bottom_layout)
 
-            enter_rr = web.find_element("xpath", '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[6]/div/div/div[2]/div/div[1]/div/div[1]/input')
-            enter_rr.send_keys(self.respiratory_rate)
+        left_bottom_layout = BoxLayout(orientation='vertical', spacing=10)
+        bottom_layout.add_widget(left_bottom_layout)
 
-            enter_summary = web.find_element("xpath", '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[7]/div/div/div[2]/div/div[1]/div[2]/textarea')
-            enter_summary.send_keys(self.summary)
+        back_button = Button(text='Main Menu', size_hint=(0.35, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
+        back_button.bind(on_press=self.themainmenu)
+        left_bottom_layout.add_widget(back_button)
 
-                #Submit form
+        right_bottom_layout = BoxLayout(orientation='vertical', spacing=10)
+        bottom_layout.add_widget(right_bottom_layout)
 
-            submit = web.find_element("xpath", '//*[@id="mG61Hd"]/div[2]/div/div[3]/div[1]/div[1]/div/span/span')
-            submit.click()
-            time.sleep(2)
-            web.quit()
+        fetch_button = Button(text='Get Vitals', size_hint=(0.35, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
+        fetch_button.bind(on_press=self.get_patient_name)
+        right_bottom_layout.add_widget(fetch_button)
+        return layout
 
-            # Create a new Word document
-            doc = Document()
-                    
-                    # Add title with patient's name
-            doc.add_heading(f'Patient Vital Signs - {self.patient_name}', level=1)
-                    
-                    # Add vital signs information
+    def patient_index_ready(self, result):
+        self.show_suggestions(self.recall_name_input, self.recall_name_input.text)
 
-            doc.add_paragraph(f"Patient Name: {self.patient_name}")
-            doc.add_paragraph(f"Blood pressure (mmHg): {self.bp}")
-            doc.add_paragraph(f"Temperature: {self.temperature}")
-            doc.add_paragraph(f"Pulse rate: {self.pulse_rate}")
-            doc.add_paragraph(f"Oxygen Saturation: {self.oxygen_sat}")
-            doc.add_paragraph(f"Respiratory rate: {self.respiratory_rate}")
-            doc.add_paragraph(f"Summary of condition: {self.summary}")
-                    
-            # Save the document
-            doc.save(f'{self.patient_name}_vital_signs.docx')
+    def show_suggestions(self, text_input, text):
+        names = [name for name in core.suggest_patients(text, limit=SUGGESTIONS, wait=False) if name != text] if text else []
+        for number, button in enumerate(self.suggestion_buttons):
+            shown = number < len(names)
+            button.text = names[number] if shown else ''
+            button.opacity = 1 if shown else 0
+            button.disabled = not shown
 
-            Clock.schedule_once(self.themainmenu, 1)
+    def pick_suggestion(self, button):
+        self.recall_name_input.text = button.text
+        self.get_patient_name(button)
 
-    def recall_vital_signs(self, instance):
-        self.clear_widgets()
-        layout = BoxLayout(orientation='vertical', spacing = 80)
-        self.add_widget(layout)
+    def get_patient_name(self, instance):
+        self.patient_name = self.recall_name_input.text
+        worker.submit(core.recall, self.patient_name, on_done=self.show_patient_record, on_error=self.show_error)
 
-        self.image_widget = Image(source='Your Image Here', 
-        allow_stretch=True, 
-        keep_ratio=True, 
-        size_hint=(None, None)
-        )
-        layout.add_widget(self.image_widget)
-        self.image_widget.pos_hint = {'center_x': 0.5, 'center_y': 0.5}
-        self.title_label = Label(text='Patient Name', font_size=64, font_name='Roboto', bold=True, color=(0.12, 0.46, 0.70, 1))
-        self.title_label.size_hint = (1, 0.4)
-        layout.add_widget(self.title_label)
-        self.patient_name_input = TextInput(multiline=False, hint_text='Enter Your Name', size_hint=(0.3, 0.3), pos_hint={'center_x': 0.5, 'center_y': 0.9})
-        layout.add_widget(self.patient_name_input)
-        
-        bottom_layout = GridLayout(cols=2, spacing=1)
+    def build_record_screen(self):
+        layout = BoxLayout(orientation='vertical', spacing = 10)
+        self.record_label = Label(font_name='Roboto',
+                    color=(0, 0, 0, 1),
+                    font_size=30,
+                    pos_hint={'center_x': 0.5, 'center_y': 0.5})
+        layout.add_widget(self.record_label)
+
+        bottom_layout = GridLayout(cols=2, spacing=10, size_hint=(1, 0.2))
         layout.add_widget(bottom_layout)
 
-        left_bottom_layout = BoxLayout(orientation='vertical', spacing=10)
-        bottom_layout.add_widget(left_bottom_layout)
+        back_button = Button(text='Main Menu', background_color=(0.12, 0.46, 0.70, 1))
+        back_button.bind(on_press=self.themainmenu)
+        bottom_layout.add_widget(back_button)
 
-        self.back_button = Button(text='Main Menu', size_hint=(0.35, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
-        self.back_button.bind(on_press=self.themainmenu)
-        left_bottom_layout.add_widget(self.back_button)
+        export_button = Button(text='Export to Word', background_color=(0.12, 0.46, 0.70, 1))
+        export_button.bind(on_press=lambda button: worker.submit(export_patient_record, self.recalled_patient, on_error=self.show_error))
+        bottom_layout.add_widget(export_button)
+        return layout
 
-        right_bottom_layout = BoxLayout(orientation='vertical', spacing=10)
-        bottom_layout.add_widget(right_bottom_layout)
+    #Shows the patient's latest vitals, with a button to export all their encounters to Word
+    def show_patient_record(self, encounter):
+        if encounter is None:
+            self.show_redirect('''No record found.
+    Redirecting to main menu''')
+            return
 
-        self.fetch_button = Button(text='Get Vitals', size_hint=(0.35, None), pos_hint={'center_x': 0.5, 'center_y': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
-        self.fetch_button.bind(on_press=self.get_patient_name)
-        right_bottom_layout.add_widget(self.fetch_button)
+        self.show_screen('record')
+        self.recalled_patient = encounter['patient_name']
+        self.record_label.text = format_encounter(encounter)
 
-        spacer = Widget(size_hint_y=0.4)
-        self.add_widget(spacer)
+    def mass_casualty(self, instance):
+        self.show_screen('mass_casualty')
+        self.casualties_input.text = ''
+        self.assign_button.text = 'Assign Hospitals'
+        self.assign_button.disabled = False
 
+    def build_mass_casualty_screen(self):
+        layout = BoxLayout(orientation='vertical', spacing=20)
 
-    def get_patient_name(self, instance):
-        self.patient_name = self.patient_name_input.text
-        self.clear_widgets()
-        layout = BoxLayout(orientation='vertical', spacing = 10)
-        self.add_widget(layout)  # Add the layout to the screen after adding the label
-        sleep(2)
-        try:
-            doc_path = f'{self.patient_name}_vital_signs.docx'
-            os.startfile(doc_path)
-        except FileNotFoundError:
-            self.clear_widgets()
-            label = Label(text='''File not found.
-    Redirecting to main menu''', 
-                        font_name='Roboto', bold=True, 
-                        color=(0, 0, 0, 1), 
-                        font_size=30, 
-                        pos_hint={'center_x': 0.5, 'center_y': 0.5})
-            layout.add_widget(label)
-            Clock.schedule_once(self.themainmenu, 3)
-        except Exception as e:
-            self.clear_widgets()
-            label = Label(text='''An error occured.
-    Redirecting to main menu''', 
-                        font_name='Roboto', bold=True, 
-                        color=(0, 0, 0, 1), 
-                        font_size=30, 
-                        pos_hint={'center_x': 0.5, 'center_y': 0.5})
-            layout.add_widget(label)
-            Clock.schedule_once(self.themainmenu, 3)
-        Clock.schedule_once(self.themainmenu, 3)
+        label = Label(text='Mass Casualty', font_size=64, font_name='Roboto', bold=True, color=(0.12, 0.46, 0.70, 1), size_hint=(1, 0.2))
+        layout.add_widget(label)
+
+        self.casualties_input = TextInput(multiline=True, hint_text='''One patient per line: location, priority
+(1 = immediate, 2 = urgent, 3 = can wait)''', font_size=25)
+        layout.add_widget(self.casualties_input)
+
+        bottom_layout = GridLayout(cols=2, spacing=10, size_hint=(1, 0.15))
+        layout.add_widget(bottom_layout)
+
+        back_button = Button(text='Main Menu', background_color=(0.12, 0.46, 0.70, 1))
+        back_button.bind(on_press=self.themainmenu)
+        bottom_layout.add_widget(back_button)
+
+        self.assign_button = Button(text='Assign Hospitals', background_color=(0.12, 0.46, 0.70, 1))
+        self.assign_button.bind(on_press=self.assign_casualties)
+        bottom_layout.add_widget(self.assign_button)
+        return layout
+
+    def assign_casualties(self, instance):
+        lines = [line for line in self.casualties_input.text.splitlines() if line.strip()]
+        self.assign_button.text = 'Assigning...'
+        self.assign_button.disabled = True
+        worker.submit(assign_mass_casualty, lines, on_done=self.show_casualty_assignments, on_error=self.show_error)
+
+    def build_casualty_results_screen(self):
+        layout = BoxLayout(orientation='vertical', spacing=10)
+        self.casualty_results_label = Label(font_name='Roboto', color=(0, 0, 0, 1), font_size=25)
+        layout.add_widget(self.casualty_results_label)
+        back_button = Button(text='Main Menu', size_hint=(0.35, 0.15), pos_hint={'center_x': 0.5}, background_color=(0.12, 0.46, 0.70, 1))
+        back_button.bind(on_press=self.themainmenu)
+        layout.add_widget(back_button)
+        return layout
+
+    def show_casualty_assignments(self, summary):
+        self.show_screen('casualty_results')
+        self.casualty_results_label.text = summary
 
     def exit_app(self, instance):
         App.get_running_app().stop()
@@ -535,7 +615,28 @@ Please wait.......''',
 
 class VitalSignsApp(App):
     def build(self):
-        return MainMenu()
+        core.start(index_patients=False)  # The Recall screen builds it on the worker when it is opened
+        menu = MainMenu()
+        startup_profile.mark('main menu built')
+        return menu
+
+    def on_start(self):
+        if startup_profile.PROFILE:
+            Window.bind(on_flip=self.first_frame)
+
+    #Called when the first frame is on screen, in startup-profiling mode only
+    def first_frame(self, window):
+        Window.unbind(on_flip=self.first_frame)
+        startup_profile.mark('first frame')
+        self.within_startup_budget = startup_profile.report()
+        self.stop()
+
+    def on_stop(self):
+        worker.shutdown()
+        core.close()
 
 if __name__ == '__main__':
-    VitalSignsApp().run()
\ No newline at end of file
+    app = VitalSignsApp()
+    app.run()
+    if startup_profile.PROFILE:
+        sys.exit(0 if getattr(app, 'within_startup_budget', False) else 1)
\ No newline at end of file
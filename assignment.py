@@ -0,0 +1,89 @@
+# Mass-casualty batch assignment for the Vital Signs app.
+# Normally each patient is sent to the nearest hospital with a free bed, one at a time. After a bus
+# crash that greedy choice fills the nearest hospital with the first few patients and sends the rest
+# (often the most critical ones) far away. Here all patients are assigned together:
+# 1. one vectorized N x M matrix of distances from every patient to every hospital with beds
+# 2. each hospital becomes as many "slots" as it has free beds, and each patient is matched to one
+#    slot so that the total (priority-weighted) distance is as small as possible. This is the
+#    assignment problem, solved with SciPy's Hungarian-style linear_sum_assignment
+# 3. when there are fewer beds than patients, the least urgent patients are the ones left unassigned
+# Only each patient's nearest hospitals get slots, which keeps the problem small (well under a
+# second for hundreds of patients and hundreds of hospitals).
+
+import numpy as np
+
+from matching import haversine_matrix
+
+#Triage priority (1 = immediate, 2 = urgent, 3 = can wait) -> how much each km of their trip counts
+PRIORITY_WEIGHTS = {1: 4.0, 2: 2.0, 3: 1.0}
+DEFAULT_PRIORITY = 2
+CANDIDATE_HOSPITALS = 16  # Nearest hospitals per patient that get slots
+UNASSIGNED_KM = 10000.0  # Cost of leaving a patient without a bed, in (weighted) km
+
+
+#patients is a list of (lat, long); hospital_latitudes, hospital_longitudes and beds are per hospital.
+#Returns one (hospital index, distance in km) per patient, or (None, None) for patients that could
+#not get a bed.
+def assign_patients(patients, hospital_latitudes, hospital_longitudes, beds, priorities=None,
+                    candidate_hospitals=CANDIDATE_HOSPITALS):
+    # SciPy takes a third of a second to import, so it is only loaded when a batch is actually assigned
+    from scipy.optimize import linear_sum_assignment
+
+    if not patients:
+        return []
+    beds = np.asarray(beds, dtype=np.int64)
+    open_hospitals = np.flatnonzero(beds > 0)
+    if len(open_hospitals) == 0:
+        return [(None, None)] * len(patients)
+
+    patient_count = len(patients)
+    distances = haversine_matrix([patient[0] for patient in patients], [patient[1] for patient in patients],
+                                 np.asarray(hospital_latitudes)[open_hospitals],
+                                 np.asarray(hospital_longitudes)[open_hospitals])
+    weights = np.array([PRIORITY_WEIGHTS.get(priority, PRIORITY_WEIGHTS[DEFAULT_PRIORITY])
+                        for priority in (priorities if priorities is not None else [DEFAULT_PRIORITY] * patient_count)])
+
+    # Give slots to each patient's nearest hospitals, looking further out until there are enough beds
+    candidates = min(candidate_hospitals, len(open_hospitals))
+    while True:
+        if candidates < len(open_hospitals):
+            nearest = np.argpartition(distances, candidates - 1, axis=1)[:, :candidates]
+        else:
+            nearest = np.tile(np.arange(len(open_hospitals)), (patient_count, 1))
+        wanted = np.bincount(nearest.ravel(), minlength=len(open_hospitals))
+        slots = np.minimum(beds[open_hospitals], wanted)
+        if slots.sum() >= patient_count or candidates >= len(open_hospitals):
+            break
+        candidates = min(candidates * 2, len(open_hospitals))
+
+    slot_hospitals = np.repeat(np.arange(len(open_hospitals)), slots)
+    costs = distances[:, slot_hospitals] * weights[:, None]
+    # "No bed" columns, enough for everyone; leaving an urgent patient out costs more than a less urgent one
+    unassigned = np.repeat((UNASSIGNED_KM * weights)[:, None], patient_count, axis=1)
+    costs = np.hstack([costs, unassigned])
+
+    rows, columns = linear_sum_assignment(costs)
+    assignments = [(None, None)] * patient_count
+    for row, column in zip(rows, columns):
+        if column < len(slot_hospitals):
+            hospital = slot_hospitals[column]
+            assignments[row] = (int(open_hospitals[hospital]), float(distances[row, hospital]))
+    return assignments
+
+
+#The one-at-a-time rule the app uses for single patients, applied to a batch in order. Useful to
+#compare against assign_patients.
+def assign_greedy(patients, hospital_latitudes, hospital_longitudes, beds):
+    beds = np.array(beds, dtype=np.int64)
+    distances = haversine_matrix([patient[0] for patient in patients], [patient[1] for patient in patients],
+                                 hospital_latitudes, hospital_longitudes)
+    assignments = []
+    for row in distances:
+        row = np.where(beds > 0, row, np.inf)
+        hospital = int(np.argmin(row))
+        if np.isinf(row[hospital]):
+            assignments.append((None, None))
+            continue
+        beds[hospital] -= 1
+        assignments.append((hospital, float(row[hospital])))
+    return assignments
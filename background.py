@@ -0,0 +1,37 @@
+# Background work for the Vital Signs app.
+# Kivy draws the screen and handles taps on one thread (the main loop). Anything slow that runs there
+# (geocoding, opening Chrome, writing a .docx) freezes the app until it is done.
+# BackgroundWorker runs that kind of work on a small pool of threads and hands the result back to the
+# main loop through Kivy's Clock, so callbacks are always safe to touch widgets.
+
+from concurrent.futures import ThreadPoolExecutor
+
+from kivy.clock import Clock
+
+WORKER_THREADS = 4
+
+
+class BackgroundWorker:
+    def __init__(self, max_workers=WORKER_THREADS, schedule=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='vitals-worker')
+        # schedule(callback) must run callback on the UI thread. It defaults to the next Kivy frame.
+        self.schedule = schedule or (lambda callback: Clock.schedule_once(lambda dt: callback(), 0))
+
+    #Runs function(*args) on a worker thread. on_done(result) or on_error(exception) is then called on the UI thread.
+    def submit(self, function, *args, on_done=None, on_error=None):
+        future = self.executor.submit(function, *args)
+
+        def finished(future):
+            error = future.exception()
+            if error is not None:
+                if on_error is not None:
+                    self.schedule(lambda: on_error(error))
+            elif on_done is not None:
+                result = future.result()
+                self.schedule(lambda: on_done(result))
+
+        future.add_done_callback(finished)
+        return future
+
+    def shutdown(self, wait=False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,328 @@
+# Live bed availability for the Vital Signs app.
+# available_beds used to be a number typed into the hospital list that nothing ever decreased, so
+# many ambulances dispatched at the same time were all sent to the same hospital with "2 beds".
+# BedRegistry keeps the live count per hospital:
+# - a feed (a file the hospitals' systems write to) updates the counts while the app runs
+# - matching takes a reservation on a bed, under a lock, so two dispatches cannot get the same bed
+# - a reservation that is not confirmed in time expires and gives the bed back
+# - listeners (the matching index) are told about every change, so they never pick a full hospital
+# It also measures how often the lock was contended and how long feed updates take to become visible.
+
+import csv
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from hospital_registry import facility_ids, hospital_columns
+from outbox import percentiles
+
+RESERVATION_TTL = 120.0  # Seconds a matched bed is held while the vitals are sent
+FEED_POLL_INTERVAL = 1.0
+CONFIRMATION_WINDOW = 600.0  # Seconds confirmations are remembered, to correct bed reports sent before them
+
+
+class RegistryRetired(Exception):
+    #The registry was replaced by a reload; the caller should try again on the new one
+    pass
+
+
+class BedRegistry:
+    #hospitals is the usual 2D list ("name", lat, long, available beds, ...) or a HospitalRegistry.
+    #Hospitals are numbered by their row; outside the registry they are named by facility id (see find).
+    def __init__(self, hospitals, reservation_ttl=RESERVATION_TTL):
+        names, latitudes, longitudes, beds = hospital_columns(hospitals)
+        self.hospitals = hospitals
+        self.names = list(names)
+        self._ids = None
+        self._positions = None
+        self.beds = [int(count) for count in beds]  # beds the hospital reports as free
+        self.held = [0] * len(hospitals)  # beds we have reserved but not confirmed yet
+        self.reservation_ttl = reservation_ttl
+        self.reservations = {}  # reservation id -> (hospital index, expires at)
+        self.expiry_heap = []
+        #When (time.time()) each hospital's recent confirmations were made. A report the hospital sent
+        #before a confirmation does not count that patient yet.
+        self.confirmed_at = [deque() for name in self.names]
+        self.feed_rows = {}  # hospital index -> (available_beds, updated_at) last applied from the feed
+        self.next_id = itertools.count(1)
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.update_latencies = deque(maxlen=10000)
+        self.stats = {'reservations': 0, 'rejected': 0, 'confirmed': 0, 'released': 0, 'expired': 0,
+                      'updates': 0, 'lock_acquisitions': 0, 'lock_contended': 0, 'lock_wait': 0.0}
+        self.feed_thread = None
+        self.feed_path = None
+        self.stopping = threading.Event()
+        self.retired = False
+
+    def _acquire(self):
+        # Counts how often someone else already held the lock, and how long we waited for it
+        if self.lock.acquire(blocking=False):
+            self.stats['lock_acquisitions'] += 1
+            return
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.stats['lock_acquisitions'] += 1
+        self.stats['lock_contended'] += 1
+        self.stats['lock_wait'] += time.perf_counter() - start
+
+    #The facility id of every hospital, worked out the first time it is needed
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = facility_ids(self.hospitals)
+        return self._ids
+
+    #The row of a hospital given by its facility id, by its name when no other hospital has that name,
+    #or by its row. Returns None for a hospital that is not in the registry or a name several hospitals share.
+    def find(self, hospital):
+        if not isinstance(hospital, str):
+            return int(hospital) if 0 <= hospital < len(self.names) else None
+        if self._positions is None:
+            names = {}
+            for index, name in enumerate(self.names):
+                names[name] = None if name in names else index
+            self._positions = {facility: index for index, facility in enumerate(self.ids)}, names
+        by_id, by_name = self._positions
+        index = by_id.get(hospital)
+        return by_name.get(hospital) if index is None else index
+
+    #listener(hospital index, available beds) is called every time a hospital's availability changes
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        for index in range(len(self.names)):
+            listener(index, self.available(index))
+
+    def _changed(self, index):
+        available = max(0, self.beds[index] - self.held[index])
+        for listener in self.listeners:
+            listener(index, available)
+
+    def _expire(self, now):
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, reservation_id = heapq.heappop(self.expiry_heap)
+            reservation = self.reservations.pop(reservation_id, None)
+            if reservation is not None:
+                self.held[reservation[0]] -= 1
+                self.stats['expired'] += 1
+                self._changed(reservation[0])
+
+    #Gives back the beds of reservations that have run out. The index only sees a fully held hospital as
+    #full, so this has to happen before asking it, not only when a bed at that hospital is reserved.
+    def expire(self):
+        now = time.monotonic()
+        if not self.expiry_heap or self.expiry_heap[0][0] > now:
+            return
+        self._acquire()
+        try:
+            self._expire(now)
+        finally:
+            self.lock.release()
+
+    def available(self, index):
+        self.expire()
+        return max(0, self.beds[index] - self.held[index])
+
+    #Holds one bed at the hospital. Returns a reservation id, or None if it has no free bed.
+    def reserve(self, index, ttl=None):
+        now = time.monotonic()
+        self._acquire()
+        try:
+            if self.retired:
+                raise RegistryRetired()
+            self._expire(now)
+            if self.beds[index] - self.held[index] <= 0:
+                self.stats['rejected'] += 1
+                return None
+            reservation_id = next(self.next_id)
+            expires_at = now + (ttl or self.reservation_ttl)
+            self.reservations[reservation_id] = (index, expires_at)
+            heapq.heappush(self.expiry_heap, (expires_at, reservation_id))
+            self.held[index] += 1
+            self.stats['reservations'] += 1
+            self._changed(index)
+            return reservation_id
+        finally:
+            self.lock.release()
+
+    #Finds the nearest hospitals with the index (a HospitalIndex, or CoverageTiles in front of one) and
+    #reserves a bed at the first one that still has one.
+    #rank(candidates) may reorder the (hospital index, distance) candidates, for example by driving time.
+    #Only hospitals offering every service in the required bitmask are considered.
+    #Returns (hospital index, distance or rank score, reservation id) or None.
+    def reserve_nearest(self, hospital_index, latitude, longitude, k=5, rank=None, required=0):
+        self.expire()
+        tried = set()
+        while True:
+            candidates = [candidate for candidate in hospital_index.nearest(latitude, longitude, k=k, required=required)
+                          if candidate[0] not in tried]
+            if not candidates:
+                return None
+            if rank is not None:
+                candidates = rank(candidates)
+            for index, score in candidates:
+                reservation_id = self.reserve(index)
+                if reservation_id is not None:
+                    return index, score, reservation_id
+                tried.add(index)
+            # Others took the beds while we were looking; look further out
+            k *= 2
+            if k > 2 * len(self.names):
+                return None
+
+    #The patient was sent to the hospital: the bed is now taken until the hospital reports otherwise
+    def confirm(self, reservation_id):
+        self._acquire()
+        try:
+            if self.retired:
+                raise RegistryRetired()
+            reservation = self.reservations.pop(reservation_id, None)
+            if reservation is None:
+                return False
+            index = reservation[0]
+            self.held[index] -= 1
+            self.beds[index] = max(0, self.beds[index] - 1)
+            now = time.time()
+            confirmed_at = self.confirmed_at[index]
+            confirmed_at.append(now)
+            while confirmed_at[0] < now - CONFIRMATION_WINDOW:
+                confirmed_at.popleft()
+            self.stats['confirmed'] += 1
+            self._changed(index)
+            return True
+        finally:
+            self.lock.release()
+
+    #The dispatch did not go ahead: give the bed back
+    def release(self, reservation_id):
+        self._acquire()
+        try:
+            if self.retired:
+                raise RegistryRetired()
+            reservation = self.reservations.pop(reservation_id, None)
+            if reservation is None:
+                return False
+            self.held[reservation[0]] -= 1
+            self.stats['released'] += 1
+            self._changed(reservation[0])
+            return True
+        finally:
+            self.lock.release()
+
+    #A hospital reported its free beds. sent_at is when the hospital sent it (time.time()). Patients we
+    #confirmed after that are not in the report yet, so they are taken off the reported count; without
+    #sent_at the report is taken as current. sent_at is also used to measure how long updates take to
+    #become visible to matching. hospital is anything find takes.
+    def apply_update(self, hospital, beds, sent_at=None):
+        index = self.find(hospital)
+        if index is None:
+            return False
+        self._acquire()
+        try:
+            if self.retired:
+                raise RegistryRetired()
+            beds = int(beds)
+            if sent_at is not None:
+                beds -= sum(1 for confirmed_at in self.confirmed_at[index] if confirmed_at > sent_at)
+            self.beds[index] = max(0, beds)
+            self.stats['updates'] += 1
+            self._changed(index)
+        finally:
+            self.lock.release()
+        if sent_at is not None:
+            self.update_latencies.append(time.time() - sent_at)
+        return True
+
+    #Reads a feed file and applies the rows that changed. The file is either CSV with the columns
+    #name, available_beds (and optionally updated_at, and id, the facility id, for hospitals that share
+    #their name with another), or JSON lines with the same keys.
+    def load_feed(self, path):
+        with open(path, newline='', encoding='utf-8') as file:
+            if path.endswith('.csv'):
+                rows = list(csv.DictReader(file))
+            else:
+                rows = [json.loads(line) for line in file if line.strip()]
+        applied = 0
+        for row in rows:
+            index = self.find(row.get('id') or row['name'])
+            if index is None:
+                continue
+            sent_at = float(row['updated_at']) if row.get('updated_at') else None
+            report = (int(row['available_beds']), sent_at)
+            if self.feed_rows.get(index) == report:
+                continue  # Already applied; applying it again would undo the confirmations made since
+            self.feed_rows[index] = report
+            applied += self.apply_update(index, report[0], sent_at)
+        return applied
+
+    #Takes over the live state of the registry this one replaces when the hospital list is reloaded: the
+    #bed counts, reservations and counters of the hospitals that are in both. A hospital is matched by
+    #facility id, or, if it moved, by its name when that is unique in both lists. Call it with previous.lock
+    #held, and keep holding it until this registry is in use, so no reservation is lost in between.
+    #previous is retired: from then on reserving, confirming or releasing on it raises RegistryRetired,
+    #so a dispatch that started before the reload does not change a registry nobody reads any more.
+    def adopt(self, previous):
+        previous.retired = True
+        with self.lock:
+            moved = {}
+            for old_index, facility in enumerate(previous.ids):
+                new_index = self.find(facility)
+                if new_index is None and previous.find(previous.names[old_index]) is not None:
+                    new_index = self.find(previous.names[old_index])
+                moved[old_index] = new_index
+            for old_index, new_index in moved.items():
+                if new_index is not None:
+                    self.beds[new_index] = previous.beds[old_index]
+                    self.confirmed_at[new_index] = previous.confirmed_at[old_index]
+                    if old_index in previous.feed_rows:
+                        self.feed_rows[new_index] = previous.feed_rows[old_index]
+            for reservation_id, (old_index, expires_at) in previous.reservations.items():
+                new_index = moved[old_index]
+                if new_index is not None:
+                    self.reservations[reservation_id] = (new_index, expires_at)
+                    heapq.heappush(self.expiry_heap, (expires_at, reservation_id))
+                    self.held[new_index] += 1
+            self.next_id = previous.next_id
+            self.stats.update(previous.stats)
+            for new_index in moved.values():
+                if new_index is not None:
+                    self._changed(new_index)
+
+    #Watches a feed file and applies it every time it changes
+    def watch_file(self, path, interval=FEED_POLL_INTERVAL):
+        self.feed_path = path
+        def watch():
+            last_modified = None
+            while not self.stopping.is_set():
+                try:
+                    self.expire()
+                    modified = os.stat(path).st_mtime_ns
+                    if modified != last_modified:
+                        last_modified = modified
+                        self.load_feed(path)
+                except RegistryRetired:
+                    return  # The new registry watches the file from now on
+                except (OSError, ValueError, KeyError) as error:
+                    if not isinstance(error, FileNotFoundError):
+                        print(f"Bed feed {path} could not be read: {error!r}")
+                self.stopping.wait(interval)
+
+        self.feed_thread = threading.Thread(target=watch, name='bed-feed', daemon=True)
+        self.feed_thread.start()
+        return self.feed_thread
+
+    def stop(self):
+        self.stopping.set()
+        if self.feed_thread is not None:
+            self.feed_thread.join()
+
+    def registry_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['held'] = sum(self.held)
+        stats['update_latency'] = percentiles(list(self.update_latencies))
+        return stats
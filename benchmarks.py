@@ -0,0 +1,302 @@
+# Benchmarks for the hot paths of a dispatch: matching, geocoding, form submission, patient records,
+# patient search, bulk export and loading the hospital registry.
+# Everything runs on synthetic data and local stand-ins (stand_ins.py), so the numbers do not depend
+# on the network. Matching is measured on synthetic HeFRA registries of 10 to 100,000 facilities.
+# Every stage reports operations per second and p50/p99 latency. The results can be saved as a
+# baseline, and later runs fail (exit code 1) when a stage got slower than the baseline by more
+# than the threshold.
+# Run with:
+#   python benchmarks.py              measure and compare with the saved baseline, if there is one
+#   python benchmarks.py save         measure and save the results as the new baseline
+#   python benchmarks.py quick        smaller registries and shorter runs
+#   python benchmarks.py matching     only the stages whose name starts with "matching" (any prefix works)
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from bed_registry import BedRegistry
+from bulk_export import export_encounters
+from coverage_tiles import CoverageTiles
+from geocoding import GeocodingResolver
+from hospital_registry import capability_mask, facilities_from_list, HospitalRegistry, write_snapshot
+from matching import haversine_distance, HospitalIndex
+from outbox import percentiles
+from patient_search import PatientSearchIndex
+from records import RecordStore
+from stand_ins import StandInFormServer, StandInNominatim
+from submission import HttpFormSubmitter
+
+BASELINE_PATH = 'benchmarks_baseline.json'
+REGRESSION_THRESHOLD = 0.25  # A stage fails when its ops/sec drops, or its p50 grows, by more than this
+REGISTRY_SIZES = (10, 1000, 10000, 100000)
+QUICK_REGISTRY_SIZES = (10, 1000, 10000)
+STAGE_SECONDS = 1.0  # How long each stage is measured for
+QUICK_STAGE_SECONDS = 0.25
+RECORDS = 50000  # Encounters in the record store before it is measured
+EXPORTED = 10000  # Encounters in a bulk export
+PATIENT_NAMES = 100000
+
+#Ghana's bounding box, where the synthetic facilities and patients are placed
+GHANA_LATITUDES = (4.74, 11.17)
+GHANA_LONGITUDES = (-3.26, 1.19)
+FIRST_NAMES = ['Kwame', 'Ama', 'Kofi', 'Akosua', 'Yaw', 'Abena', 'Kwaku', 'Adwoa', 'Kojo', 'Efua', 'Kwabena',
+               'Akua', 'Fiifi', 'Esi', 'Kwesi', 'Afua', 'Nana', 'Yaa', 'Selorm', 'Dzifa', 'Ibrahim', 'Amina']
+SURNAMES = ['Mensah', 'Asante', 'Owusu', 'Boateng', 'Osei', 'Agyeman', 'Appiah', 'Nkrumah', 'Danso', 'Addo',
+            'Quaye', 'Tetteh', 'Amoah', 'Acheampong', 'Ofori', 'Sarpong', 'Adjei', 'Darko', 'Gyamfi', 'Fosu']
+#How many facilities offer each service in the synthetic registries
+SERVICE_SHARES = {'emergency': 0.6, 'oxygen': 0.5, 'icu': 0.05, 'surgery': 0.2, 'trauma': 0.1,
+                  'pediatrics': 0.25, 'maternity': 0.4, 'laboratory': 0.5}
+ICU = capability_mask(['icu', 'oxygen'])
+
+
+#A HeFRA-like registry in the app's usual 2D list format ("name", lat, long, available beds, link, mapping)
+def synthetic_registry(size, seed=0):
+    generator = random.Random(seed)
+    services = random.Random(seed + 1)  # Separate, so the places are the same as without services
+    return [[f"Facility {number}",
+             generator.uniform(*GHANA_LATITUDES),
+             generator.uniform(*GHANA_LONGITUDES),
+             generator.choice([0, 0, 1, 2, 5, 10, 20]),
+             f"Google Form Link {number}",
+             {},
+             [service for service, share in SERVICE_SHARES.items() if services.random() < share]]
+            for number in range(size)]
+
+
+#Patients as the app sees them: a vitals dictionary and where they are
+def synthetic_patients(count, seed=1):
+    generator = random.Random(seed)
+    patients = []
+    for number in range(count):
+        name = f"{generator.choice(FIRST_NAMES)} {generator.choice(SURNAMES)} {number}"
+        vitals = {'patient_name': name,
+                  'bp': f"{generator.randint(90, 180)}/{generator.randint(50, 110)}",
+                  'temperature': f"{generator.uniform(35.5, 40.5):.1f}",
+                  'pulse_rate': str(generator.randint(45, 160)),
+                  'oxygen_sat': str(generator.randint(82, 100)),
+                  'respiratory_rate': str(generator.randint(8, 35)),
+                  'summary': 'Synthetic patient'}
+        patients.append((vitals, generator.uniform(*GHANA_LATITUDES), generator.uniform(*GHANA_LONGITUDES)))
+    return patients
+
+
+class EmptyStage(Exception):
+    pass
+
+
+#Calls operation(item) for the items in turn until the time is up (at least 3 calls) and returns
+#{'ops_per_sec', 'p50', 'p99', 'count'}, with latencies in milliseconds
+def measure(operation, items, seconds=STAGE_SECONDS):
+    if not items:
+        raise EmptyStage('there is nothing to measure it on (is a file in assets/ missing?)')
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    number = 0
+    while time.perf_counter() < deadline or len(latencies) < 3:
+        item = items[number % len(items)]
+        start = time.perf_counter()
+        operation(item)
+        latencies.append(time.perf_counter() - start)
+        number += 1
+    tail = percentiles(latencies)
+    return {'ops_per_sec': len(latencies) / sum(latencies),
+            'p50': tail['p50'] * 1000,
+            'p99': tail['p99'] * 1000,
+            'count': len(latencies)}
+
+
+#The linear scan the app used before the spatial index, kept as the reference
+def nearest_by_scan(hospitals, latitude, longitude):
+    nearest, smallest = None, float('inf')
+    for hospital in hospitals:
+        if hospital[3] > 0:
+            distance = haversine_distance(latitude, longitude, hospital[1], hospital[2])
+            if distance < smallest:
+                nearest, smallest = hospital, distance
+    return nearest
+
+
+def matching_stages(sizes, seconds):
+    positions = [(latitude, longitude) for vitals, latitude, longitude in synthetic_patients(1000)]
+    for size in sizes:
+        hospitals = synthetic_registry(size)
+        index = HospitalIndex(hospitals)
+        yield f'matching.scan/{size}', lambda: measure(lambda position: nearest_by_scan(hospitals, *position),
+                                                       positions, seconds)
+        yield f'matching.index/{size}', lambda: measure(lambda position: index.nearest(*position, k=5), positions, seconds)
+        tiles = CoverageTiles(index)
+        yield f'matching.tiles/{size}', lambda: measure(lambda position: tiles.nearest(*position, k=5), positions, seconds)
+        yield f'matching.icu/{size}', lambda: measure(lambda position: index.nearest(*position, k=5, required=ICU),
+                                                      positions, seconds)
+
+        registry = BedRegistry(hospitals)
+        registry.add_listener(index.set_available_beds)
+
+        def reserve(position):
+            match = registry.reserve_nearest(index, *position)
+            if match is not None:
+                registry.release(match[2])
+
+        yield f'matching.reserve/{size}', lambda: measure(reserve, positions, seconds)
+
+
+def geocoding_stages(directory, seconds):
+    generator = random.Random(2)
+    places = {f'place {number}': (generator.uniform(*GHANA_LATITUDES), generator.uniform(*GHANA_LONGITUDES))
+              for number in range(20000)}
+    names = [f'Place {number}' for number in range(len(places))]
+    cache_path = os.path.join(directory, 'geocode_cache.sqlite3')
+    with StandInNominatim(places) as nominatim:
+        # Every name is new: gazetteer miss, then the (stand-in) network, then written to the cache
+        resolver = GeocodingResolver(cache_path, geocoder=nominatim.geocoder())
+        yield 'geocoding.network', lambda: measure(resolver.resolve, names, seconds)
+        looked_up = names[:1000]
+        for name in looked_up:
+            resolver.resolve(name)  # Already remembered when the network stage ran
+        yield 'geocoding.memory', lambda: measure(resolver.resolve, looked_up, seconds)
+        # A fresh resolver has an empty memory, so it finds the names in the SQLite cache
+        resolver = GeocodingResolver(cache_path, geocoder=nominatim.geocoder(), memory_cache_size=1)
+        yield 'geocoding.disk', lambda: measure(resolver.resolve, looked_up, seconds)
+        resolver = GeocodingResolver(None, geocoder=nominatim.geocoder(), memory_cache_size=1)
+        towns = list(resolver.gazetteer)
+        yield 'geocoding.gazetteer', lambda: measure(resolver.resolve, towns, seconds)
+        # Misspelled towns go through the fuzzy gazetteer lookup
+        yield 'geocoding.gazetteer_fuzzy', lambda: measure(resolver.resolve, [town[:-1] + 'x' for town in towns], seconds)
+
+
+def submission_stages(seconds):
+    vitals = [patient[0] for patient in synthetic_patients(100)]
+    with StandInFormServer() as server:
+        link = server.form_link()
+        submitter = HttpFormSubmitter()
+        submitter.submit(link, vitals[0])  # Looks up the field mapping once, as the app does
+        yield 'submission.http', lambda: measure(lambda patient: submitter.submit(link, patient), vitals, seconds)
+        submitter.close()
+
+
+def record_stages(directory, seconds, records=RECORDS):
+    store = RecordStore(os.path.join(directory, 'patient_records.sqlite3'))
+    patients = synthetic_patients(records)
+    store.save_many([(vitals, 'Facility 1', 'Synthetic') for vitals, latitude, longitude in patients])
+    names = [vitals['patient_name'] for vitals, latitude, longitude in patients[:5000]]
+    yield 'records.save', lambda: measure(lambda vitals: store.save_encounter(vitals, 'Facility 1', 'Synthetic'),
+                                  [patient[0] for patient in patients[:5000]], seconds)
+    yield 'records.latest', lambda: measure(store.latest, names, seconds)
+    yield 'records.history', lambda: measure(store.history, names, seconds)
+    store.close()
+
+    # A month of a busy hospital, exported to Word documents and a CSV table
+    store = RecordStore(os.path.join(directory, 'export_records.sqlite3'))
+    store.save_many([(vitals, 'Facility 1', 'Synthetic') for vitals, latitude, longitude in patients[:EXPORTED]])
+    output = os.path.join(directory, 'export')
+    yield f'records.export/{EXPORTED}', lambda: measure(lambda number: export_encounters(store, output), range(3), seconds)
+    store.close()
+
+
+def search_stages(seconds, names=PATIENT_NAMES):
+    generator = random.Random(3)
+    full_names = [f"{generator.choice(FIRST_NAMES)} {generator.choice(SURNAMES)} {generator.choice(SURNAMES)}"
+                  for number in range(names)]
+    start = time.perf_counter()
+    index = PatientSearchIndex(full_names)
+    build = time.perf_counter() - start
+    yield 'search.build', lambda: {'ops_per_sec': 1 / build, 'p50': build * 1000, 'p99': build * 1000, 'count': 1}
+    typed = []
+    for name in full_names[:500]:
+        first, surname = name.split(' ')[:2]
+        typed += [first[:3], f'{first} {surname[:4]}', f'{first[:-1]} {surname}']  # unfinished, then misspelled
+    yield 'search.suggest', lambda: measure(index.search, typed, seconds)
+
+
+def registry_stages(directory, sizes, seconds):
+    size = max(sizes)
+    path = os.path.join(directory, 'hospitals.snapshot')
+    write_snapshot(facilities_from_list(synthetic_registry(size)), path)
+    yield f'registry.load/{size}', lambda: measure(lambda number: HospitalRegistry(path), range(100), seconds)
+    registry = HospitalRegistry(path)
+    rows = random.Random(4).sample(range(size), min(size, 1000))
+    yield f'registry.row/{size}', lambda: measure(registry.__getitem__, rows, seconds)
+
+
+def run(quick=False, prefixes=()):
+    seconds = QUICK_STAGE_SECONDS if quick else STAGE_SECONDS
+    sizes = QUICK_REGISTRY_SIZES if quick else REGISTRY_SIZES
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        groups = {
+            'matching': lambda: matching_stages(sizes, seconds),
+            'geocoding': lambda: geocoding_stages(directory, seconds),
+            'submission': lambda: submission_stages(seconds),
+            'records': lambda: record_stages(directory, seconds),
+            'search': lambda: search_stages(seconds),
+            'registry': lambda: registry_stages(directory, sizes, seconds),
+        }
+        for group, stages in groups.items():
+            if prefixes and not any(group.startswith(prefix) or prefix.startswith(group) for prefix in prefixes):
+                continue
+            # Each stage is a name and a function that measures it, so stages that were not asked for cost nothing
+            for name, stage in stages():
+                if prefixes and not any(name.startswith(prefix) for prefix in prefixes):
+                    continue
+                try:
+                    results[name] = result = stage()
+                except EmptyStage as error:
+                    sys.exit(f'Stage {name}: {error}')
+                print(f"{name:28} {result['ops_per_sec']:12.1f} ops/s  p50 {result['p50']:9.3f} ms  "
+                      f"p99 {result['p99']:9.3f} ms", flush=True)
+    return results
+
+
+#Returns the stages that got slower than the baseline by more than the threshold, as text
+def regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    slower = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+            slower.append(f"{name}: {result['ops_per_sec']:.1f} ops/s, was {before['ops_per_sec']:.1f}")
+        elif result['p50'] > before['p50'] * (1 + threshold):
+            slower.append(f"{name}: p50 {result['p50']:.3f} ms, was {before['p50']:.3f} ms")
+    return slower
+
+
+def load_baseline(path=BASELINE_PATH):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+#Saves the results, keeping the baseline of stages that were not run this time
+def save_baseline(results, path=BASELINE_PATH):
+    baseline = load_baseline(path) or {}
+    baseline.update(results)
+    with open(path, 'w') as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    save = 'save' in arguments
+    quick = 'quick' in arguments
+    prefixes = [argument for argument in arguments if argument not in ('save', 'quick')]
+    results = run(quick, prefixes)
+    if save:
+        save_baseline(results)
+        print(f'Baseline saved to {BASELINE_PATH}')
+        sys.exit(0)
+    baseline = load_baseline()
+    if baseline is None:
+        print('No baseline yet; run "python benchmarks.py save" to make one')
+        sys.exit(0)
+    slower = regressions(results, baseline)
+    for line in slower:
+        print(f'REGRESSION {line}')
+    print(f'{len(slower)} of {len(results)} stages slower than the baseline by more than {REGRESSION_THRESHOLD:.0%}')
+    sys.exit(1 if slower else 0)
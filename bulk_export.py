@@ -0,0 +1,273 @@
+# Bulk export of patient records for hospitals and auditors.
+# A report used to be made one patient at a time: export_docx builds a python-docx Document paragraph by
+# paragraph, which is fine for one patient's history but takes minutes for an end-of-shift or monthly
+# export of thousands of encounters. This module streams the encounters out of the record store
+# (records.py) one batch at a time and writes:
+#   - Word documents of up to PER_FILE encounters each, in the same layout as export_docx. python-docx
+#     only builds one small report, once (the template); every document after that is the template's
+#     parts with a new body, made by filling the template's title and line paragraphs with the text of
+#     each encounter. The documents are written by a pool of processes.
+#   - one table of every encounter for analytics, encounters.csv, or encounters.parquet when pyarrow
+#     is installed.
+# Only a few batches are in memory at any time, however many encounters there are.
+# Run with: python bulk_export.py <directory> [since] [until] [--hospital=NAME] [--format=parquet]
+#           [--workers=N] [--records=PATH]
+# since and until are dates (2026-10-01, "2026-10-01 07:00") or ages (12h, 30d, "30d ago").
+
+import concurrent.futures
+import csv
+import importlib.util
+import io
+import multiprocessing
+import os
+import re
+import sys
+import time
+import zipfile
+from xml.sax.saxutils import escape
+
+from instrumentation import count, span
+from records import encounter_lines, ENCOUNTER_COLUMNS, RecordStore, RECORDS_PATH, VITALS_COLUMNS
+
+PER_FILE = 1000  # Encounters per Word document
+TABLE_FORMATS = ['csv', 'parquet']
+TITLE_MARK = 'VITALS-EXPORT-TITLE'
+LINE_MARK = 'VITALS-EXPORT-LINE'
+INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')  # Characters a .docx cannot hold
+AGE = re.compile(r'^(\d+(?:\.\d+)?)\s*([hd])(?:\s+ago)?$')
+TIME_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+
+
+#Turns "2026-10-01", "2026-10-01 07:00" (local time) or "12h", "30d", "30d ago" (that long ago) into a
+#timestamp.
+#None and "" stay None.
+def parse_time(text, now=None):
+    if text is None or text == '':
+        return None
+    if isinstance(text, (int, float)) and not isinstance(text, bool):
+        return float(text)
+    text = str(text).strip()
+    age = AGE.match(text)
+    if age:
+        return (now or time.time()) - float(age.group(1)) * (3600 if age.group(2) == 'h' else 86400)
+    for time_format in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(text, time_format))
+        except ValueError:
+            pass
+    raise ValueError(f'{text!r} is not a date (2026-10-01, 2026-10-01 07:00) or an age (12h, 30d)')
+
+
+#Raises ValueError if the table cannot be written in that format here
+def check_table_format(table_format):
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(f"the table format must be one of {', '.join(TABLE_FORMATS)}")
+    if table_format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise ValueError('Parquet export needs pyarrow (pip install pyarrow); use csv instead')
+
+
+#Text as the inside of a <w:t> element. Line breaks and tabs become what python-docx would make of them.
+def xml_text(text):
+    text = escape(INVALID_XML.sub('', str(text))).replace('\r\n', '\n').replace('\r', '\n')
+    return (text.replace('\n', '</w:t><w:br/><w:t xml:space="preserve">')
+                .replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">'))
+
+
+class DocxTemplate:
+    #The parts of a report made once by python-docx, with the XML of a title paragraph and of a line
+    #paragraph cut out of its body so that they can be filled in for every encounter
+    def __init__(self):
+        from docx import Document
+
+        doc = Document()
+        doc.add_heading(TITLE_MARK, level=1)
+        doc.add_paragraph(LINE_MARK)
+        package_bytes = io.BytesIO()
+        doc.save(package_bytes)
+        with zipfile.ZipFile(package_bytes) as package:
+            self.parts = [(info.filename, package.read(info.filename)) for info in package.infolist()]
+
+        document = dict(self.parts)['word/document.xml'].decode('utf-8')
+        body = document.index('<w:body>') + len('<w:body>')
+        title_end = document.index('</w:p>', body) + len('</w:p>')
+        line_end = document.index('</w:p>', title_end) + len('</w:p>')
+        self.head, self.tail = document[:body], document[line_end:]
+        self.title = self._fill(document[body:title_end], TITLE_MARK)
+        self.line = self._fill(document[title_end:line_end], LINE_MARK)
+
+    @staticmethod
+    def _fill(paragraph, mark):
+        before, after = paragraph.split(f'<w:t>{mark}</w:t>')
+        return before + '<w:t xml:space="preserve">', '</w:t>' + after
+
+    def document_xml(self, encounters):
+        pieces = [self.head]
+        for encounter in encounters:
+            title, lines = encounter_lines(encounter)
+            pieces += [self.title[0], xml_text(title), self.title[1]]
+            for line in lines:
+                pieces += [self.line[0], xml_text(line), self.line[1]]
+        pieces.append(self.tail)
+        return ''.join(pieces)
+
+    #Writes the encounters to a .docx file. The file only appears once it is complete.
+    def write(self, encounters, path):
+        partial = path + '.part'
+        with zipfile.ZipFile(partial, 'w', zipfile.ZIP_DEFLATED) as package:
+            for name, data in self.parts:
+                if name == 'word/document.xml':
+                    data = self.document_xml(encounters).encode('utf-8')
+                package.writestr(name, data)
+        os.replace(partial, path)
+        return path
+
+
+#Each process of the pool gets the template once, when it starts
+worker_template = None
+
+
+def start_worker(template):
+    global worker_template
+    worker_template = template
+
+
+def write_document(encounters, path):
+    worker_template.write(encounters, path)
+    return path, len(encounters)
+
+
+#Time as text for the table, in UTC
+def iso_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+class CsvTable:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(ENCOUNTER_COLUMNS)
+
+    def write(self, encounters):
+        self.writer.writerows([encounter[column] if column != 'recorded_at' else iso_time(encounter[column])
+                               for column in ENCOUNTER_COLUMNS] for encounter in encounters)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetTable:
+    #One row group per batch, so the whole table is never in memory
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.path = path
+        self.schema = pyarrow.schema(
+            [('id', pyarrow.int64()), ('patient_id', pyarrow.string()), ('patient_name', pyarrow.string()),
+             ('recorded_at', pyarrow.timestamp('ms', tz='UTC'))]
+            + [(column, pyarrow.string()) for column in VITALS_COLUMNS + ['hospital', 'location']])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, encounters):
+        arrays = []
+        for field in self.schema:
+            if field.name == 'recorded_at':
+                values = [round(encounter['recorded_at'] * 1000) for encounter in encounters]
+            else:
+                values = [encounter[field.name] for encounter in encounters]
+            arrays.append(self.pyarrow.array(values, type=field.type))
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+#Exports every encounter recorded from since (included) to until (excluded, now if None), optionally only
+#those sent to one hospital, into directory: encounters-0001.docx, encounters-0002.docx, ... and
+#encounters.csv (or .parquet). progress(encounters written, total) is called after every document.
+#Returns what was written.
+def export_encounters(store, directory, since=None, until=None, hospital=None, table_format='csv',
+                      per_file=PER_FILE, workers=None, progress=None):
+    check_table_format(table_format)
+    if until is None:
+        until = time.time()  # Encounters recorded during the export are left for the next one
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+
+    total = store.count_between(since, until, hospital)
+    report = {'directory': directory, 'total': total, 'encounters': 0, 'files': [],
+              'table': os.path.join(directory, f'encounters.{table_format}')}
+    template = DocxTemplate()
+    table = (ParquetTable if table_format == 'parquet' else CsvTable)(report['table'])
+
+    # A pool only pays for the time it takes to start when there are several documents to write
+    pool = None
+    pool_size = min(workers, -(-total // per_file))  # No more processes than documents
+    if pool_size > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            pool_size, mp_context=multiprocessing.get_context('spawn'),
+            initializer=start_worker, initargs=(template,))
+
+    def written(path, encounters):
+        report['files'].append(path)
+        report['encounters'] += encounters
+        if progress is not None:
+            progress(report['encounters'], total)
+
+    pending = set()
+    try:
+        with span('export.bulk'):
+            batches = store.iter_encounters(since, until, hospital, per_file)
+            for number, batch in enumerate(batches, 1):
+                table.write(batch)
+                path = os.path.join(directory, f'encounters-{number:04d}.docx')
+                if pool is None:
+                    written(template.write(batch, path), len(batch))
+                    continue
+                pending.add(pool.submit(write_document, batch, path))
+                if len(pending) >= 2 * pool_size:
+                    # Reading stops until a document is written, so batches do not pile up in memory
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        written(*future.result())
+            for future in concurrent.futures.as_completed(pending):
+                written(*future.result())
+    finally:
+        table.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    report['files'].sort()
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    count('export.encounters', report['encounters'])
+    return report
+
+
+if __name__ == '__main__':
+    options = dict(argument[2:].split('=', 1) for argument in sys.argv[1:]
+                   if argument.startswith('--') and '=' in argument)
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    if not arguments:
+        print('usage: python bulk_export.py <directory> [since] [until] [--hospital=NAME] '
+              '[--format=csv|parquet] [--workers=N] [--records=PATH]')
+        sys.exit(1)
+
+    def show(done, total):
+        print(f'\r{done}/{total} encounters', end='', file=sys.stderr, flush=True)
+
+    store = RecordStore(options.get('records', RECORDS_PATH))
+    try:
+        report = export_encounters(store, arguments[0],
+                                   parse_time(arguments[1]) if len(arguments) > 1 else None,
+                                   parse_time(arguments[2]) if len(arguments) > 2 else None,
+                                   options.get('hospital'), options.get('format', 'csv'),
+                                   workers=int(options['workers']) if 'workers' in options else None,
+                                   progress=show)
+    finally:
+        store.close()
+    print(file=sys.stderr)
+    print(f"Exported {report['encounters']} encounters to {len(report['files'])} documents "
+          f"and {report['table']} in {report['seconds']:.1f} s")
@@ -0,0 +1,288 @@
+# Coverage tiles for hospital matching.
+# Most dispatches come from the same few thousand places, and the hospitals near a place barely change
+# between dispatches. Ghana is divided into a grid of tiles (about 2.2 km across). The first query
+# in a tile finds the TILE_CANDIDATES nearest hospitals with free beds to the tile's centre and keeps
+# them; later queries in the tile only measure the distance to those few hospitals.
+# The answer is exact, not an approximation: a hospital that is not kept is at least as far from the
+# tile centre as the last kept one, so from the patient it is at least that distance minus the distance
+# from the patient to the centre. If the kept hospitals that still have a free bed are closer than that,
+# no other hospital can be. If they are not, the query goes to the k-d tree, like a tile nobody asked for yet.
+# Tiles are recomputed only when needed:
+# - a kept hospital runs out of beds: the tiles that kept it are recomputed on their next query
+# - a hospital gets a free bed again: only tiles whose last kept hospital is further away than it are
+# - the hospital list is reloaded: tiles that kept a hospital that is gone, or that a new hospital
+#   could be nearer to, are recomputed
+# A query for hospitals with particular services (an ICU, oxygen) ranks only the kept hospitals that
+# have them; the same bound decides whether that answer is final.
+# The tiles are saved to an .npz file on close and loaded at start.
+# Run with: python coverage_tiles.py bench [facilities] [queries]
+
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+from math import asin, cos, inf, radians, sin, sqrt
+
+import numpy as np
+
+from matching import EARTH_RADIUS_KM, haversine_distance
+
+COVERAGE_TILES_PATH = 'coverage_tiles.npz'
+TILE_DEGREES = 0.02
+TILE_CANDIDATES = 16
+#The grid covers Ghana: south, north, west, east in degrees
+GHANA_BOUNDS = (4.5, 11.25, -3.3, 1.25)
+
+
+#Distances in km from one place to many places, for arrays of both (same as haversine_many, elementwise)
+def haversine_pairs(lats1, lons1, lats2, lons2):
+    lats1, lons1, lats2, lons2 = (np.radians(np.asarray(values, dtype=np.float64))
+                                  for values in (lats1, lons1, lats2, lons2))
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class CoverageTiles:
+    #index is the HospitalIndex (its available_beds are kept up to date by the bed registry)
+    def __init__(self, index, bounds=GHANA_BOUNDS, tile_degrees=TILE_DEGREES, candidates=TILE_CANDIDATES):
+        self.index = index
+        self.bounds = bounds
+        self.tile_degrees = tile_degrees
+        self.k = candidates
+        south, north, west, east = bounds
+        self.rows = int(np.ceil((north - south) / tile_degrees))
+        self.columns = int(np.ceil((east - west) / tile_degrees))
+        tiles = self.rows * self.columns
+        row, column = np.divmod(np.arange(tiles), self.columns)
+        self.centre_latitudes = south + (row + 0.5) * tile_degrees
+        self.centre_longitudes = west + (column + 0.5) * tile_degrees
+
+        # Candidates of every tile, nearest first, -1 padded, and the distance from the centre to the last one
+        # (infinite when there were fewer hospitals with beds than candidates). kth is NaN for a tile not computed.
+        self.candidates = np.full((tiles, candidates), -1, dtype=np.int32)
+        self.kth = np.full(tiles, np.nan)
+        self.available = np.asarray(index.available_beds) > 0  # what the tiles were computed with
+        self.kept = {}  # tile -> [(hospital, capabilities, x, y, z)] of its candidates as plain Python, for the re-check
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'fallbacks': 0, 'bypassed': 0, 'outside': 0,
+                      'invalidated': 0, 'computed': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    #The tile of a place, or None outside the grid
+    def tile(self, latitude, longitude):
+        south, north, west, east = self.bounds
+        row = int((latitude - south) // self.tile_degrees)
+        column = int((longitude - west) // self.tile_degrees)
+        if not (0 <= row < self.rows and 0 <= column < self.columns):
+            return None
+        return row * self.columns + column
+
+    def _compute(self, tile):
+        found = self.index.nearest(self.centre_latitudes[tile], self.centre_longitudes[tile], k=self.k, min_beds=1)
+        self.candidates[tile] = -1
+        self.candidates[tile, :len(found)] = [index for index, distance in found]
+        self.kth[tile] = found[-1][1] if len(found) == self.k else np.inf
+        self.kept.pop(tile, None)
+        self.stats['computed'] += 1
+
+    #Computes every tile, for example before saving the tiles for devices
+    def precompute(self):
+        with self.lock:
+            for tile in range(len(self.kth)):
+                if np.isnan(self.kth[tile]):
+                    self._compute(tile)
+
+    def _invalidate(self, tiles):
+        tiles = tiles & ~np.isnan(self.kth)
+        self.kth[tiles] = np.nan
+        self.stats['invalidated'] += int(tiles.sum())
+
+    #Invalidates the tiles a hospital at this place could now be among the candidates of
+    def _invalidate_near(self, latitude, longitude):
+        computed = ~np.isnan(self.kth)
+        distances = haversine_pairs(latitude, longitude, self.centre_latitudes[computed], self.centre_longitudes[computed])
+        tiles = np.zeros(len(self.kth), dtype=bool)
+        tiles[np.flatnonzero(computed)[distances < self.kth[computed]]] = True
+        self._invalidate(tiles)
+
+    #Bed registry listener: a hospital's free beds changed
+    def set_available_beds(self, hospital_index, beds):
+        with self.lock:
+            available = beds > 0
+            if available == self.available[hospital_index]:
+                return
+            self.available[hospital_index] = available
+            if available:
+                self._invalidate_near(self.index.latitudes[hospital_index], self.index.longitudes[hospital_index])
+            else:
+                self._invalidate(np.any(self.candidates == hospital_index, axis=1))
+
+    #Same as HospitalIndex.nearest: up to k (hospital index, distance in km) pairs, nearest first, for
+    #hospitals with at least min_beds free beds and every service in the required bitmask
+    def nearest(self, latitude, longitude, k=1, min_beds=1, required=0):
+        if k > self.k or min_beds != 1:
+            self._count('bypassed')
+            return self.index.nearest(latitude, longitude, k=k, min_beds=min_beds, required=required)
+        tile = self.tile(latitude, longitude)
+        if tile is None:
+            self._count('outside')
+            return self.index.nearest(latitude, longitude, k=k, min_beds=min_beds, required=required)
+
+        with self.lock:
+            missed = np.isnan(self.kth[tile])
+            if missed:
+                self._compute(tile)
+            kth = self.kth[tile]
+            kept = self.kept.get(tile)
+            if kept is None:
+                candidates = self.candidates[tile]
+                candidates = candidates[candidates >= 0]
+                kept = self.kept[tile] = [(index, capabilities, *point) for index, capabilities, point in
+                                          zip(candidates.tolist(), self.index.capabilities[candidates].tolist(),
+                                              self.index.points[candidates].tolist())]
+        # A handful of candidates: plain Python is faster than NumPy here. Squared chords between unit
+        # vectors rank the same as great-circle distances.
+        lat, lon = radians(latitude), radians(longitude)
+        qx, qy, qz = cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+        beds = self.index.available_beds
+        ranked = sorted(((x - qx) ** 2 + (y - qy) ** 2 + (z - qz) ** 2, index)
+                        for index, capabilities, x, y, z in kept
+                        if beds[index] >= min_beds and capabilities & required == required)[:k]
+        found = [(index, 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(chord) / 2))) for chord, index in ranked]
+        # No hospital that was not kept can be closer than this
+        bound = kth - haversine_distance(latitude, longitude, self.centre_latitudes[tile], self.centre_longitudes[tile])
+        if kth == inf or (len(found) == k and found[-1][1] <= bound):
+            self._count('misses' if missed else 'hits')
+            return found
+        self._count('fallbacks')
+        return self.index.nearest(latitude, longitude, k=k, min_beds=min_beds, required=required)
+
+    def tile_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['tiles_computed'] = int((~np.isnan(self.kth)).sum())
+        queries = stats['hits'] + stats['misses'] + stats['fallbacks'] + stats['bypassed'] + stats['outside']
+        stats['hit_rate'] = round(stats['hits'] / queries, 4) if queries else None
+        return stats
+
+    #Identifies the hospital places and grid the tiles were computed for, so tiles of another list are never loaded
+    def fingerprint(self):
+        digest = hashlib.sha1()
+        digest.update(np.asarray(self.index.latitudes, dtype=np.float64).tobytes())
+        digest.update(np.asarray(self.index.longitudes, dtype=np.float64).tobytes())
+        digest.update(repr((self.bounds, self.tile_degrees, self.k)).encode())
+        return digest.hexdigest()
+
+    #Writes the computed tiles to an .npz file: their numbers, candidates and last-candidate distances,
+    #and which hospitals had free beds when they were computed
+    def save(self, path=COVERAGE_TILES_PATH):
+        with self.lock:
+            tiles = np.flatnonzero(~np.isnan(self.kth))
+            arrays = {'fingerprint': np.array(self.fingerprint()), 'tiles': tiles.astype(np.int32),
+                      'candidates': self.candidates[tiles], 'kth': self.kth[tiles], 'available': self.available}
+        temporary = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(temporary, **arrays)
+        os.replace(temporary, path)
+        return len(tiles)
+
+    #Loads tiles saved for the same hospitals. Tiles that a hospital with free beds now (but not then)
+    #could belong to are dropped. Returns how many tiles were loaded.
+    def load(self, path=COVERAGE_TILES_PATH):
+        if not path or not os.path.exists(path):
+            return 0
+        with np.load(path) as saved:
+            if str(saved['fingerprint']) != self.fingerprint():
+                return 0
+            with self.lock:
+                self.kept.clear()
+                tiles = saved['tiles']
+                self.candidates[tiles] = saved['candidates']
+                self.kth[tiles] = saved['kth']
+                was_available = saved['available']
+                for hospital in np.flatnonzero(self.available & ~was_available):
+                    self._invalidate_near(self.index.latitudes[hospital], self.index.longitudes[hospital])
+                for hospital in np.flatnonzero(~self.available & was_available):
+                    self._invalidate(np.any(self.candidates == hospital, axis=1))
+                return int((~np.isnan(self.kth)).sum())
+
+    #Takes over the tiles of the previous hospital list after a reload. ids and previous_ids (facility ids)
+    #say which hospital is which. Tiles that kept a hospital that is gone or moved, and tiles a new hospital
+    #could be nearer to, are recomputed on their next query.
+    def adopt(self, previous, ids, previous_ids):
+        if (previous.bounds, previous.tile_degrees, previous.k) != (self.bounds, self.tile_degrees, self.k):
+            return
+        positions = {facility: position for position, facility in enumerate(ids)}
+        with previous.lock, self.lock:
+            # Old hospital number -> new number, -1 for a hospital that is gone or has moved
+            mapping = np.full(len(previous_ids) + 1, -1, dtype=np.int64)
+            for old, facility in enumerate(previous_ids):
+                new = positions.get(facility)
+                if (new is not None and previous.index.latitudes[old] == self.index.latitudes[new]
+                        and previous.index.longitudes[old] == self.index.longitudes[new]):
+                    mapping[old] = new
+            self.candidates[:] = mapping[previous.candidates]  # -1 stays -1 through the last entry
+            self.kth[:] = previous.kth
+            self._invalidate(np.any((self.candidates < 0) & (previous.candidates >= 0), axis=1))
+            # Hospitals that tiles have not seen with a free bed: new ones, moved ones, and ones that got beds
+            seen = np.zeros(len(ids), dtype=bool)
+            kept = mapping[:-1][previous.available] if len(previous_ids) else mapping[:0]
+            seen[kept[kept >= 0]] = True
+            for hospital in np.flatnonzero(self.available & ~seen):
+                self._invalidate_near(self.index.latitudes[hospital], self.index.longitudes[hospital])
+            for hospital in np.flatnonzero(~self.available & seen):
+                self._invalidate(np.any(self.candidates == hospital, axis=1))
+
+
+#Compares the tiles with the k-d tree on a synthetic registry, with patients from a few thousand places
+def bench(size=10000, queries=20000, places=3000):
+    from benchmarks import synthetic_registry
+    from matching import HospitalIndex
+
+    hospitals = synthetic_registry(size)
+    index = HospitalIndex(hospitals)
+    tiles = CoverageTiles(index)
+    generator = random.Random(5)
+    south, north, west, east = GHANA_BOUNDS
+    towns = [(generator.uniform(south, north), generator.uniform(west, east)) for _ in range(places)]
+    patients = [(latitude + generator.gauss(0, 0.01), longitude + generator.gauss(0, 0.01))
+                for latitude, longitude in (generator.choice(towns) for _ in range(queries))]
+
+    start = time.perf_counter()
+    expected = [index.nearest(latitude, longitude, k=5) for latitude, longitude in patients]
+    tree = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [tiles.nearest(latitude, longitude, k=5) for latitude, longitude in patients]
+    tiled = time.perf_counter() - start
+    assert [[index for index, distance in answer] for answer in found] == \
+           [[index for index, distance in answer] for answer in expected]
+    start = time.perf_counter()
+    again = [tiles.nearest(latitude, longitude, k=5) for latitude, longitude in patients]
+    warm = time.perf_counter() - start
+    assert again == found
+
+    print(f'{size} facilities, {queries} queries from {places} places, 5 nearest with a free bed')
+    print(f'  k-d tree            {tree / queries * 1e6:8.1f} us per query')
+    print(f'  tiles, first pass   {tiled / queries * 1e6:8.1f} us per query')
+    print(f'  tiles, warm         {warm / queries * 1e6:8.1f} us per query')
+    print(f'  {tiles.tile_stats()}')
+
+    # A full hospital, and the same hospital with a bed again, each only touch the tiles around it
+    busiest = int(np.bincount(tiles.candidates[tiles.candidates >= 0]).argmax())
+    before = tiles.stats['invalidated']
+    start = time.perf_counter()
+    tiles.set_available_beds(busiest, 0)
+    tiles.set_available_beds(busiest, 3)
+    print(f'  a hospital filling up and freeing a bed invalidated {tiles.stats["invalidated"] - before} '
+          f'of {tiles.tile_stats()["tiles_computed"]} tiles in {(time.perf_counter() - start) * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 10000, int(sys.argv[3]) if len(sys.argv) > 3 else 20000)
+    else:
+        print('Usage: python coverage_tiles.py bench [facilities] [queries]')
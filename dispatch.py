@@ -0,0 +1,485 @@
+# The dispatch core of the Vital Signs app, without any user interface.
+# Intake -> geocode -> match -> submit -> record used to live inside the Kivy screens, so nothing else
+# could drive it. DispatchCore holds everything a dispatch needs (hospital index, bed registry, router,
+# geocoder, record store, outbox) and exposes each stage as a plain method. The Kivy app calls these
+# methods from its background worker, and service.py serves the same methods over HTTP.
+# Every method is safe to call from many threads at once.
+
+import os
+import threading
+import time
+import uuid
+
+from assignment import assign_patients, DEFAULT_PRIORITY
+from bed_registry import BedRegistry, RegistryRetired
+from coverage_tiles import CoverageTiles, COVERAGE_TILES_PATH
+from geocoding import GeocodingResolver
+from hospital_registry import capability_names, facility_id, HospitalRegistry, HOSPITALS_SNAPSHOT_PATH
+from instrumentation import annotate, count, span, start_file_export, trace
+from matching import haversine_distance, HospitalIndex
+from outbox import Outbox, OUTBOX_PATH
+from patient_search import PatientSearchIndex
+from records import RecordStore, RECORDS_PATH
+from routing import Router, ROUTING_GRAPH_PATH, rank_by_travel_time
+from submission import FormSubmitter, VITALS_FIELDS
+from vitals_stream import required_capabilities, VitalsStreams, score_vitals
+
+#These are HeFRA (Health Facilities Regulatory Agency) certified hospitals. Below are hospitals I am using to test-run the app.
+#the input data is in a 2D list in the format ("name", lat, long, available beds, "Google form link", field mapping, services). These are HeFRA cerified hospitals.
+#The field mapping says which entry.<id> of the form each vital goes into. Leave it empty and it is read from the form the first time.
+#The services are names from hospital_registry.CAPABILITIES; leave them out and the hospital is considered for every patient.
+TEACHING_HOSPITAL = ['emergency', 'oxygen', 'icu', 'surgery', 'trauma', 'pediatrics', 'maternity', 'laboratory', 'blood_bank']
+hospitals = [
+    ["Korle Bu Teaching Hospital", 5.5381, -0.2272, 2, "Google Form Link 1", {}, TEACHING_HOSPITAL + ['dialysis', 'ct_scan']],
+    ["Komfo Anokye Teaching Hospital", 6.698, -1.629, 2, "Google Form Link 2", {}, TEACHING_HOSPITAL + ['dialysis', 'ct_scan']],
+    ["Tamale Teaching Hospital", 9.393, -0.824, 15, "Google Form Link 3", {}, TEACHING_HOSPITAL],
+    # More hospitals here if needed
+]
+
+BED_FEED_PATH = 'bed_feed.csv'
+EXPORTS_PATH = 'exports'  # Bulk exports go into a folder each under here
+REGISTRY_POLL_INTERVAL = 2.0  # Seconds between checks for a new hospital snapshot
+ROUTING_CANDIDATES = 10  # Nearest hospitals in a straight line that are compared by driving time
+DELIVERY_TIMEOUT = 5.0  # Seconds a dispatch waits to hear that the hospital got the vitals
+
+
+#The hospitals: the compiled HeFRA snapshot (see hospital_registry.py) if there is one, otherwise the list above
+def load_hospitals(snapshot_path=HOSPITALS_SNAPSHOT_PATH):
+    if snapshot_path and os.path.exists(snapshot_path):
+        return HospitalRegistry(snapshot_path)
+    return hospitals
+
+
+#The Google Maps directions from the patient to the hospital
+def directions_url(latitude, longitude, hospital_name):
+    return f"https://www.google.com/maps/dir/{latitude},{longitude}/{hospital_name} Hospital"
+
+
+class DispatchCore:
+    def __init__(self, hospitals=None, records_path=RECORDS_PATH, outbox_path=OUTBOX_PATH,
+                 routing_path=ROUTING_GRAPH_PATH, geocoder=None, submitter=None,
+                 snapshot_path=HOSPITALS_SNAPSHOT_PATH, tiles_path=COVERAGE_TILES_PATH, exports_path=EXPORTS_PATH):
+        self.snapshot_path = snapshot_path
+        self.tiles_path = tiles_path
+        self.facilities = self._facilities(load_hospitals(snapshot_path) if hospitals is None else hospitals)
+        self.coverage.load(tiles_path)
+        self.facilities_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.registry_thread = None
+
+        #Driving times over the road network, if the offline graph has been built (see routing.py).
+        #Without it, hospitals are ranked by straight-line distance.
+        self.router = Router(routing_path) if routing_path and os.path.exists(routing_path) else None
+
+        #It remembers places it has seen and knows the common Ghanaian towns offline.
+        self.geocoder = geocoder or GeocodingResolver()
+
+        #Every encounter is kept here, indexed by patient, and every patient name is searchable
+        self.record_store = RecordStore(records_path)
+        self.patient_index = None  # Built on start() or build_patient_index(), or on first use
+        self.patient_index_lock = threading.Lock()
+
+        #Submissions are stored in the outbox until the hospital has accepted them
+        self.submitter = submitter or FormSubmitter()
+        self.outbox = Outbox(self.submitter, outbox_path)
+
+        #Monitor readings from ambulances, with rolling early-warning scores. The buffers are allocated
+        #on the first reading, so the app does not pay for them unless monitors are connected.
+        self.vitals_streams = None
+        self.vitals_streams_lock = threading.Lock()
+        self.metrics_exporter = None
+
+        #Bulk exports (see bulk_export.py), each in its own folder under exports_path. They run one at a
+        #time, on their own thread, and their progress is kept here.
+        self.exports_path = exports_path
+        self.exports = {}
+        self.exports_lock = threading.Lock()
+        self.export_running = threading.Lock()
+
+    #The hospitals, their spatial index, their live bed counts and the coverage tiles. They are kept
+    #together in one tuple, so a reload replaces them all at once and a dispatch never mixes an old index
+    #with new rows.
+    @staticmethod
+    def _facilities(hospitals):
+        #The hospitals are put into a spatial index once, so finding the nearest one does not need a loop over every row.
+        hospital_index = HospitalIndex(hospitals)
+
+        #Live bed counts. Matching reserves a bed here so two dispatches cannot be sent to the same last bed,
+        #and the index is told about every change.
+        bed_registry = BedRegistry(hospitals)
+        bed_registry.add_listener(hospital_index.set_available_beds)
+
+        #Nearest hospitals of each area, kept between dispatches and answered in place of the index
+        #(see coverage_tiles.py). Only the tiles a bed change can affect are recomputed.
+        coverage = CoverageTiles(hospital_index)
+        bed_registry.add_listener(coverage.set_available_beds)
+        return hospitals, hospital_index, bed_registry, coverage
+
+    @property
+    def hospitals(self):
+        return self.facilities[0]
+
+    @property
+    def hospital_index(self):
+        return self.facilities[1]
+
+    @property
+    def bed_registry(self):
+        return self.facilities[2]
+
+    @property
+    def coverage(self):
+        return self.facilities[3]
+
+    #Replaces the hospital list, for example with a new snapshot. Live bed counts and reservations of
+    #the hospitals that are still there carry over.
+    def reload_hospitals(self, hospitals=None):
+        with self.facilities_lock:
+            facilities = self._facilities(HospitalRegistry(self.snapshot_path) if hospitals is None else hospitals)
+            previous_hospitals, previous_index, previous, previous_coverage = self.facilities
+            with previous.lock:
+                facilities[2].adopt(previous)
+                facilities[3].adopt(previous_coverage, facilities[2].ids, previous.ids)
+                self.facilities = facilities
+            previous.stop()
+            if previous.feed_path:
+                facilities[2].watch_file(previous.feed_path)
+        count('registry.reloads')
+        return len(facilities[0])
+
+    #Reloads the hospitals whenever a new snapshot is put in place
+    def _watch_registry(self):
+        while not self.stopping.wait(REGISTRY_POLL_INTERVAL):
+            if isinstance(self.hospitals, HospitalRegistry) and self.hospitals.changed():
+                try:
+                    self.reload_hospitals()
+                except (OSError, ValueError) as error:
+                    print(f"Hospital snapshot {self.snapshot_path} could not be loaded: {error!r}")
+
+    #The monitor streams, created on first use
+    def _streams(self):
+        with self.vitals_streams_lock:
+            if self.vitals_streams is None:
+                self.vitals_streams = VitalsStreams()
+            return self.vitals_streams
+
+    #Starts the outbox flusher, builds the patient name index in the background (unless the caller builds
+    #it itself, see build_patient_index) and, if a feed path is given, starts the bed feed watcher. A hospital
+    #snapshot is watched for replacements.
+    def start(self, bed_feed_path=BED_FEED_PATH, index_patients=True):
+        self.outbox.start()
+        if index_patients:
+            threading.Thread(target=self._patients, name='patient-index', daemon=True).start()
+        if bed_feed_path:
+            self.bed_registry.watch_file(bed_feed_path)
+        if isinstance(self.hospitals, HospitalRegistry):
+            self.registry_thread = threading.Thread(target=self._watch_registry, name='hospital-registry', daemon=True)
+            self.registry_thread.start()
+        self.metrics_exporter = start_file_export()
+        return self
+
+    def close(self):
+        self.stopping.set()
+        if self.registry_thread is not None:
+            self.registry_thread.join()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+        self.bed_registry.stop()
+        if self.tiles_path:
+            self.coverage.save(self.tiles_path)
+        self.outbox.close()
+        self.submitter.close()
+        with self.export_running:  # An export still reading the records finishes first
+            self.record_store.close()
+
+    #Builds the patient name index from the record store, unless it is built already. With many records
+    #this takes a while, so the app runs it on its background worker.
+    def build_patient_index(self):
+        self._patients()
+
+    #The patient name index, built from the record store the first time it is needed
+    def _patients(self):
+        with self.patient_index_lock:
+            if self.patient_index is None:
+                self.patient_index = PatientSearchIndex(self.record_store.patient_names())
+            return self.patient_index
+
+    def get_coordinates(self, location_name):
+        with span('geocode'):
+            return self.geocoder.resolve(location_name)
+
+    #Geocodes the patient, finds the nearest hospital with a free bed and reserves that bed.
+    #required is a bitmask of services the hospital must offer (see required_capabilities); when no such
+    #hospital has a free bed, the nearest hospital with one is taken instead, since some care beats none.
+    #Returns None if the place is unknown, otherwise (lat, long, hospital, reservation id) where hospital may be None.
+    def match_patient(self, location_name, required=0):
+        current_latitude, current_longitude = self.get_coordinates(location_name)
+        if current_latitude is None and current_longitude is None:
+            return None
+        with span('match'):
+            while True:
+                hospitals, hospital_index, bed_registry, coverage = self.facilities
+                rank = None
+                if self.router is not None:
+                    # The straight-line index picks the candidates, the road network decides which is quickest to reach
+                    rank = lambda candidates: rank_by_travel_time(self.router, current_latitude, current_longitude,
+                                                                  candidates, hospitals)
+                k = ROUTING_CANDIDATES if self.router is not None else 5
+                try:
+                    match = bed_registry.reserve_nearest(coverage, current_latitude, current_longitude, k=k,
+                                                         rank=rank, required=required)
+                    if match is None and required:
+                        count('match.capabilities_relaxed')
+                        match = bed_registry.reserve_nearest(coverage, current_latitude, current_longitude, k=k,
+                                                             rank=rank)
+                    break
+                except RegistryRetired:
+                    count('match.registry_retired')  # The hospitals were reloaded meanwhile; match again on the new ones
+        if match is None:
+            return current_latitude, current_longitude, None, None
+        index, distance, reservation_id = match
+        return current_latitude, current_longitude, hospitals[index], reservation_id
+
+    #The k nearest hospitals with a free bed (and the required services), without reserving anything.
+    #Returns None if the place is unknown, otherwise (lat, long, [(hospital, distance in km, available beds)]).
+    def nearest_hospitals(self, location_name, k=3, required=0):
+        latitude, longitude = self.get_coordinates(location_name)
+        if latitude is None and longitude is None:
+            return None
+        hospitals, hospital_index, bed_registry, coverage = self.facilities
+        return latitude, longitude, [(hospitals[index], distance, bed_registry.available(index))
+                                     for index, distance in coverage.nearest(latitude, longitude, k=k, required=required)]
+
+    #Whether the hospital (a row of the hospital list, as match_patient returns it, or a facility id)
+    #offers every service in the bitmask
+    def offers(self, hospital, required):
+        hospitals, hospital_index, bed_registry, coverage = self.facilities
+        if not isinstance(hospital, str):
+            hospital = facility_id(hospital[0], hospital[1], hospital[2])
+        index = bed_registry.find(hospital)
+        return index is not None and int(hospital_index.capabilities[index]) & required == required
+
+    #A hospital reported how many beds it has free. hospital is its facility id, or its name when no other
+    #hospital has that name. sent_at is when it sent the report (time.time()).
+    def update_beds(self, hospital, available_beds, sent_at=None):
+        return self._on_current_registry(lambda bed_registry: bed_registry.apply_update(hospital, available_beds,
+                                                                                       sent_at))
+
+    #Calls operation(bed registry) on the registry in use, again if a reload retires it in the meantime.
+    #Reservations move to the new registry with the same ids, so confirming one there works.
+    def _on_current_registry(self, operation):
+        while True:
+            try:
+                return operation(self.bed_registry)
+            except RegistryRetired:
+                pass
+
+    #The patient was sent to the hospital: the reserved bed is now taken
+    def confirm(self, reservation_id):
+        return self._on_current_registry(lambda bed_registry: bed_registry.confirm(reservation_id))
+
+    #The dispatch did not go ahead: give the reserved bed back
+    def release(self, reservation_id):
+        return self._on_current_registry(lambda bed_registry: bed_registry.release(reservation_id))
+
+    #Puts the vitals in the outbox for the hospital's Google Form and returns the idempotency key.
+    #With a timeout, also returns whether the hospital got them in that time (the outbox keeps retrying either way).
+    def submit_vitals(self, hospital, vitals, timeout=DELIVERY_TIMEOUT):
+        google_form_link, field_mapping = hospital[4], hospital[5]
+        with span('submit'):
+            key = self.outbox.enqueue(google_form_link, vitals, field_mapping, track=timeout > 0)
+        if timeout <= 0:
+            return key, False
+        with span('submit.wait'):
+            return key, self.outbox.wait(key, timeout=timeout)
+
+    #Saves the encounter in the patient record store and returns its id
+    def save_vital_signs(self, vitals, hospital_name=None, location_name=None):
+        with span('record'):
+            encounter_id = self.record_store.save_encounter(vitals, hospital=hospital_name, location=location_name)
+            patient_index = self._patients()
+            with self.patient_index_lock:
+                patient_index.add(vitals.get('patient_name', ''))
+        return encounter_id
+
+    #A whole dispatch: match, submit, confirm the bed and save the record. Returns a dictionary whose
+    #'status' is 'dispatched', 'location_not_found' or 'no_free_bed'. Every dispatch is kept as a trace
+    #(see instrumentation.py).
+    def dispatch(self, vitals, location_name, delivery_timeout=DELIVERY_TIMEOUT):
+        with trace('dispatch', location=location_name):
+            result = self._dispatch(vitals, location_name, delivery_timeout)
+            annotate('status', result['status'])
+            annotate('hospital', result.get('hospital'))
+        count(f"dispatch.{result['status']}")
+        return result
+
+    def _dispatch(self, vitals, location_name, delivery_timeout):
+        required, reasons = required_capabilities(vitals)
+        match = self.match_patient(location_name, required)
+        if match is None:
+            return {'status': 'location_not_found', 'location': location_name}
+        latitude, longitude, hospital, reservation_id = match
+        if hospital is None:
+            return {'status': 'no_free_bed', 'location': location_name, 'latitude': latitude, 'longitude': longitude}
+        try:
+            key, delivered = self.submit_vitals(hospital, vitals, timeout=delivery_timeout)
+        except Exception:
+            self.release(reservation_id)
+            raise
+        self.confirm(reservation_id)
+        encounter_id = self.save_vital_signs(vitals, hospital[0], location_name)
+        news2, risk = score_vitals(vitals)
+        return {
+            'status': 'dispatched',
+            'location': location_name,
+            'latitude': latitude,
+            'longitude': longitude,
+            'hospital': hospital[0],
+            'hospital_id': facility_id(hospital[0], hospital[1], hospital[2]),
+            'distance_km': haversine_distance(latitude, longitude, hospital[1], hospital[2]),
+            'directions_url': directions_url(latitude, longitude, hospital[0]),
+            'submission_key': key,
+            'delivered': delivered,
+            'encounter_id': encounter_id,
+            'news2': news2,
+            'risk': risk,
+            'required_capabilities': capability_names(required),
+            'capability_reasons': reasons,
+            'capabilities_met': self.offers(hospital, required),
+        }
+
+    #Mass-casualty mode: assigns many patients at once so the nearest hospital is not overloaded.
+    #Each item is (location, priority) with priority 1 (immediate), 2 (urgent) or 3 (can wait).
+    #Returns one (location, hospital name or None, distance in km or None, reason) per patient.
+    def assign_mass_casualty(self, casualties):
+        patients, priorities, located = [], [], []
+        for location_name, priority in casualties:
+            latitude, longitude = self.get_coordinates(location_name)
+            located.append(latitude is not None)
+            if latitude is not None:
+                patients.append((latitude, longitude))
+                priorities.append(priority or DEFAULT_PRIORITY)
+
+        hospitals, hospital_index, bed_registry, coverage = self.facilities
+        beds = [bed_registry.available(index) for index in range(len(hospitals))]
+        assignments = iter(assign_patients(patients, hospital_index.latitudes, hospital_index.longitudes,
+                                           beds, priorities))
+        results = []
+        for (location_name, priority), found in zip(casualties, located):
+            if not found:
+                results.append((location_name, None, None, 'location not found'))
+                continue
+            index, distance = next(assignments)
+            # Take the bed for real; it may have gone to a single dispatch, or moved in a reload, in the meantime
+            facility = bed_registry.ids[index] if index is not None else None
+            name = bed_registry.names[index] if index is not None else None
+
+            def reserve(current):
+                position = current.find(facility) if facility is not None else None
+                return None if position is None else current.reserve(position)
+
+            reservation_id = self._on_current_registry(reserve)
+            if reservation_id is None:
+                results.append((location_name, None, None, 'no free bed'))
+            else:
+                self.confirm(reservation_id)
+                results.append((location_name, name, distance, None))
+        return results
+
+    #The patient's most recent encounter, or None
+    def recall(self, patient_name):
+        return self.record_store.latest(patient_name)
+
+    def history(self, patient_name, limit=100):
+        return self.record_store.history(patient_name, limit)
+
+    #Patient names matching what has been typed so far. With wait=False nothing is suggested until the
+    #index has been built, instead of building it in the caller's thread.
+    def suggest_patients(self, text, limit=8, wait=True):
+        if not wait and self.patient_index is None:
+            return []
+        patient_index = self._patients()
+        with self.patient_index_lock:
+            return patient_index.search(text, limit)
+
+    #Adds monitor readings (see vitals_stream.py) and returns how many were taken
+    def ingest_readings(self, readings):
+        return self._streams().ingest(readings)
+
+    #Rolling vitals and the early-warning score of a monitored patient, or None
+    def stream_summary(self, patient_id):
+        return self._streams().summary(patient_id)
+
+    #Monitored patients whose NEWS2 score is at least the threshold, highest first
+    def at_risk(self, threshold=5):
+        return self._streams().at_risk(threshold)
+
+    #Starts exporting the encounters recorded from since to until (timestamps, or None for no limit),
+    #optionally only those sent to one hospital, and returns the export's progress. export_progress()
+    #tells how far it has got.
+    def start_export(self, since=None, until=None, hospital=None, table_format='csv'):
+        from bulk_export import check_table_format  # Only loaded when an export is asked for
+
+        check_table_format(table_format)
+        export_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+        job = {'id': export_id, 'state': 'queued', 'encounters': 0, 'total': None, 'files': [],
+               'table': None, 'seconds': None, 'error': None}
+        with self.exports_lock:
+            self.exports[export_id] = job
+        until = time.time() if until is None else until  # What is recorded while it waits is not included
+        threading.Thread(target=self._export, args=(job, since, until, hospital, table_format),
+                         name=f'export-{export_id}', daemon=True).start()
+        return self.export_progress(export_id)
+
+    def _export(self, job, since, until, hospital, table_format):
+        from bulk_export import export_encounters
+
+        with self.export_running:
+            job['state'] = 'running'
+
+            def progress(encounters, total):
+                job['encounters'], job['total'] = encounters, total
+
+            try:
+                report = export_encounters(self.record_store, os.path.join(self.exports_path, job['id']),
+                                           since, until, hospital, table_format, progress=progress)
+            except Exception as error:  # The export is reported as failed instead of dying silently
+                job.update(state='failed', error=repr(error))
+                return
+            job.update(state='finished', encounters=report['encounters'], total=report['total'],
+                       files=[os.path.basename(path) for path in report['files']],
+                       table=os.path.basename(report['table']), seconds=report['seconds'])
+
+    #How far an export has got, or None if there is no such export
+    def export_progress(self, export_id):
+        with self.exports_lock:
+            job = self.exports.get(export_id)
+            return dict(job, files=list(job['files'])) if job is not None else None
+
+    #Counters of every part, for monitoring
+    def stats(self):
+        stats = {
+            'outbox': self.outbox.queue_stats(),
+            'beds': self.bed_registry.registry_stats(),
+            'tiles': self.coverage.tile_stats(),
+            'geocoding': dict(self.geocoder.stats),
+        }
+        if self.vitals_streams is not None:
+            stats['vitals_streams'] = dict(self.vitals_streams.stats, patients=len(self.vitals_streams))
+        return stats
+
+
+#Checks a vitals dictionary from outside (for example a JSON request). Returns (vitals, None) with only the
+#known fields, as text, or (None, error message).
+def clean_vitals(data):
+    if not isinstance(data, dict):
+        return None, 'vitals must be an object'
+    if not str(data.get('patient_name') or '').strip():
+        return None, 'patient_name is required'
+    vitals = {}
+    for field in VITALS_FIELDS:
+        value = data.get(field, '')
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            return None, f'{field} must be text or a number'
+        vitals[field] = str(value).strip()
+    return vitals, None
@@ -0,0 +1,221 @@
+# Geocoding for the Vital Signs app.
+# get_coordinates used to create a new Nominatim client and go to the network for every place name,
+# even for names we see all day ("Madina", "Kejetia", "Tamale Central"). The resolver below looks a
+# name up in layers, cheapest first:
+# 1. An in-memory LRU cache
+# 2. A SQLite cache on disk, with a time-to-live and a size limit
+# 3. A gazetteer of Ghanaian localities shipped in assets/ (exact and fuzzy name matching)
+# 4. Nominatim, through one shared client that respects its rate limit of one request per second
+# Only the last layer touches the network.
+
+import csv
+import difflib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from instrumentation import span
+
+#Next to this file rather than the current directory, so scripts run from anywhere find it
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'ghana_localities.csv')
+CACHE_PATH = 'geocode_cache.sqlite3'
+CACHE_TTL = 30 * 24 * 3600  # Places do not move, so found coordinates are kept for 30 days
+NOT_FOUND_TTL = 24 * 3600  # Names Nominatim could not find are retried after a day
+CACHE_MAX_ENTRIES = 50000
+LAST_USED_SLACK = 3600  # last_used is only rewritten when it is older than this, so most hits are pure reads
+MEMORY_CACHE_SIZE = 1024
+FUZZY_CUTOFF = 0.85
+
+
+#Turns a place name into a lookup key: lower case, no accents, no punctuation, single spaces.
+#"  Kejetia, " and "kejetia" get the same key.
+def normalize_place_name(name):
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(character for character in name if not unicodedata.combining(character))
+    name = re.sub(r'[^a-z0-9]+', ' ', name.lower())
+    return name.strip()
+
+
+#Loads the bundled gazetteer into a dictionary of {normalized name: (lat, long)}
+def load_gazetteer(path=GAZETTEER_PATH):
+    gazetteer = {}
+    try:
+        with open(path, newline='', encoding='utf-8') as file:
+            for row in csv.DictReader(file):
+                gazetteer[normalize_place_name(row['name'])] = (float(row['latitude']), float(row['longitude']))
+    except FileNotFoundError:
+        pass
+    return gazetteer
+
+
+#The shared Nominatim client. It is only created the first time a name misses every other layer.
+#Errors are raised rather than turned into None, so an outage is not mistaken for "no such place", and
+#they are not retried here: the resolver holds its lock around this call, and the next lookup retries anyway.
+def nominatim_geocoder(user_agent="my_app"):
+    from geopy.geocoders import Nominatim
+    from geopy.extra.rate_limiter import RateLimiter
+
+    geolocator = Nominatim(user_agent=user_agent)
+    return RateLimiter(geolocator.geocode, min_delay_seconds=1, max_retries=0, swallow_exceptions=False)
+
+
+class GeocodeCache:
+    #SQLite store of {key: (lat, long)} with a time-to-live. Rows that were not found are stored with
+    #NULL coordinates so the same unknown name does not go to the network again straight away.
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, not_found_ttl=NOT_FOUND_TTL, max_entries=CACHE_MAX_ENTRIES,
+                 last_used_slack=LAST_USED_SLACK):
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.max_entries = max_entries
+        self.last_used_slack = last_used_slack
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS geocode_cache ('
+            'key TEXT PRIMARY KEY, latitude REAL, longitude REAL, stored_at REAL, last_used REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS geocode_cache_last_used ON geocode_cache (last_used)')
+        self.connection.commit()
+
+    #Returns (found, (lat, long)) where found is False when the key is missing or expired.
+    #last_used only orders the rows for eviction, so it is kept to within last_used_slack seconds rather
+    #than turning every hit into a write.
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT latitude, longitude, stored_at, last_used FROM geocode_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return False, (None, None)
+            latitude, longitude, stored_at, last_used = row
+            ttl = self.ttl if latitude is not None else self.not_found_ttl
+            if now - stored_at > ttl:
+                self.connection.execute('DELETE FROM geocode_cache WHERE key = ?', (key,))
+                self.connection.commit()
+                return False, (None, None)
+            if now - last_used > self.last_used_slack:
+                self.connection.execute('UPDATE geocode_cache SET last_used = ? WHERE key = ?', (now, key))
+                self.connection.commit()
+            return True, (latitude, longitude)
+
+    def put(self, key, coordinates):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?, ?)',
+                (key, coordinates[0], coordinates[1], now, now),
+            )
+            # Evict the least recently used rows once the cache is over its size limit
+            count = self.connection.execute('SELECT COUNT(*) FROM geocode_cache').fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute(
+                    'DELETE FROM geocode_cache WHERE key IN '
+                    '(SELECT key FROM geocode_cache ORDER BY last_used LIMIT ?)',
+                    (count - self.max_entries,),
+                )
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class GeocodingResolver:
+    #geocoder is any callable that takes a place name and returns an object with .latitude and
+    #.longitude (or None). It defaults to the shared Nominatim client; tests can pass a local stand-in.
+    def __init__(self, cache_path=CACHE_PATH, gazetteer_path=GAZETTEER_PATH, geocoder=None,
+                 memory_cache_size=MEMORY_CACHE_SIZE, fuzzy_cutoff=FUZZY_CUTOFF):
+        self.memory = OrderedDict()
+        self.memory_cache_size = memory_cache_size
+        self.memory_lock = threading.Lock()
+        self.cache = GeocodeCache(cache_path) if cache_path else None
+        self.gazetteer = load_gazetteer(gazetteer_path) if gazetteer_path else {}
+        self.gazetteer_names = list(self.gazetteer)
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.geocoder = geocoder
+        self.geocoder_lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'gazetteer_hits': 0, 'network_hits': 0, 'misses': 0,
+                      'network_errors': 0}
+
+    def _count(self, name):
+        with self.memory_lock:
+            self.stats[name] += 1
+
+    def _remember(self, key, coordinates):
+        with self.memory_lock:
+            self.memory[key] = coordinates
+            self.memory.move_to_end(key)
+            if len(self.memory) > self.memory_cache_size:
+                self.memory.popitem(last=False)
+
+    def _from_gazetteer(self, key):
+        if key in self.gazetteer:
+            return self.gazetteer[key]
+        close = difflib.get_close_matches(key, self.gazetteer_names, n=1, cutoff=self.fuzzy_cutoff)
+        if close:
+            return self.gazetteer[close[0]]
+        return None
+
+    #Returns (lat, long), (None, None) if Nominatim answered that it does not know the name, or None if
+    #it could not be asked (timeout, outage, no network)
+    def _from_network(self, location_name):
+        from geopy.exc import GeocoderServiceError
+
+        # One client for the whole app, and one request at a time so the rate limit holds across threads
+        with self.geocoder_lock:
+            if self.geocoder is None:
+                self.geocoder = nominatim_geocoder()
+            try:
+                with span('geocode.network'):
+                    location = self.geocoder(location_name)
+            except (GeocoderServiceError, OSError):
+                return None
+        if location:
+            return location.latitude, location.longitude
+        return None, None
+
+    #Returns (lat, long) for a place name, or (None, None) if no layer knows it
+    def resolve(self, location_name):
+        key = normalize_place_name(location_name)
+        if not key:
+            self._count('misses')
+            return None, None
+
+        with self.memory_lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self.memory[key]
+
+        if self.cache is not None:
+            found, coordinates = self.cache.get(key)
+            if found:
+                self._count('disk_hits')
+                self._remember(key, coordinates)
+                return coordinates
+
+        coordinates = self._from_gazetteer(key)
+        if coordinates is not None:
+            self._count('gazetteer_hits')
+            self._remember(key, coordinates)
+            return coordinates
+
+        coordinates = self._from_network(location_name)
+        if coordinates is None:
+            # Nothing is cached, so the next lookup of this name asks again
+            self._count('network_errors')
+            return None, None
+        if coordinates[0] is None:
+            self._count('misses')
+        else:
+            self._count('network_hits')
+            self._remember(key, coordinates)
+        if self.cache is not None:
+            self.cache.put(key, coordinates)
+        return coordinates
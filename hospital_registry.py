@@ -0,0 +1,342 @@
+# Binary hospital registry for the Vital Signs app.
+# The hospitals used to be a list of lists typed into the source, every entry a handful of Python
+# floats and strings. The full HeFRA register has tens of thousands of facilities, so instead the
+# official CSV export is compiled once into a snapshot file:
+# - coordinates, bed counts and capability flags are typed columns (float64, int32, uint32)
+# - every text (names, form links, regions) is stored once in a string table and referred to by number,
+#   so the thousands of facilities in "Greater Accra" share one copy of it
+# The app memory-maps the snapshot, so loading it is a few milliseconds, the columns are NumPy views of
+# the file without copying, and several processes on one machine share the same pages.
+# Dropping a new snapshot in place (compile writes it atomically) makes the app reload it.
+# Run with: python hospital_registry.py compile hefra.csv [hospitals.snapshot]
+#           python hospital_registry.py bench [facilities]
+
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+HOSPITALS_SNAPSHOT_PATH = 'hospitals.snapshot'
+MAGIC = b'VSHR'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQQ')  # magic, version, facilities, strings, string bytes
+HEADER_SIZE = 64
+
+#Services a facility can offer, one bit each in the capabilities column
+CAPABILITIES = ['emergency', 'oxygen', 'icu', 'surgery', 'trauma', 'pediatrics', 'maternity', 'laboratory',
+                'blood_bank', 'dialysis', 'ct_scan']
+#A facility whose services are not known is not ruled out for any patient
+UNKNOWN_CAPABILITIES = (1 << len(CAPABILITIES)) - 1
+
+#The typed columns, in the order they are stored. Text columns hold numbers into the string table.
+COLUMNS = [
+    ('latitudes', np.float64),
+    ('longitudes', np.float64),
+    ('beds', np.int32),
+    ('capabilities', np.uint32),
+    ('name_ids', np.int32),
+    ('form_link_ids', np.int32),
+    ('field_mapping_ids', np.int32),
+    ('region_ids', np.int32),
+    ('district_ids', np.int32),
+    ('facility_type_ids', np.int32),
+]
+
+#The header names the CSV export may use for each field (compared in lower case, spaces as _)
+CSV_FIELDS = {
+    'name': ['facility_name', 'name', 'facility', 'hospital'],
+    'latitude': ['latitude', 'lat'],
+    'longitude': ['longitude', 'lon', 'long', 'lng'],
+    'beds': ['available_beds', 'beds', 'bed_count', 'bed_capacity'],
+    'form_link': ['google_form_link', 'form_link', 'form'],
+    'region': ['region'],
+    'district': ['district'],
+    'facility_type': ['facility_type', 'type'],
+    'services': ['services', 'capabilities'],
+}
+
+
+#Turns "ICU; Oxygen, CT scan" (or a list of names) into capability bits. Unknown services are ignored.
+def capability_mask(services):
+    if isinstance(services, (list, tuple, set)):
+        services = ','.join(services)
+    mask = 0
+    for service in str(services or '').replace(';', ',').replace('|', ',').split(','):
+        service = service.strip().lower().replace(' ', '_').replace('-', '_')
+        if service in CAPABILITIES:
+            mask |= 1 << CAPABILITIES.index(service)
+    return mask
+
+
+#The capability names in a mask
+def capability_names(mask):
+    return [name for bit, name in enumerate(CAPABILITIES) if mask >> bit & 1]
+
+
+def _aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+#Where each column, the string offsets and the string bytes start in a snapshot with this many rows
+def _layout(facilities, strings):
+    offsets = {}
+    position = HEADER_SIZE
+    for name, dtype in COLUMNS:
+        offsets[name] = position
+        position = _aligned(position + facilities * np.dtype(dtype).itemsize)
+    offsets['string_offsets'] = position
+    offsets['string_bytes'] = _aligned(position + (strings + 1) * 8)
+    return offsets
+
+
+#Writes a snapshot from facility dictionaries (name, latitude, longitude, beds, form_link,
+#field_mapping, region, district, facility_type, capabilities). The file is written next to the
+#target and moved into place, so a running app never reads half a snapshot.
+def write_snapshot(facilities, path=HOSPITALS_SNAPSHOT_PATH):
+    strings = {}
+
+    def intern(text):
+        text = '' if text is None else str(text)
+        if text not in strings:
+            strings[text] = len(strings)
+        return strings[text]
+
+    count = len(facilities)
+    columns = {name: np.zeros(count, dtype=dtype) for name, dtype in COLUMNS}
+    for row, facility in enumerate(facilities):
+        columns['latitudes'][row] = facility['latitude']
+        columns['longitudes'][row] = facility['longitude']
+        columns['beds'][row] = facility.get('beds') or 0
+        columns['capabilities'][row] = facility.get('capabilities') or 0
+        columns['name_ids'][row] = intern(facility['name'])
+        columns['form_link_ids'][row] = intern(facility.get('form_link'))
+        columns['field_mapping_ids'][row] = intern(json.dumps(facility.get('field_mapping') or {}, sort_keys=True))
+        columns['region_ids'][row] = intern(facility.get('region'))
+        columns['district_ids'][row] = intern(facility.get('district'))
+        columns['facility_type_ids'][row] = intern(facility.get('facility_type'))
+
+    encoded = [text.encode('utf-8') for text in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(text) for text in encoded], out=string_offsets[1:])
+    layout = _layout(count, len(encoded))
+
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, count, len(encoded), int(string_offsets[-1])).ljust(HEADER_SIZE, b'\0'))
+        for name, dtype in COLUMNS:
+            file.seek(layout[name])
+            file.write(columns[name].tobytes())
+        file.seek(layout['string_offsets'])
+        file.write(string_offsets.tobytes())
+        file.seek(layout['string_bytes'])
+        file.write(b''.join(encoded))
+    os.replace(temporary, path)
+    return count
+
+
+#Reads the HeFRA CSV export into facility dictionaries. Rows without a name or usable coordinates
+#are skipped. Returns (facilities, skipped rows).
+def read_hefra_csv(path):
+    facilities, skipped = [], 0
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        headers = {header.strip().lower().replace(' ', '_'): header for header in reader.fieldnames or []}
+        columns = {field: next((headers[alias] for alias in aliases if alias in headers), None)
+                   for field, aliases in CSV_FIELDS.items()}
+
+        def value(row, field):
+            return (row.get(columns[field]) or '').strip() if columns[field] else ''
+
+        for row in reader:
+            try:
+                latitude, longitude = float(value(row, 'latitude')), float(value(row, 'longitude'))
+            except ValueError:
+                skipped += 1
+                continue
+            beds = value(row, 'beds')
+            if not value(row, 'name') or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                skipped += 1
+                continue
+            facilities.append({
+                'name': value(row, 'name'),
+                'latitude': latitude,
+                'longitude': longitude,
+                'beds': int(float(beds)) if beds.replace('.', '', 1).isdigit() else 0,
+                'form_link': value(row, 'form_link'),
+                'region': value(row, 'region'),
+                'district': value(row, 'district'),
+                'facility_type': value(row, 'facility_type'),
+                'capabilities': capability_mask(value(row, 'services')) if columns['services'] else UNKNOWN_CAPABILITIES,
+            })
+    return facilities, skipped
+
+
+#Compiles the HeFRA CSV export into a snapshot. Returns (facilities written, rows skipped).
+def compile_csv(csv_path, snapshot_path=HOSPITALS_SNAPSHOT_PATH):
+    facilities, skipped = read_hefra_csv(csv_path)
+    return write_snapshot(facilities, snapshot_path), skipped
+
+
+#The usual 2D list ("name", lat, long, available beds, "Google form link", field mapping, [services])
+#as facility dictionaries
+def facilities_from_list(hospitals):
+    return [{'name': hospital[0], 'latitude': hospital[1], 'longitude': hospital[2], 'beds': hospital[3],
+             'form_link': hospital[4], 'field_mapping': hospital[5] if len(hospital) > 5 else {},
+             'capabilities': capability_mask(hospital[6]) if len(hospital) > 6 else UNKNOWN_CAPABILITIES}
+            for hospital in hospitals]
+
+
+class HospitalRegistry:
+    #A memory-mapped snapshot. It can be used wherever the hospital list is: registry[i] is the usual
+    #row ("name", lat, long, available beds, "Google form link", field mapping), built on request.
+    def __init__(self, path=HOSPITALS_SNAPSHOT_PATH):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.modified = os.fstat(file.fileno()).st_mtime_ns
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, strings, string_bytes = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} hospital snapshot')
+        layout = _layout(count, strings)
+        for name, dtype in COLUMNS:
+            setattr(self, name, np.frombuffer(self.buffer, dtype=dtype, count=count, offset=layout[name]))
+        self.string_offsets = np.frombuffer(self.buffer, dtype=np.uint64, count=strings + 1,
+                                            offset=layout['string_offsets'])
+        self.string_start = layout['string_bytes']
+        self._names = None
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('hospital index out of range')
+        return [self.string(self.name_ids[index]), float(self.latitudes[index]), float(self.longitudes[index]),
+                int(self.beds[index]), self.string(self.form_link_ids[index]),
+                json.loads(self.string(self.field_mapping_ids[index]))]
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    #Text number `number` of the string table
+    def string(self, number):
+        start = self.string_start + int(self.string_offsets[number])
+        end = self.string_start + int(self.string_offsets[number + 1])
+        return self.buffer[start:end].decode('utf-8')
+
+    #Every facility name, decoded once
+    def names(self):
+        if self._names is None:
+            offsets = (self.string_offsets + self.string_start).tolist()
+            buffer = self.buffer
+            self._names = [buffer[offsets[number]:offsets[number + 1]].decode('utf-8')
+                           for number in self.name_ids.tolist()]
+        return self._names
+
+    def region(self, index):
+        return self.string(self.region_ids[index])
+
+    def district(self, index):
+        return self.string(self.district_ids[index])
+
+    def facility_type(self, index):
+        return self.string(self.facility_type_ids[index])
+
+    #True when a different snapshot has been put at the path since this one was loaded
+    def changed(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self.modified
+        except FileNotFoundError:
+            return False
+
+
+#Names, latitudes, longitudes and bed counts of either a registry or the usual hospital list
+def hospital_columns(hospitals):
+    if isinstance(hospitals, HospitalRegistry):
+        return hospitals.names(), hospitals.latitudes, hospitals.longitudes, hospitals.beds
+    return ([hospital[0] for hospital in hospitals], [hospital[1] for hospital in hospitals],
+            [hospital[2] for hospital in hospitals], [hospital[3] for hospital in hospitals])
+
+
+#A facility's id: its name and where it is. Two facilities with the same name get different ids, and a
+#facility keeps its id from one snapshot to the next as long as it does not move.
+def facility_id(name, latitude, longitude):
+    return f'{name}@{float(latitude):.5f},{float(longitude):.5f}'
+
+
+#The facility id of every hospital in a registry or the usual hospital list
+def facility_ids(hospitals):
+    names, latitudes, longitudes, beds = hospital_columns(hospitals)
+    return [facility_id(name, latitude, longitude)
+            for name, latitude, longitude in zip(names, np.asarray(latitudes).tolist(), np.asarray(longitudes).tolist())]
+
+
+#Capability bits of every hospital. In the usual list the services are an optional 7th entry.
+def hospital_capabilities(hospitals):
+    if isinstance(hospitals, HospitalRegistry):
+        return np.asarray(hospitals.capabilities, dtype=np.uint32)
+    return np.array([capability_mask(hospital[6]) if len(hospital) > 6 else UNKNOWN_CAPABILITIES
+                     for hospital in hospitals], dtype=np.uint32)
+
+
+def resident_kb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+#Compiles a synthetic registry and compares loading it from the snapshot with building the list
+def bench(size=50000):
+    import tempfile
+    from benchmarks import synthetic_registry
+
+    hospitals = synthetic_registry(size)
+    regions = ['Greater Accra', 'Ashanti', 'Northern', 'Volta', 'Central', 'Western', 'Eastern']
+    facilities = facilities_from_list(hospitals)
+    for number, facility in enumerate(facilities):
+        facility['region'] = regions[number % len(regions)]
+        facility['capabilities'] = number % (1 << len(CAPABILITIES))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, HOSPITALS_SNAPSHOT_PATH)
+        start = time.perf_counter()
+        write_snapshot(facilities, path)
+        compiled = time.perf_counter() - start
+        before = resident_kb()
+        start = time.perf_counter()
+        registry = HospitalRegistry(path)
+        loaded = time.perf_counter() - start
+        start = time.perf_counter()
+        registry.names()
+        named = time.perf_counter() - start
+        grown = resident_kb() - before if before is not None else None
+        print(f'{size} facilities, snapshot of {os.path.getsize(path) / 1024:.0f} kB compiled in {compiled * 1000:.0f} ms')
+        print(f'  load (memory map)   {loaded * 1000:8.2f} ms')
+        print(f'  decode every name   {named * 1000:8.2f} ms')
+        if grown is not None:
+            print(f'  resident memory     {grown:8d} kB more after loading and decoding names')
+        print(f'  row 0               {registry[0]}')
+        del registry
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'compile':
+        written, skipped = compile_csv(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else HOSPITALS_SNAPSHOT_PATH)
+        print(f'{written} facilities written, {skipped} rows skipped')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 50000)
+    else:
+        print('Usage: python hospital_registry.py compile hefra.csv [hospitals.snapshot] | bench [facilities]')
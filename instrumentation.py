@@ -0,0 +1,302 @@
+# Timing and counters for the dispatch pipeline.
+# A dispatch goes through geocoding, matching, form submission and the record store, and each of these
+# can be the slow one in production. Every stage is wrapped in a span:
+#     with span('geocode'):
+#         ...
+# which adds its duration to a histogram for that stage. A whole dispatch is a trace; the spans inside
+# it are kept with it, so the slowest dispatches can be looked at stage by stage afterwards.
+# The histograms and counters are served as Prometheus text (GET /metrics in service.py) and, if
+# VITALS_METRICS_FILE is set, written once a minute to a rotating file for devices nobody can scrape.
+# Spans are on by default and cost a few microseconds, against milliseconds for the cheapest stage;
+# with VITALS_METRICS=0 they do nothing.
+
+import bisect
+import collections
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('VITALS_METRICS', '1') != '0'
+METRICS_FILE = os.environ.get('VITALS_METRICS_FILE')
+EXPORT_INTERVAL = 60
+MAX_FILE_BYTES = 1024 * 1024
+FILE_BACKUPS = 3
+
+#Histogram bucket upper bounds in seconds, from a cache hit to a stuck Chrome
+BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+RECENT_TRACES = 200
+SLOWEST_TRACES = 20
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last one is everything above the largest bucket
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.recent_traces = collections.deque(maxlen=RECENT_TRACES)
+        self.slowest_traces = []  # (seconds, id, trace), fastest first
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].observe(seconds)
+
+    def count(self, event, amount=1):
+        with self.lock:
+            self.counters[event] += amount
+
+    def add_trace(self, trace):
+        with self.lock:
+            self.recent_traces.append(trace)
+            if len(self.slowest_traces) < SLOWEST_TRACES or trace['seconds'] > self.slowest_traces[0][0]:
+                bisect.insort(self.slowest_traces, (trace['seconds'], id(trace), trace))
+                if len(self.slowest_traces) > SLOWEST_TRACES:
+                    self.slowest_traces.pop(0)
+
+    #Count, total and p50/p99 (from the buckets) of every stage, and every counter
+    def snapshot(self):
+        with self.lock:
+            stages = {}
+            for stage, histogram in self.histograms.items():
+                stages[stage] = {
+                    'count': histogram.count,
+                    'seconds': round(histogram.total, 6),
+                    'p50': bucket_quantile(histogram, 0.5),
+                    'p99': bucket_quantile(histogram, 0.99),
+                }
+            return {'time': time.time(), 'stages': stages, 'counters': dict(self.counters)}
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.recent_traces.clear()
+            self.slowest_traces.clear()
+
+
+metrics = Metrics()
+local = threading.local()
+
+
+#The upper bound of the bucket the quantile falls into, or None for an empty histogram
+def bucket_quantile(histogram, quantile):
+    if histogram.count == 0:
+        return None
+    wanted = quantile * histogram.count
+    seen = 0
+    for bound, count in zip(BUCKETS + [float('inf')], histogram.counts):
+        seen += count
+        if seen >= wanted:
+            return bound
+    return float('inf')
+
+
+class Span:
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        seconds = time.perf_counter() - self.started
+        metrics.observe(self.stage, seconds)
+        if error_type is not None:
+            metrics.count(f'{self.stage}.errors')
+        trace = getattr(local, 'trace', None)
+        if trace is not None:
+            trace['spans'].append({
+                'stage': self.stage,
+                'at': round(self.started - trace['started'], 6),
+                'seconds': round(seconds, 6),
+                'error': error_type.__name__ if error_type is not None else None,
+            })
+        return False
+
+
+class Trace:
+    __slots__ = ('span', 'trace', 'outer')
+
+    def __init__(self, name, attributes):
+        self.span = Span(name)
+        self.trace = {'name': name, 'attributes': attributes, 'spans': []}
+
+    def __enter__(self):
+        self.outer = getattr(local, 'trace', None)
+        if self.outer is None:
+            # A trace inside another trace (a dispatch inside mass-casualty mode) is only a span of the outer one
+            local.trace = self.trace
+        self.span.__enter__()
+        self.trace['started'] = self.span.started
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.span.__exit__(error_type, error, traceback)
+        if self.outer is None:
+            local.trace = None
+            trace = self.trace
+            trace['seconds'] = round(time.perf_counter() - trace.pop('started'), 6)
+            trace['finished_at'] = time.time()
+            trace['spans'].pop()  # The trace's own span
+            if error_type is not None:
+                trace['attributes']['error'] = error_type.__name__
+            metrics.add_trace(trace)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+#Times the block as one stage
+def span(stage):
+    return Span(stage) if ENABLED else NULL_SPAN
+
+
+#Times the block as a whole trace (one dispatch), keeping the spans that run inside it
+def trace(name, **attributes):
+    return Trace(name, attributes) if ENABLED else NULL_SPAN
+
+
+#Adds something worth knowing (the hospital chosen, the outcome) to the current trace, if there is one
+def annotate(key, value):
+    current = getattr(local, 'trace', None) if ENABLED else None
+    if current is not None:
+        current['attributes'][key] = value
+
+
+def count(event, amount=1):
+    if ENABLED:
+        metrics.count(event, amount)
+
+
+#Decorator: times every call of the function as one stage
+def timed(stage):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+#The last traces, newest first, or the slowest ones, slowest first
+def traces(slowest=False, limit=RECENT_TRACES):
+    with metrics.lock:
+        if slowest:
+            found = [trace for seconds, key, trace in reversed(metrics.slowest_traces)]
+        else:
+            found = list(reversed(metrics.recent_traces))
+    return found[:limit]
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+#Everything in the Prometheus text format. gauges is an optional {name: number} of current values
+#(queue lengths, cache sizes) that the caller knows about.
+def prometheus_text(gauges=None):
+    lines = []
+    with metrics.lock:
+        lines.append('# HELP vitals_stage_seconds Time spent in each dispatch stage.')
+        lines.append('# TYPE vitals_stage_seconds histogram')
+        for stage, histogram in sorted(metrics.histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'vitals_stage_seconds_bucket{{stage="{label(stage)}",le="{bound}"}} {cumulative}')
+            lines.append(f'vitals_stage_seconds_bucket{{stage="{label(stage)}",le="+Inf"}} {histogram.count}')
+            lines.append(f'vitals_stage_seconds_sum{{stage="{label(stage)}"}} {histogram.total:.6f}')
+            lines.append(f'vitals_stage_seconds_count{{stage="{label(stage)}"}} {histogram.count}')
+        lines.append('# HELP vitals_events_total Number of times each event happened.')
+        lines.append('# TYPE vitals_events_total counter')
+        for event, value in sorted(metrics.counters.items()):
+            lines.append(f'vitals_events_total{{event="{label(event)}"}} {value}')
+    if gauges:
+        lines.append('# HELP vitals_state Current values reported by the dispatch core.')
+        lines.append('# TYPE vitals_state gauge')
+        for name, value in sorted(gauges.items()):
+            lines.append(f'vitals_state{{name="{label(name)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+#Turns nested stats dictionaries into {"outbox.pending": 3, ...}, keeping only numbers
+def flatten(stats, prefix=''):
+    flat = {}
+    for key, value in stats.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+class FileExporter:
+    #Every interval, writes one JSON line with the stage timings and counters, and the slowest traces
+    #since the last line, to a file that is rotated when it gets big
+    def __init__(self, path, interval=EXPORT_INTERVAL, max_bytes=MAX_FILE_BYTES, backups=FILE_BACKUPS):
+        self.interval = interval
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        self.stopping = threading.Event()
+        self.last_export = time.time()
+        self.thread = None
+
+    def export(self):
+        line = metrics.snapshot()
+        line['slowest_traces'] = [trace for trace in traces(slowest=True) if trace['finished_at'] > self.last_export]
+        self.last_export = line['time']
+        self.handler.emit(logging.makeLogRecord({'msg': json.dumps(line), 'levelno': logging.INFO}))
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.export()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='metrics-export', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.export()
+        self.handler.close()
+
+
+#Starts the file export if VITALS_METRICS_FILE (or path) is set. Returns the exporter, or None.
+def start_file_export(path=METRICS_FILE, interval=EXPORT_INTERVAL):
+    if not path or not ENABLED:
+        return None
+    exporter = FileExporter(path, interval)
+    exporter.start()
+    return exporter
@@ -0,0 +1,240 @@
+# Hospital matching engine for the Vital Signs app.
+# The app used to walk the whole hospital list and call haversine_distance once per facility.
+# That is fine for three hospitals but not for the full HeFRA registry, so this module builds
+# a spatial index (a k-d tree over points on the unit sphere) once, and answers
+# "k nearest hospitals with free beds" using NumPy to compute the distances in batches.
+
+import heapq
+import threading
+from math import radians, sin, cos, sqrt, atan2
+
+import numpy as np
+
+from hospital_registry import hospital_capabilities, hospital_columns
+
+EARTH_RADIUS_KM = 6371  # Radius of the Earth in kilometers (Ghana uses the metric system)
+LEAF_SIZE = 32  # Number of hospitals kept together at the bottom of the tree
+
+
+#The function below is the Haversine formula which calculates the distance between two places.
+#It is kept as the reference implementation; the index below must always agree with it.
+def haversine_distance(lat1, lon1, lat2, lon2):
+    # Convert latitudes and longitudes from degrees to radians for simplicity
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+
+    # This is the Haversine formula
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    distance = EARTH_RADIUS_KM * c
+
+    return distance
+
+
+#Same formula as above, but from one place to many places at once (lats and lons are arrays)
+def haversine_many(lat, lon, lats, lons):
+    lat, lon = radians(lat), radians(lon)
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+
+    dlat = lats - lat
+    dlon = lons - lon
+    a = np.sin(dlat / 2) ** 2 + cos(lat) * np.cos(lats) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_KM * c
+
+
+#Distances from every place in the first list to every place in the second, as an N x M matrix
+def haversine_matrix(lats1, lons1, lats2, lons2):
+    lats1 = np.radians(np.asarray(lats1, dtype=np.float64))[:, None]
+    lons1 = np.radians(np.asarray(lons1, dtype=np.float64))[:, None]
+    lats2 = np.radians(np.asarray(lats2, dtype=np.float64))[None, :]
+    lons2 = np.radians(np.asarray(lons2, dtype=np.float64))[None, :]
+
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_KM * c
+
+
+#Turns latitudes and longitudes (in degrees) into x, y, z points on a sphere of radius 1.
+#The straight-line (chord) distance between two such points grows with the distance along the
+#Earth's surface, so the nearest point in 3D is also the nearest place on the map.
+def to_unit_vectors(lats, lons):
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    cos_lats = np.cos(lats)
+    return np.column_stack((cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)))
+
+
+class PointIndex:
+    #A k-d tree over places given by their latitudes and longitudes (in degrees)
+    def __init__(self, latitudes, longitudes, leaf_size=LEAF_SIZE):
+        self.leaf_size = leaf_size
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.points = to_unit_vectors(self.latitudes, self.longitudes)
+
+        # The tree is stored in flat lists. A node is a leaf when its left child is -1,
+        # in which case start:end is its slice of self.order.
+        self.order = np.arange(len(self.points))
+        self.split_dims = []
+        self.split_values = []
+        self.left = []
+        self.right = []
+        self.starts = []
+        self.ends = []
+        self.root = self._build(0, len(self.points)) if len(self.points) else -1
+        self.node_masks = None  # Optional: per node, the OR of the bitmasks of every place below it
+
+    def __len__(self):
+        return len(self.points)
+
+    #Gives every node the OR of the bitmasks of the places below it, so nearest(required=...) can skip
+    #subtrees where no place has all the required bits
+    def set_masks(self, masks):
+        masks = np.asarray(masks)
+        self.node_masks = [0] * len(self.starts)
+        for node in reversed(range(len(self.starts))):  # Children always come after their parent
+            if self.left[node] == -1:
+                indices = self.order[self.starts[node]:self.ends[node]]
+                self.node_masks[node] = int(np.bitwise_or.reduce(masks[indices])) if len(indices) else 0
+            else:
+                self.node_masks[node] = self.node_masks[self.left[node]] | self.node_masks[self.right[node]]
+
+    def _new_node(self, start, end):
+        self.split_dims.append(-1)
+        self.split_values.append(0.0)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.starts.append(start)
+        self.ends.append(end)
+        return len(self.starts) - 1
+
+    def _build(self, start, end):
+        node = self._new_node(start, end)
+        if end - start <= self.leaf_size:
+            return node
+
+        # Split on the axis where the places are most spread out, at the median
+        indices = self.order[start:end]
+        spread = np.ptp(self.points[indices], axis=0)
+        dim = int(np.argmax(spread))
+        middle = (end - start) // 2
+        indices = indices[np.argpartition(self.points[indices, dim], middle)]
+        self.order[start:end] = indices
+
+        self.split_dims[node] = dim
+        self.split_values[node] = float(self.points[indices[middle], dim])
+        self.left[node] = self._build(start, start + middle)
+        self.right[node] = self._build(start + middle, end)
+        return node
+
+    #Returns up to k (index, distance in km) pairs, nearest first. keep(indices) may return a mask
+    #of the places at a leaf that are allowed in the answer. With node_masks set, subtrees where no
+    #place has every bit of `required` are skipped without being looked at.
+    def nearest(self, latitude, longitude, k=1, keep=None, required=0):
+        if self.root == -1 or k <= 0:
+            return []
+
+        lat, lon = radians(latitude), radians(longitude)
+        query = np.array([cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)])
+        best = []  # max-heap of (-squared chord, index)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node < 0:
+                # Negative entries are far children pushed with the distance to their split plane
+                node, plane_distance = -node - 1, stack.pop()
+                if len(best) == k and plane_distance >= -best[0][0]:
+                    continue
+            if required and self.node_masks[node] & required != required:
+                continue
+
+            if self.left[node] == -1:
+                indices = self.order[self.starts[node]:self.ends[node]]
+                if keep is not None:
+                    indices = indices[keep(indices)]
+                if len(indices) == 0:
+                    continue
+                offsets = self.points[indices] - query
+                chords = np.einsum('ij,ij->i', offsets, offsets)
+                if len(best) == k:
+                    closer = chords < -best[0][0]
+                    indices, chords = indices[closer], chords[closer]
+                for chord, index in zip(chords.tolist(), indices.tolist()):
+                    if len(best) < k:
+                        heapq.heappush(best, (-chord, index))
+                    elif chord < -best[0][0]:
+                        heapq.heapreplace(best, (-chord, index))
+                continue
+
+            difference = query[self.split_dims[node]] - self.split_values[node]
+            if difference < 0:
+                near, far = self.left[node], self.right[node]
+            else:
+                near, far = self.right[node], self.left[node]
+            # The far side is visited after the near side, and only if it could still hold a closer place
+            stack.append(difference * difference)
+            stack.append(-far - 1)
+            stack.append(near)
+
+        found = [index for _, index in sorted(best, reverse=True)]
+        distances = haversine_many(latitude, longitude, self.latitudes[found], self.longitudes[found])
+        return list(zip(found, distances.tolist()))
+
+
+class HospitalIndex(PointIndex):
+    #hospitals is the usual 2D list in the format ("name", lat, long, available beds, "Google form link", field mapping)
+    #or a HospitalRegistry loaded from a snapshot
+    def __init__(self, hospitals, leaf_size=LEAF_SIZE):
+        self.hospitals = hospitals
+        names, latitudes, longitudes, beds = hospital_columns(hospitals)
+        self.available_beds = np.array(beds, dtype=np.int64)
+        super().__init__(latitudes, longitudes, leaf_size)
+
+        #Services of each hospital as bits (see hospital_registry.CAPABILITIES), and per node of the tree
+        #the services offered anywhere below it, so a search for an ICU skips regions without one
+        self.capabilities = hospital_capabilities(hospitals)
+        self.set_masks(self.capabilities)
+
+        #A rare service (few hospitals have an ICU) would still mean searching far through the full tree,
+        #so the hospitals offering each service get a smaller tree of their own, built when first needed
+        self.service_counts = [int(np.count_nonzero(self.capabilities >> bit & 1)) for bit in range(32)]
+        self.service_indexes = {}
+        self.service_lock = threading.Lock()
+
+    def _service_index(self, bit):
+        with self.service_lock:
+            index = self.service_indexes.get(bit)
+            if index is None:
+                members = np.flatnonzero(self.capabilities >> bit & 1)
+                index = PointIndex(self.latitudes[members], self.longitudes[members], self.leaf_size)
+                index.members = members
+                index.set_masks(self.capabilities[members])
+                self.service_indexes[bit] = index
+            return index
+
+    #Keeps the index in step when a hospital's bed count changes
+    def set_available_beds(self, hospital_index, beds):
+        self.available_beds[hospital_index] = beds
+        if isinstance(self.hospitals, list):
+            self.hospitals[hospital_index][3] = beds  # A snapshot is read-only; its rows are made on request
+
+    #Returns up to k (hospital index, distance in km) pairs, nearest first, for hospitals
+    #with at least min_beds available beds that offer every service in the `required` bitmask.
+    def nearest(self, latitude, longitude, k=1, min_beds=1, required=0):
+        if required:
+            rarest = min((bit for bit in range(32) if required >> bit & 1), key=lambda bit: self.service_counts[bit])
+            if self.service_counts[rarest] * 2 > len(self):
+                return super().nearest(latitude, longitude, k, required=required, keep=lambda indices: (
+                    (self.available_beds[indices] >= min_beds) & (self.capabilities[indices] & required == required)))
+            index = self._service_index(rarest)
+            members = index.members
+            found = index.nearest(latitude, longitude, k, required=required, keep=lambda indices: (
+                (self.available_beds[members[indices]] >= min_beds)
+                & (self.capabilities[members[indices]] & required == required)))
+            return [(int(members[position]), distance) for position, distance in found]
+        if min_beds <= 0:
+            return super().nearest(latitude, longitude, k)
+        return super().nearest(latitude, longitude, k, keep=lambda indices: self.available_beds[indices] >= min_beds)
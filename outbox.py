@@ -0,0 +1,279 @@
+# Store-and-forward outbox for hospital submissions.
+# Ambulances and field units often have poor connectivity. A submission that failed used to be lost,
+# and a slow one held up the screen. Now every submission is first written to a SQLite table
+# (the outbox) and a background flusher delivers it to the hospital's Google Form:
+# - in batches, with a limit on how many posts are in flight at once
+# - retrying failures with exponential backoff, so a dead connection is not hammered
+# - with a key per record, so the same record is only queued once (Google Forms ignores the key, so a
+#   post that timed out after reaching the form can still be answered twice when it is retried)
+# A record is only marked 'sent' once the hospital has accepted it. Sent records lose their vitals but keep
+# their key and status for SENT_RETENTION, so their status can still be looked up.
+
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import count, span
+
+OUTBOX_PATH = 'outbox.sqlite3'
+BATCH_SIZE = 100
+MAX_CONCURRENCY = 8
+BASE_BACKOFF = 1.0  # Seconds before the first retry; doubles on every failure
+MAX_BACKOFF = 300.0
+MAX_ATTEMPTS = 50  # After this many failures a record is kept but marked 'failed' for someone to look at
+POLL_INTERVAL = 5.0
+SENT_RETENTION = 30 * 24 * 3600  # Sent records are pruned when they were enqueued longer ago than this
+PRUNE_INTERVAL = 3600
+
+
+#Middle and tail values of a list of latencies (in seconds)
+def percentiles(values, points=(50, 99)):
+    if not values:
+        return {f'p{point}': None for point in points}
+    ordered = sorted(values)
+    return {f'p{point}': ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))] for point in points}
+
+
+class Outbox:
+    #submitter is anything with submit(google_form_link, vitals, field_mapping, idempotency_key),
+    #for example submission.FormSubmitter. It must raise an exception when the hospital did not accept the data.
+    def __init__(self, submitter, path=OUTBOX_PATH, batch_size=BATCH_SIZE, max_concurrency=MAX_CONCURRENCY,
+                 base_backoff=BASE_BACKOFF, max_backoff=MAX_BACKOFF, max_attempts=MAX_ATTEMPTS,
+                 sent_retention=SENT_RETENTION):
+        self.submitter = submitter
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.sent_retention = sent_retention
+        self.pruned_at = 0.0
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY, idempotency_key TEXT UNIQUE, google_form_link TEXT, payload TEXT, '
+            "field_mapping TEXT, status TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, "
+            'next_attempt_at REAL, enqueued_at REAL, last_error TEXT)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)')
+        self.connection.commit()
+
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='outbox')
+        #An event per tracked record still in flight; it is set and removed when the record is sent or given up
+        self.waiters = {}
+        #The hospital's own field mapping of every record enqueued by this process. The submitter fills an
+        #empty one in place, so the hospital entry keeps what was discovered (see HttpFormSubmitter.mapping_for).
+        self.field_mappings = {}
+        self.latencies = deque(maxlen=10000)
+        self.stats = {'enqueued': 0, 'sent': 0, 'failed_attempts': 0, 'given_up': 0, 'batches': 0}
+
+    #Writes one submission to the outbox and returns its key. It is a single indexed insert, so it costs
+    #the same however long the queue is. Enqueueing a key that is already in the outbox keeps only the first.
+    def enqueue(self, google_form_link, vitals, field_mapping=None, idempotency_key=None, track=False):
+        key = idempotency_key or uuid.uuid4().hex
+        # Registered before the insert, so the flusher finds them even if it sends the record straight away
+        waiter = mapping = None
+        if track and key not in self.waiters:
+            waiter = self.waiters[key] = threading.Event()
+        if field_mapping is not None and key not in self.field_mappings:
+            mapping = self.field_mappings[key] = field_mapping
+        now = time.time()
+        with self.lock:
+            inserted = self.connection.execute(
+                'INSERT OR IGNORE INTO outbox (idempotency_key, google_form_link, payload, field_mapping, '
+                'next_attempt_at, enqueued_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, google_form_link, json.dumps(vitals), json.dumps(field_mapping or {}), now, now),
+            ).rowcount == 1
+            self.connection.commit()
+            if inserted:
+                self.stats['enqueued'] += 1
+        if inserted:
+            self.wake.set()
+        else:
+            # The key was queued (or sent) before; that record's own waiter and mapping stay
+            if waiter is not None:
+                self.waiters.pop(key, None)
+            if mapping is not None:
+                self.field_mappings.pop(key, None)
+        return key
+
+    #Waits until a record enqueued with track=True has been delivered and returns whether it was. Returns
+    #False on timeout; the record stays in the outbox and is still delivered later.
+    def wait(self, key, timeout=None):
+        event = self.waiters.get(key)
+        if event is not None:
+            event.wait(timeout)
+        return self.status(key) == 'sent'
+
+    #'pending' or 'failed' while the record waits in the outbox, 'sent' once the hospital accepted it, and
+    #'unknown' for a key this outbox has never seen (or that was pruned after SENT_RETENTION)
+    def status(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT status FROM outbox WHERE idempotency_key = ?', (key,)).fetchone()
+        return 'unknown' if row is None else row[0]
+
+    def _due_batch(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT id, idempotency_key, google_form_link, payload, field_mapping, attempts, enqueued_at '
+                "FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (time.time(), self.batch_size),
+            ).fetchall()
+
+    def _send(self, row):
+        row_id, key, google_form_link, payload, field_mapping, attempts, enqueued_at = row
+        mapping = self.field_mappings.get(key)
+        if mapping is None:
+            mapping = json.loads(field_mapping)  # Enqueued before a restart
+        unknown = not mapping
+        try:
+            with span('outbox.send'):
+                self.submitter.submit(google_form_link, json.loads(payload), mapping, key)
+            return None
+        except Exception as error:
+            return error
+        finally:
+            if unknown and mapping:
+                # The submitter discovered the form's fields; the records still waiting for it keep them
+                with self.lock:
+                    self.connection.execute(
+                        'UPDATE outbox SET field_mapping = ? '
+                        "WHERE google_form_link = ? AND field_mapping = '{}' AND status = 'pending'",
+                        (json.dumps(mapping), google_form_link))
+                    self.connection.commit()
+
+    def _backoff(self, attempts):
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)  # Jitter, so many units coming back online do not retry in step
+
+    #Sends one batch of due records. Returns how many records were in the batch.
+    def flush_once(self):
+        batch = self._due_batch()
+        if not batch:
+            return 0
+        errors = list(self.pool.map(self._send, batch))
+
+        now = time.time()
+        sent, retry, given_up, finished = [], [], [], []
+        for row, error in zip(batch, errors):
+            row_id, key, attempts, enqueued_at = row[0], row[1], row[5] + 1, row[6]
+            if error is None:
+                sent.append((attempts, row_id))
+                finished.append(key)
+                self.latencies.append(now - enqueued_at)
+            elif attempts >= self.max_attempts:
+                given_up.append((attempts, str(error), row_id))
+                finished.append(key)
+            else:
+                retry.append((attempts, now + self._backoff(attempts), str(error), row_id))
+
+        with self.lock:
+            # The vitals are dropped once delivered; the key and status are kept for status()
+            self.connection.executemany(
+                "UPDATE outbox SET attempts = ?, status = 'sent', payload = NULL, last_error = NULL WHERE id = ?",
+                sent)
+            self.connection.executemany(
+                'UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?', retry)
+            self.connection.executemany(
+                "UPDATE outbox SET attempts = ?, last_error = ?, status = 'failed' WHERE id = ?", given_up)
+            self.connection.commit()
+            self.stats['sent'] += len(sent)
+            self.stats['failed_attempts'] += len(retry) + len(given_up)
+            self.stats['given_up'] += len(given_up)
+            self.stats['batches'] += 1
+        # Only now is status() 'sent' or 'failed', so a woken wait() reads the final answer
+        for key in finished:
+            self.field_mappings.pop(key, None)
+            waiter = self.waiters.pop(key, None)
+            if waiter is not None:
+                waiter.set()
+        count('outbox.sent', len(sent))
+        count('outbox.retries', len(retry))
+        count('outbox.given_up', len(given_up))
+        return len(batch)
+
+    #Sends batches until nothing is due any more (or the timeout runs out). Returns how many were attempted.
+    def drain(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        attempted = 0
+        while deadline is None or time.monotonic() < deadline:
+            batch = self.flush_once()
+            if batch == 0:
+                break
+            attempted += batch
+        return attempted
+
+    #Removes sent records enqueued longer ago than sent_retention. Returns how many were removed.
+    def prune(self):
+        with self.lock:
+            removed = self.connection.execute(
+                "DELETE FROM outbox WHERE status = 'sent' AND enqueued_at < ?",
+                (time.time() - self.sent_retention,)).rowcount
+            self.connection.commit()
+        self.pruned_at = time.time()
+        return removed
+
+    def _next_due_in(self):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()
+        if row[0] is None:
+            return POLL_INTERVAL
+        return max(0.0, min(POLL_INTERVAL, row[0] - time.time()))
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                self.drain()
+                if time.time() - self.pruned_at > PRUNE_INTERVAL:
+                    self.prune()
+            except sqlite3.Error as error:
+                print(f"Outbox flush failed: {error!r}")
+            # Sleep until the next retry is due, or until something new is enqueued
+            self.wake.wait(self._next_due_in())
+            self.wake.clear()
+
+    #Starts the background flusher
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='outbox-flusher', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.pool.shutdown(wait=True)
+
+    def close(self):
+        self.stop()
+        with self.lock:
+            self.connection.close()
+
+    #Queue depth, age of the oldest waiting record and delivery latency (enqueue to accepted, in seconds)
+    def queue_stats(self):
+        with self.lock:
+            counts = dict(self.connection.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+            oldest = self.connection.execute(
+                "SELECT MIN(enqueued_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+            stats = dict(self.stats)
+        stats['depth'] = counts.get('pending', 0)
+        stats['failed'] = counts.get('failed', 0)
+        stats['oldest_age'] = None if oldest is None else time.time() - oldest
+        stats['latency'] = percentiles(list(self.latencies))
+        return stats
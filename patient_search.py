@@ -0,0 +1,174 @@
+# Patient name search for the Recall Vitals screen.
+# Recall used to work only when the operator typed exactly the name used at intake. This index keeps
+# every patient name in memory and suggests matches while the operator types:
+# - every word typed must match a word of the name, and the last word may be unfinished
+#   ("ama mens" finds "Ama Mensah")
+# - words may be misspelled ("kwme", "mensa"); close spellings are found through the three-letter
+#   pieces (trigrams) they share with known words and ranked by edit distance
+# The fuzzy part works on the distinct words of all names (a few tens of thousands), not on every
+# patient, and the patients are then found through a word -> names index, so it stays fast with
+# hundreds of thousands of patients. Names are added one at a time as records are saved.
+
+import bisect
+import itertools
+from collections import Counter
+
+from records import normalize_name
+
+SUGGESTIONS = 8
+PREFIX_WORDS = 64  # How many known words an unfinished last word may stand for
+FUZZY_CANDIDATES = 50
+PENDING_LIMIT = 4096  # New words wait in a small unsorted list and are merged into the sorted one in bulk
+
+
+#The three-letter pieces of a word, padded so its start counts too
+def trigrams(word):
+    padded = f'  {word}'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+#Number of single-letter insertions, deletions and substitutions needed to turn a into b
+def edit_distance(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, letter_a in enumerate(a, 1):
+        current = [i]
+        for j, letter_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (letter_a != letter_b)))
+        previous = current
+    return previous[-1]
+
+
+#How many typing mistakes we forgive in a word of this length
+def allowed_mistakes(word):
+    if len(word) < 3:
+        return 0
+    return 1 if len(word) < 7 else 2
+
+
+class PatientSearchIndex:
+    def __init__(self, names=()):
+        self.display_names = {}  # key -> name as it was typed at intake
+        self.word_keys = {}  # word -> set of keys of the names that contain it
+        self.vocabulary = []  # sorted distinct words, for prefix search
+        self.pending = []  # new words not merged into self.vocabulary yet
+        self.word_trigrams = {}  # trigram -> words that contain it
+        for name in names:
+            self.add(name, merge=False)
+        self._merge()
+
+    def __len__(self):
+        return len(self.display_names)
+
+    def _merge(self):
+        # The sorted list plus one sorted run at the end: Python's sort merges the two in linear time
+        self.pending.sort()
+        self.vocabulary.extend(self.pending)
+        self.vocabulary.sort()
+        self.pending = []
+
+    #Adds a patient name. Adding a name that is already in the index only updates how it is displayed.
+    def add(self, name, merge=True):
+        key = normalize_name(name)
+        if not key:
+            return
+        new = key not in self.display_names
+        self.display_names[key] = name.strip()
+        if not new:
+            return
+        for word in set(key.split(' ')):
+            if word not in self.word_keys:
+                self.word_keys[word] = set()
+                self.pending.append(word)
+                for trigram in trigrams(word):
+                    self.word_trigrams.setdefault(trigram, []).append(word)
+            self.word_keys[word].add(key)
+        if merge and len(self.pending) > PENDING_LIMIT:
+            self._merge()
+
+    def _prefix_words(self, prefix):
+        words = []
+        position = bisect.bisect_left(self.vocabulary, prefix)
+        while position < len(self.vocabulary) and len(words) < PREFIX_WORDS:
+            if not self.vocabulary[position].startswith(prefix):
+                break
+            words.append(self.vocabulary[position])
+            position += 1
+        words += [word for word in self.pending if word.startswith(prefix)]
+        return words
+
+    #Known words that are within a few mistakes of the typed word. If is_prefix, the typed word
+    #may be the unfinished start of the known word.
+    def _close_words(self, typed, is_prefix):
+        mistakes = allowed_mistakes(typed)
+        if mistakes == 0:
+            return {}
+        counts = Counter()
+        for trigram in trigrams(typed):
+            counts.update(self.word_trigrams.get(trigram, ()))
+        close = {}
+        for word, count in counts.most_common(FUZZY_CANDIDATES):
+            distance = edit_distance(typed, word[:len(typed) + 1] if is_prefix else word)
+            if is_prefix:
+                distance = min(distance, edit_distance(typed, word[:len(typed)]))
+            if distance <= mistakes:
+                close[word] = distance
+        return close
+
+    #Keys of the names containing any of the words
+    def _keys_of(self, words):
+        if len(words) == 1:
+            return self.word_keys[words[0]]
+        return set().union(*(self.word_keys[word] for word in words))
+
+    #For one typed word: {number of mistakes: [known words]}
+    def _word_options(self, typed, is_prefix):
+        options = {}
+        if is_prefix:
+            exact = self._prefix_words(typed)
+        else:
+            exact = [typed] if typed in self.word_keys else []
+        if exact:
+            options[0] = exact
+        for word, distance in self._close_words(typed, is_prefix).items():
+            if distance > 0 or word not in exact:
+                options.setdefault(distance, []).append(word)
+        return options
+
+    #Returns up to limit names, best first: fewest spelling mistakes, then names that start with
+    #what was typed, then shorter names
+    def search(self, text, limit=SUGGESTIONS):
+        query = normalize_name(text)
+        if not query:
+            return []
+        typed_words = query.split(' ')
+        options = [self._word_options(word, number == len(typed_words) - 1) for number, word in enumerate(typed_words)]
+        if not all(options):
+            return []
+
+        found = []
+        seen = set()
+        # Try the combinations of mistakes per word, fewest total mistakes first
+        levels = sorted(itertools.product(*[sorted(option) for option in options]), key=sum)
+        for level in levels:
+            words_per_typed_word = [options[number][distance] for number, distance in enumerate(level)]
+            if len(words_per_typed_word) == 1:
+                # One typed word: take names in vocabulary order until there are enough to rank
+                matches = []
+                for key in (key for word in words_per_typed_word[0] for key in self.word_keys[word]):
+                    if key not in seen:
+                        seen.add(key)
+                        matches.append(key)
+                        if len(matches) >= limit * 8:
+                            break
+            else:
+                # Several typed words: the names must contain all of them (a set intersection, done in C)
+                keys_per_typed_word = sorted((self._keys_of(words) for words in words_per_typed_word), key=len)
+                matches = list(keys_per_typed_word[0].intersection(*keys_per_typed_word[1:]) - seen)
+                seen.update(matches)
+            matches.sort(key=lambda key: (not key.startswith(query), len(key), key))
+            found += matches
+            if len(found) >= limit:
+                break
+        return [self.display_names[key] for key in found[:limit]]
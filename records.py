@@ -0,0 +1,196 @@
+# Patient record store for the Vital Signs app.
+# Every visit used to be written to "<patient name>_vital_signs.docx", overwriting the previous one,
+# and recall worked only by rebuilding that file name. Records now live in one SQLite database:
+# every encounter is kept with a timestamp, and lookups by patient id or by name use an index,
+# so recall stays fast with millions of encounters. A Word document is only made on request (export_docx).
+
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from instrumentation import timed
+
+RECORDS_PATH = 'patient_records.sqlite3'
+VITALS_COLUMNS = ['bp', 'temperature', 'pulse_rate', 'oxygen_sat', 'respiratory_rate', 'summary']
+ENCOUNTER_COLUMNS = ['id', 'patient_id', 'patient_name', 'recorded_at'] + VITALS_COLUMNS + ['hospital', 'location']
+
+
+#Turns a patient's name into the key it is indexed by: lower case, no accents, single spaces.
+#"Ama  Mensah" and "ama mensah" find the same patient.
+def normalize_name(name):
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(character for character in name if not unicodedata.combining(character))
+    return re.sub(r'\s+', ' ', name.lower()).strip()
+
+
+class RecordStore:
+    def __init__(self, path=RECORDS_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS encounters ('
+            'id INTEGER PRIMARY KEY, patient_id TEXT NOT NULL, patient_name TEXT, name_key TEXT NOT NULL, '
+            'recorded_at REAL NOT NULL, bp TEXT, temperature TEXT, pulse_rate TEXT, oxygen_sat TEXT, '
+            'respiratory_rate TEXT, summary TEXT, hospital TEXT, location TEXT)'
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS encounters_patient ON encounters (patient_id, recorded_at)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS encounters_name ON encounters (name_key, recorded_at)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS encounters_time ON encounters (recorded_at)')
+        self.connection.commit()
+
+    def _row(self, vitals, hospital, location, patient_id, recorded_at):
+        name = vitals.get('patient_name', '')
+        return (
+            patient_id or vitals.get('patient_id') or normalize_name(name),
+            name,
+            normalize_name(name),
+            recorded_at or time.time(),
+            *[vitals.get(column, '') for column in VITALS_COLUMNS],
+            hospital,
+            location,
+        )
+
+    #Saves one encounter and returns its id. vitals is the usual dictionary with patient_name, bp, etc.
+    #Patients without an id are identified by their normalized name.
+    def save_encounter(self, vitals, hospital=None, location=None, patient_id=None, recorded_at=None):
+        row = self._row(vitals, hospital, location, patient_id, recorded_at)
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT INTO encounters (patient_id, patient_name, name_key, recorded_at, bp, temperature, '
+                'pulse_rate, oxygen_sat, respiratory_rate, summary, hospital, location) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self.connection.commit()
+            return cursor.lastrowid
+
+    #Saves many encounters in one transaction. Each item is (vitals, hospital, location).
+    def save_many(self, encounters):
+        rows = [self._row(vitals, hospital, location, None, None) for vitals, hospital, location in encounters]
+        with self.lock:
+            self.connection.executemany(
+                'INSERT INTO encounters (patient_id, patient_name, name_key, recorded_at, bp, temperature, '
+                'pulse_rate, oxygen_sat, respiratory_rate, summary, hospital, location) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.connection.commit()
+
+    def _select(self, where, parameters, limit):
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT {", ".join(ENCOUNTER_COLUMNS)} FROM encounters WHERE {where} '
+                'ORDER BY recorded_at DESC, id DESC LIMIT ?', (*parameters, limit)).fetchall()
+        return [dict(zip(ENCOUNTER_COLUMNS, row)) for row in rows]
+
+    #All encounters of a patient, newest first
+    def history(self, patient_name, limit=100):
+        return self._select('name_key = ?', (normalize_name(patient_name),), limit)
+
+    def history_by_id(self, patient_id, limit=100):
+        return self._select('patient_id = ?', (patient_id,), limit)
+
+    #The most recent encounter of a patient, or None if we have never seen them
+    def latest(self, patient_name):
+        encounters = self.history(patient_name, limit=1)
+        return encounters[0] if encounters else None
+
+    def _range(self, since, until, hospital):
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append('recorded_at >= ?')
+            parameters.append(since)
+        if until is not None:
+            conditions.append('recorded_at < ?')
+            parameters.append(until)
+        if hospital is not None:
+            conditions.append('hospital = ?')
+            parameters.append(hospital)
+        return conditions, parameters
+
+    #Every encounter recorded from since (included) to until (excluded), oldest first, in lists of at most
+    #batch encounters. Each list is a separate query, so the store is not locked while the caller works
+    #and only one list is in memory at a time.
+    def iter_encounters(self, since=None, until=None, hospital=None, batch=1000):
+        conditions, parameters = self._range(since, until, hospital)
+        after = None
+        while True:
+            where = list(conditions)
+            values = list(parameters)
+            if after is not None:
+                where.append('(recorded_at > ? OR (recorded_at = ? AND id > ?))')
+                values += [after[0], after[0], after[1]]
+            with self.lock:
+                rows = self.connection.execute(
+                    f'SELECT {", ".join(ENCOUNTER_COLUMNS)} FROM encounters '
+                    f'{"WHERE " + " AND ".join(where) if where else ""} '
+                    'ORDER BY recorded_at, id LIMIT ?', (*values, batch)).fetchall()
+            if not rows:
+                return
+            yield [dict(zip(ENCOUNTER_COLUMNS, row)) for row in rows]
+            after = (rows[-1][3], rows[-1][0])  # recorded_at and id of the last one
+
+    #How many encounters iter_encounters would return
+    def count_between(self, since=None, until=None, hospital=None):
+        conditions, parameters = self._range(since, until, hospital)
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM encounters ' + ('WHERE ' + ' AND '.join(conditions) if conditions else ''),
+                parameters).fetchone()[0]
+
+    #The name of every patient in the store, as typed at their latest encounter
+    def patient_names(self):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT patient_name, MAX(recorded_at) FROM encounters GROUP BY name_key').fetchall()
+        return [row[0] for row in rows]
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM encounters').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+#The title and the lines of one encounter in a report, in the same layout the app has always used.
+#export_docx and the bulk export (bulk_export.py) both write these.
+def encounter_lines(encounter):
+    # Title with patient's name
+    title = f"Patient Vital Signs - {encounter['patient_name']}"
+
+    # Vital signs information
+    lines = [
+        f"Recorded: {time.strftime('%Y-%m-%d %H:%M', time.localtime(encounter['recorded_at']))}",
+        f"Patient Name: {encounter['patient_name']}",
+        f"Blood pressure (mmHg): {encounter['bp']}",
+        f"Temperature: {encounter['temperature']}",
+        f"Pulse rate: {encounter['pulse_rate']}",
+        f"Oxygen Saturation: {encounter['oxygen_sat']}",
+        f"Respiratory rate: {encounter['respiratory_rate']}",
+        f"Summary of condition: {encounter['summary']}",
+    ]
+    if encounter.get('hospital'):
+        lines.append(f"Sent to: {encounter['hospital']}")
+    return title, lines
+
+
+#Writes encounters to a Word document and returns its path
+@timed('export.docx')
+def export_docx(encounters, path):
+    from docx import Document
+
+    doc = Document()
+    for encounter in encounters:
+        title, lines = encounter_lines(encounter)
+        doc.add_heading(title, level=1)
+        for line in lines:
+            doc.add_paragraph(line)
+
+    # Save the document
+    doc.save(path)
+    return path
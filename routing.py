@@ -0,0 +1,392 @@
+# Offline road routing for the Vital Signs app.
+# haversine_distance measures a straight line, so a hospital across a river or a lagoon can look
+# closer than one down the road. This module ranks hospitals by driving time instead, without
+# the network:
+# 1. build: read a local OpenStreetMap extract of Ghana (.osm XML, or .pbf when pyosmium is installed),
+#    keep the drivable roads and turn them into a graph whose edges are travel times in seconds
+# 2. precompute: contraction hierarchies. Nodes are "contracted" one by one from least to most
+#    important; shortcut edges keep the shortest paths that went through them. A query then only
+#    ever searches upwards in importance from both ends, which visits a few hundred nodes instead
+#    of the whole country
+# 3. save: the result is stored as flat NumPy arrays in one .npz file (float32 times, int32 ids)
+# 4. query: travel_times(from, [hospitals]) gives the driving time to each candidate in milliseconds
+#
+#   python routing.py build ghana-latest.osm ghana_roads.npz
+#   python routing.py bench ghana_roads.npz
+
+import heapq
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+
+from matching import PointIndex, haversine_distance
+
+ROUTING_GRAPH_PATH = 'ghana_roads.npz'
+
+#Typical speeds in km/h for the roads an ambulance can use
+ROAD_SPEEDS = {
+    'motorway': 100, 'trunk': 80, 'primary': 65, 'secondary': 55, 'tertiary': 45,
+    'motorway_link': 50, 'trunk_link': 45, 'primary_link': 40, 'secondary_link': 35, 'tertiary_link': 30,
+    'unclassified': 35, 'residential': 25, 'living_street': 10, 'service': 15, 'track': 15, 'road': 30,
+}
+OFF_ROAD_SPEED = 15  # km/h, for the stretch between a place and the nearest road
+WITNESS_SETTLED_LIMIT = 60  # How far a witness search may look before we add the shortcut anyway
+
+
+#Time in seconds to drive distance_km at speed_kmh
+def travel_seconds(distance_km, speed_kmh):
+    return distance_km / speed_kmh * 3600
+
+
+def _oneway(tags):
+    oneway = tags.get('oneway', 'no')
+    if oneway in ('yes', 'true', '1'):
+        return 1
+    if oneway == '-1':
+        return -1
+    if tags.get('highway') == 'motorway' or tags.get('junction') == 'roundabout':
+        return 1
+    return 0
+
+
+#Reads drivable ways from an OpenStreetMap XML file in two passes (ways first, then only the nodes
+#they use), so the whole country's nodes never have to be held in memory.
+#Returns ({osm node id: (lat, long)}, [(road type, oneway, [osm node ids])]).
+def read_osm_xml(path):
+    ways = []
+    for event, element in ElementTree.iterparse(path):
+        if element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            if tags.get('highway') in ROAD_SPEEDS:
+                ways.append((tags['highway'], _oneway(tags), [int(nd.get('ref')) for nd in element.iter('nd')]))
+            element.clear()
+        elif element.tag == 'node':
+            element.clear()
+
+    needed = {node for _, _, nodes in ways for node in nodes}
+    coordinates = {}
+    for event, element in ElementTree.iterparse(path):
+        if element.tag == 'node':
+            node = int(element.get('id'))
+            if node in needed:
+                coordinates[node] = (float(element.get('lat')), float(element.get('lon')))
+            element.clear()
+        elif element.tag == 'way':
+            element.clear()
+    return coordinates, ways
+
+
+#Same as read_osm_xml for .pbf extracts (the format Geofabrik distributes), using pyosmium
+def read_osm_pbf(path):
+    import osmium
+
+    ways = []
+
+    class WayHandler(osmium.SimpleHandler):
+        def way(self, way):
+            tags = dict(way.tags)
+            if tags.get('highway') in ROAD_SPEEDS:
+                ways.append((tags['highway'], _oneway(tags), [node.ref for node in way.nodes]))
+
+    WayHandler().apply_file(path)
+    needed = {node for _, _, nodes in ways for node in nodes}
+    coordinates = {}
+
+    class NodeHandler(osmium.SimpleHandler):
+        def node(self, node):
+            if node.id in needed:
+                coordinates[node.id] = (node.location.lat, node.location.lon)
+
+    NodeHandler().apply_file(path)
+    return coordinates, ways
+
+
+#Turns ways into a road graph. Only junctions and road ends become graph nodes; the points in
+#between only add to the length of the edge.
+#Returns (latitudes, longitudes, [(from, to, seconds)]).
+def build_road_graph(coordinates, ways):
+    uses = {}
+    for _, _, nodes in ways:
+        for node in nodes:
+            uses[node] = uses.get(node, 0) + 1
+        for end in (nodes[0], nodes[-1]):
+            uses[end] = uses.get(end, 0) + 1
+
+    numbers = {}
+    latitudes, longitudes = [], []
+    best = {}
+
+    def number(node):
+        if node not in numbers:
+            numbers[node] = len(latitudes)
+            latitudes.append(coordinates[node][0])
+            longitudes.append(coordinates[node][1])
+        return numbers[node]
+
+    def add_edge(a, b, seconds):
+        if a != b and seconds < best.get((a, b), float('inf')):
+            best[(a, b)] = seconds
+
+    for highway, oneway, nodes in ways:
+        nodes = [node for node in nodes if node in coordinates]
+        if len(nodes) < 2:
+            continue
+        speed = ROAD_SPEEDS[highway]
+        start, seconds = nodes[0], 0.0
+        for previous, node in zip(nodes, nodes[1:]):
+            seconds += travel_seconds(haversine_distance(*coordinates[previous], *coordinates[node]), speed)
+            if uses[node] > 1 or node == nodes[-1]:
+                a, b = number(start), number(node)
+                if oneway >= 0:
+                    add_edge(a, b, seconds)
+                if oneway <= 0:
+                    add_edge(b, a, seconds)
+                start, seconds = node, 0.0
+
+    edges = [(a, b, seconds) for (a, b), seconds in best.items()]
+    return np.array(latitudes), np.array(longitudes), edges
+
+
+#Contraction hierarchies preprocessing. Returns (rank of each node, all edges including shortcuts).
+def contract(node_count, edges, verbose=False):
+    outgoing = [dict() for _ in range(node_count)]
+    incoming = [dict() for _ in range(node_count)]
+    for a, b, seconds in edges:
+        outgoing[a][b] = seconds
+        incoming[b][a] = seconds
+    all_edges = dict(((a, b), seconds) for a, b, seconds in edges)
+    contracted = [False] * node_count
+    contracted_neighbours = [0] * node_count
+    rank = [0] * node_count
+
+    # Is there a path from source to target of at most limit seconds that avoids the node being contracted?
+    def witness_distances(source, avoid, limit, targets):
+        distances = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = 0
+        remaining = set(targets)
+        while heap and remaining and settled < WITNESS_SETTLED_LIMIT:
+            distance, node = heapq.heappop(heap)
+            if distance > distances.get(node, float('inf')):
+                continue
+            if distance > limit:
+                break
+            remaining.discard(node)
+            settled += 1
+            for neighbour, seconds in outgoing[node].items():
+                if neighbour == avoid or contracted[neighbour]:
+                    continue
+                candidate = distance + seconds
+                if candidate < distances.get(neighbour, float('inf')):
+                    distances[neighbour] = candidate
+                    heapq.heappush(heap, (candidate, neighbour))
+        return distances
+
+    def shortcuts_for(node):
+        shortcuts = []
+        sources = [(u, s) for u, s in incoming[node].items() if not contracted[u]]
+        targets = [(w, s) for w, s in outgoing[node].items() if not contracted[w]]
+        if not sources or not targets:
+            return shortcuts
+        longest_out = max(s for _, s in targets)
+        for u, seconds_in in sources:
+            distances = witness_distances(u, node, seconds_in + longest_out, [w for w, _ in targets])
+            for w, seconds_out in targets:
+                if w == u:
+                    continue
+                via = seconds_in + seconds_out
+                if distances.get(w, float('inf')) > via:
+                    shortcuts.append((u, w, via))
+        return shortcuts
+
+    def priority(node):
+        degree = sum(1 for u in incoming[node] if not contracted[u]) + sum(1 for w in outgoing[node] if not contracted[w])
+        return len(shortcuts_for(node)) - degree + contracted_neighbours[node]
+
+    heap = [(priority(node), node) for node in range(node_count)]
+    heapq.heapify(heap)
+    order = 0
+    while heap:
+        _, node = heapq.heappop(heap)
+        if contracted[node]:
+            continue
+        # Lazy update: the priority may be stale, re-check it against the next best node
+        current = priority(node)
+        if heap and current > heap[0][0]:
+            heapq.heappush(heap, (current, node))
+            continue
+
+        for u, w, via in shortcuts_for(node):
+            if via < outgoing[u].get(w, float('inf')):
+                outgoing[u][w] = via
+                incoming[w][u] = via
+                all_edges[(u, w)] = via
+        contracted[node] = True
+        rank[node] = order
+        order += 1
+        for neighbour in list(incoming[node]) + list(outgoing[node]):
+            contracted_neighbours[neighbour] += 1
+        if verbose and order % 10000 == 0:
+            print(f'contracted {order}/{node_count} nodes, {len(all_edges)} edges')
+
+    return rank, [(a, b, seconds) for (a, b), seconds in all_edges.items()]
+
+
+#Packs adjacency lists into flat arrays: the neighbours of node n are targets[offsets[n]:offsets[n + 1]]
+def _to_csr(node_count, edges):
+    edges = sorted(edges)
+    offsets = np.zeros(node_count + 1, dtype=np.int32)
+    for a, _, _ in edges:
+        offsets[a + 1] += 1
+    np.cumsum(offsets, out=offsets)
+    targets = np.array([b for _, b, _ in edges], dtype=np.int32)
+    weights = np.array([seconds for _, _, seconds in edges], dtype=np.float32)
+    return offsets, targets, weights
+
+
+#Builds the routing graph from a road graph and saves it. Edges going up in rank are searched from
+#the patient; edges coming down in rank are searched backwards from each hospital.
+def precompute(latitudes, longitudes, edges, path=ROUTING_GRAPH_PATH, verbose=False):
+    node_count = len(latitudes)
+    rank, all_edges = contract(node_count, edges, verbose)
+    upward = [(a, b, s) for a, b, s in all_edges if rank[a] < rank[b]]
+    downward = [(b, a, s) for a, b, s in all_edges if rank[a] > rank[b]]
+    up_offsets, up_targets, up_weights = _to_csr(node_count, upward)
+    down_offsets, down_targets, down_weights = _to_csr(node_count, downward)
+    np.savez(path, latitudes=np.asarray(latitudes, dtype=np.float64), longitudes=np.asarray(longitudes, dtype=np.float64),
+             up_offsets=up_offsets, up_targets=up_targets, up_weights=up_weights,
+             down_offsets=down_offsets, down_targets=down_targets, down_weights=down_weights)
+    return path
+
+
+#Reads an OpenStreetMap extract and writes the routing graph
+def build(osm_path, path=ROUTING_GRAPH_PATH, verbose=True):
+    start = time.perf_counter()
+    reader = read_osm_pbf if osm_path.endswith('.pbf') else read_osm_xml
+    coordinates, ways = reader(osm_path)
+    latitudes, longitudes, edges = build_road_graph(coordinates, ways)
+    if verbose:
+        print(f'{len(ways)} roads, {len(latitudes)} junctions, {len(edges)} road segments '
+              f'({time.perf_counter() - start:.1f} s)')
+    precompute(latitudes, longitudes, edges, path, verbose)
+    if verbose:
+        print(f'saved {path} ({time.perf_counter() - start:.1f} s)')
+    return path
+
+
+class Router:
+    def __init__(self, path=ROUTING_GRAPH_PATH):
+        graph = np.load(path)
+        self.latitudes = graph['latitudes']
+        self.longitudes = graph['longitudes']
+        self.up = (graph['up_offsets'], graph['up_targets'], graph['up_weights'])
+        self.down = (graph['down_offsets'], graph['down_targets'], graph['down_weights'])
+        self.nodes = PointIndex(self.latitudes, self.longitudes)
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    #The nearest road junction to a place, and the time to get there off-road
+    def snap(self, latitude, longitude):
+        node, distance = self.nodes.nearest(latitude, longitude, k=1)[0]
+        return node, travel_seconds(distance, OFF_ROAD_SPEED)
+
+    # Dijkstra that only follows the given edges (all upward in rank), so it settles few nodes.
+    # With a bound, nodes that are already further than the best known route are not expanded.
+    def _search(self, graph, source, bound=None, meet=None):
+        offsets, targets, weights = graph
+        distances = {source: 0.0}
+        heap = [(0.0, source)]
+        best = float('inf')
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            if meet is not None:
+                if distance >= best:
+                    break
+                if node in meet:
+                    best = min(best, distance + meet[node])
+            start, end = offsets[node], offsets[node + 1]
+            for neighbour, seconds in zip(targets[start:end].tolist(), weights[start:end].tolist()):
+                candidate = distance + seconds
+                if candidate < distances.get(neighbour, float('inf')):
+                    distances[neighbour] = candidate
+                    heapq.heappush(heap, (candidate, neighbour))
+        return best if meet is not None else distances
+
+    #Driving time in seconds between two road junctions (inf if there is no road between them)
+    def node_travel_time(self, source, target, forward=None):
+        if forward is None:
+            forward = self._search(self.up, source)
+        return self._search(self.down, target, meet=forward)
+
+    #Driving times in seconds from one place to many places, each given as (lat, long).
+    #The search upwards from the patient is done once and shared by every hospital.
+    def travel_times(self, latitude, longitude, destinations):
+        source, first_leg = self.snap(latitude, longitude)
+        forward = self._search(self.up, source)
+        times = []
+        for destination_latitude, destination_longitude in destinations:
+            target, last_leg = self.snap(destination_latitude, destination_longitude)
+            times.append(first_leg + self.node_travel_time(source, target, forward) + last_leg)
+        return times
+
+
+#Orders candidate hospitals (from HospitalIndex.nearest) by driving time instead of straight-line distance.
+#Returns (hospital index, seconds) pairs, quickest first.
+def rank_by_travel_time(router, latitude, longitude, candidates, hospitals):
+    destinations = [(hospitals[index][1], hospitals[index][2]) for index, _ in candidates]
+    times = router.travel_times(latitude, longitude, destinations)
+    return sorted(zip([index for index, _ in candidates], times), key=lambda pair: pair[1])
+
+
+#A made-up road network (a grid of roads with a few fast highways) around Ghana, for benchmarks
+def synthetic_road_graph(size=100, seed=0):
+    rng = np.random.default_rng(seed)
+    latitudes = np.repeat(np.linspace(4.8, 11.0, size), size) + rng.normal(0, 0.005, size * size)
+    longitudes = np.tile(np.linspace(-3.0, 1.0, size), size) + rng.normal(0, 0.005, size * size)
+    edges = []
+    for row in range(size):
+        for column in range(size):
+            node = row * size + column
+            for other in ((node + 1) if column + 1 < size else None, (node + size) if row + 1 < size else None):
+                if other is None:
+                    continue
+                highway = row % 10 == 0 or column % 10 == 0
+                speed = ROAD_SPEEDS['trunk'] if highway else ROAD_SPEEDS['unclassified'] * rng.uniform(0.5, 1.0)
+                seconds = travel_seconds(haversine_distance(latitudes[node], longitudes[node],
+                                                            latitudes[other], longitudes[other]), speed)
+                edges.append((node, other, seconds))
+                edges.append((other, node, seconds))
+    return latitudes, longitudes, edges
+
+
+#Times one-to-many queries from random places to 10 random destinations
+def benchmark(path=ROUTING_GRAPH_PATH, queries=200, destinations=10, seed=1):
+    router = Router(path)
+    rng = np.random.default_rng(seed)
+    latencies = []
+    for _ in range(queries):
+        origin = (rng.uniform(4.8, 11.0), rng.uniform(-3.0, 1.0))
+        targets = list(zip(rng.uniform(4.8, 11.0, destinations), rng.uniform(-3.0, 1.0, destinations)))
+        start = time.perf_counter()
+        router.travel_times(*origin, targets)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    print(f'{len(router)} junctions, {queries} one-to-{destinations} queries: '
+          f'p50 {latencies[len(latencies) // 2]:.2f} ms, p99 {latencies[int(len(latencies) * 0.99)]:.2f} ms')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'build':
+        build(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else ROUTING_GRAPH_PATH)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        benchmark(sys.argv[2] if len(sys.argv) > 2 else ROUTING_GRAPH_PATH)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'synthetic':
+        precompute(*synthetic_road_graph(int(sys.argv[2]) if len(sys.argv) > 2 else 100),
+                   sys.argv[3] if len(sys.argv) > 3 else ROUTING_GRAPH_PATH, verbose=True)
+    else:
+        print('usage: python routing.py build <extract.osm|.pbf> [graph.npz] | bench [graph.npz] | synthetic [size] [graph.npz]')
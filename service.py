@@ -0,0 +1,266 @@
+# HTTP service for the dispatch center.
+# Serves the same dispatch core as the Kivy app (dispatch.py) as JSON over HTTP, so a dispatch center
+# can send patients programmatically:
+#   POST /vitals                {"vitals": {...}, "location": "Madina", "wait": 0}  whole dispatch
+#   POST /match                 {"location": "Madina", "k": 3, "capabilities": ["icu"]}  nearest hospitals with free
+#                               beds (and those services), nothing reserved
+#   POST /beds                  {"hospital": "Korle Bu Teaching Hospital", "available_beds": 4}  a hospital's bed report
+#                               ("id" instead of "hospital" for a name several hospitals share, see /match)
+#   GET  /patients?q=ama+mens   patient name suggestions
+#   GET  /patients/<name>       latest encounter (?history=N for the last N)
+#   GET  /submissions/<key>     whether the hospital has accepted a submission
+#   POST /readings              [{"patient_id": "amb-12", "pulse_rate": 88, "oxygen_sat": 94, ...}, ...]  monitor readings
+#   GET  /readings/<patient_id> rolling vitals and NEWS2 early-warning score of a monitored patient
+#   GET  /at-risk?min=5         monitored patients with a NEWS2 score of at least min, highest first
+#   GET  /stats                 outbox, bed, geocoding and monitor counters
+#   GET  /metrics               stage timings and counters in the Prometheus text format
+#   GET  /traces                the last dispatches stage by stage (?slowest=1 for the slowest, &limit=N)
+#   POST /exports               {"since": "2026-10-01", "until": "12h", "hospital": "...", "format": "csv"}  starts a
+#                               bulk export of the records (see bulk_export.py)
+#   GET  /exports/<id>          how far an export has got, and its files when it is finished
+# The server runs on asyncio (aiohttp), so hundreds of open requests cost very little. The dispatch
+# stages themselves block (SQLite, geocoding), so they run on a thread pool; the event loop only
+# reads requests and writes responses.
+# Run with: python service.py [port] [host]
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from aiohttp import web
+
+import instrumentation
+from bulk_export import parse_time
+from dispatch import DispatchCore, DELIVERY_TIMEOUT, clean_vitals
+from hospital_registry import CAPABILITIES, capability_mask, facility_id
+
+SERVICE_THREADS = 32
+DEFAULT_PORT = 8080
+MAX_MATCHES = 20
+
+
+def error_response(status, message):
+    return web.json_response({'error': message}, status=status)
+
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+#Runs a blocking dispatch-core call on the service's thread pool
+async def run_blocking(request, function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app['executor'], partial(function, *args, **kwargs))
+
+
+async def post_vitals(request):
+    data = await read_json(request)
+    if data is None:
+        return error_response(400, 'the body must be a JSON object')
+    vitals, problem = clean_vitals(data.get('vitals'))
+    if problem:
+        return error_response(400, problem)
+    location = str(data.get('location') or '').strip()
+    if not location:
+        return error_response(400, 'location is required')
+    try:
+        # By default the request does not wait for the hospital; the outbox delivers in the background
+        wait = min(float(data.get('wait', 0)), DELIVERY_TIMEOUT)
+    except (TypeError, ValueError):
+        return error_response(400, 'wait must be a number of seconds')
+
+    result = await run_blocking(request, request.app['core'].dispatch, vitals, location, delivery_timeout=wait)
+    status = {'dispatched': 201, 'location_not_found': 404, 'no_free_bed': 409}[result['status']]
+    return web.json_response(result, status=status)
+
+
+async def post_match(request):
+    data = await read_json(request)
+    if data is None:
+        return error_response(400, 'the body must be a JSON object')
+    location = str(data.get('location') or '').strip()
+    if not location:
+        return error_response(400, 'location is required')
+    try:
+        k = max(1, min(int(data.get('k', 3)), MAX_MATCHES))
+    except (TypeError, ValueError):
+        return error_response(400, 'k must be a whole number')
+    services = data.get('capabilities') or []
+    if not isinstance(services, list) or any(service not in CAPABILITIES for service in services):
+        return error_response(400, f'capabilities must be a list of: {", ".join(CAPABILITIES)}')
+
+    found = await run_blocking(request, request.app['core'].nearest_hospitals, location, k, capability_mask(services))
+    if found is None:
+        return error_response(404, 'location not found')
+    latitude, longitude, candidates = found
+    return web.json_response({
+        'location': location,
+        'latitude': latitude,
+        'longitude': longitude,
+        'hospitals': [{'hospital': hospital[0], 'id': facility_id(hospital[0], hospital[1], hospital[2]),
+                       'distance_km': distance, 'available_beds': beds}
+                      for hospital, distance, beds in candidates],
+    })
+
+
+async def post_beds(request):
+    data = await read_json(request)
+    if data is None:
+        return error_response(400, 'the body must be a JSON object')
+    try:
+        beds = int(data.get('available_beds'))
+        sent_at = float(data['updated_at']) if data.get('updated_at') is not None else None
+    except (TypeError, ValueError):
+        return error_response(400, 'available_beds must be a whole number and updated_at a time')
+    hospital = str(data.get('id') or data.get('hospital') or '')
+    if not await run_blocking(request, request.app['core'].update_beds, hospital, beds, sent_at):
+        return error_response(404, f'unknown hospital {hospital} (a name several hospitals share needs their id)')
+    return web.json_response({'hospital': hospital, 'available_beds': beds})
+
+
+async def get_suggestions(request):
+    text = request.query.get('q', '')
+    names = await run_blocking(request, request.app['core'].suggest_patients, text)
+    return web.json_response({'query': text, 'patients': names})
+
+
+async def get_patient(request):
+    name = request.match_info['name']
+    core = request.app['core']
+    if 'history' in request.query:
+        try:
+            limit = max(1, min(int(request.query['history']), 1000))
+        except ValueError:
+            return error_response(400, 'history must be a whole number')
+        encounters = await run_blocking(request, core.history, name, limit)
+    else:
+        encounter = await run_blocking(request, core.recall, name)
+        encounters = [encounter] if encounter else []
+    if not encounters:
+        return error_response(404, f'no record found for {name}')
+    return web.json_response({'patient_name': name, 'encounters': encounters})
+
+
+async def get_submission(request):
+    key = request.match_info['key']
+    status = await run_blocking(request, request.app['core'].outbox.status, key)
+    if status == 'unknown':
+        return error_response(404, f'unknown submission {key}')
+    return web.json_response({'submission_key': key, 'status': status})
+
+
+async def post_readings(request):
+    try:
+        readings = await request.json()
+    except ValueError:
+        readings = None
+    if not isinstance(readings, list) or not all(isinstance(reading, dict) for reading in readings):
+        return error_response(400, 'the body must be a JSON list of readings')
+    if any(reading.get('patient_id') in (None, '') for reading in readings):
+        return error_response(400, 'every reading needs a patient_id')
+    taken = await run_blocking(request, request.app['core'].ingest_readings, readings)
+    return web.json_response({'received': len(readings), 'taken': taken})
+
+
+async def get_readings(request):
+    patient_id = request.match_info['patient_id']
+    summary = await run_blocking(request, request.app['core'].stream_summary, patient_id)
+    if summary is None:
+        return error_response(404, f'no readings for {patient_id}')
+    return web.json_response(summary)
+
+
+async def get_at_risk(request):
+    try:
+        threshold = int(request.query.get('min', 5))
+    except ValueError:
+        return error_response(400, 'min must be a whole number')
+    patients = await run_blocking(request, request.app['core'].at_risk, threshold)
+    return web.json_response({'min': threshold, 'patients': [{'patient_id': patient_id, 'news2': score}
+                                                             for patient_id, score in patients]})
+
+
+async def get_stats(request):
+    return web.json_response(await run_blocking(request, request.app['core'].stats))
+
+
+async def get_metrics(request):
+    gauges = instrumentation.flatten(await run_blocking(request, request.app['core'].stats))
+    return web.Response(text=instrumentation.prometheus_text(gauges), content_type='text/plain',
+                        headers={'X-Prometheus-Format': '0.0.4'})
+
+
+async def get_traces(request):
+    try:
+        limit = max(1, min(int(request.query.get('limit', 20)), instrumentation.RECENT_TRACES))
+    except ValueError:
+        return error_response(400, 'limit must be a whole number')
+    slowest = request.query.get('slowest') in ('1', 'true')
+    return web.json_response({'traces': instrumentation.traces(slowest=slowest, limit=limit)})
+
+
+async def post_export(request):
+    data = await read_json(request)
+    if data is None:
+        return error_response(400, 'the body must be a JSON object')
+    hospital = data.get('hospital')
+    if hospital is not None and not isinstance(hospital, str):
+        return error_response(400, 'hospital must be text')
+    try:
+        since, until = parse_time(data.get('since')), parse_time(data.get('until'))
+        export = await run_blocking(request, request.app['core'].start_export, since, until, hospital,
+                                    data.get('format', 'csv'))
+    except ValueError as error:
+        return error_response(400, str(error))
+    return web.json_response(export, status=202)
+
+
+async def get_export(request):
+    export = request.app['core'].export_progress(request.match_info['export_id'])
+    if export is None:
+        return error_response(404, 'no such export')
+    return web.json_response(export)
+
+
+#Builds the web application around a dispatch core. The core is started with the application and
+#closed with it.
+def make_app(core=None, threads=SERVICE_THREADS, bed_feed_path=None):
+    app = web.Application()
+    app['core'] = core or DispatchCore()
+    app['executor'] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='service')
+
+    async def start(app):
+        app['core'].start(bed_feed_path)
+
+    async def stop(app):
+        app['executor'].shutdown(wait=True)
+        app['core'].close()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    app.router.add_post('/vitals', post_vitals)
+    app.router.add_post('/match', post_match)
+    app.router.add_post('/beds', post_beds)
+    app.router.add_get('/patients', get_suggestions)
+    app.router.add_get('/patients/{name}', get_patient)
+    app.router.add_get('/submissions/{key}', get_submission)
+    app.router.add_post('/readings', post_readings)
+    app.router.add_get('/readings/{patient_id}', get_readings)
+    app.router.add_get('/at-risk', get_at_risk)
+    app.router.add_get('/stats', get_stats)
+    app.router.add_get('/metrics', get_metrics)
+    app.router.add_get('/traces', get_traces)
+    app.router.add_post('/exports', post_export)
+    app.router.add_get('/exports/{export_id}', get_export)
+    return app
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    host = sys.argv[2] if len(sys.argv) > 2 else '127.0.0.1'
+    web.run_app(make_app(bed_feed_path='bed_feed.csv'), host=host, port=port)
@@ -0,0 +1,305 @@
+# End-to-end load simulator for the dispatch service.
+# Benchmarks (benchmarks.py) time one stage at a time. This drives the whole flow the way a national
+# surge would: ambulances send vitals and locations, the service geocodes, matches, reserves a bed,
+# queues the form and saves the record, and hospitals discharge patients and report their free beds.
+#
+# Everything runs locally, in several processes:
+# - this process hosts the stand-in hospitals (forms that count their beds) and the stand-in Nominatim,
+#   and sends the hospitals' bed reports, late by a configurable lag, like a real feed
+# - one process runs the dispatch service (service.py) around a DispatchCore
+# - several client processes send the dispatches at the time each event is due
+# Events are generated (a Poisson stream over Ghana, optionally with a surge in the middle) or
+# replayed from a JSON lines file, one event per line:
+#   {"t": 0.41, "type": "dispatch", "location": "Kasoa", "vitals": {...}}
+#   {"t": 0.93, "type": "discharge", "hospital": "Facility 12", "patients": 2}
+#
+# The report gives throughput, latency (measured from when each dispatch was due, so a slow service
+# cannot hide its own queueing), over-commit incidents (patients sent to a hospital that had no free
+# bed when they arrived) and, second by second, how the queues built up.
+# Run with:
+#   python simulator.py [dispatches per second] [seconds] [client processes] [feed lag in seconds]
+#   python simulator.py generate events.jsonl [dispatches per second] [seconds]
+#   python simulator.py replay events.jsonl [client processes] [feed lag in seconds]
+
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from benchmarks import FIRST_NAMES, SURNAMES, GHANA_LATITUDES, GHANA_LONGITUDES, synthetic_registry
+from geocoding import load_gazetteer, GAZETTEER_PATH
+from outbox import percentiles
+from stand_ins import StandInFormServer, StandInNominatim, stand_in_geocoder
+
+HOSPITALS = 300
+PLACES = 3000  # Made-up places only the stand-in Nominatim knows, on top of the gazetteer towns
+DISCHARGE_RATE = 0.6  # Discharges per dispatch, so beds slowly run out during a surge
+SURGE = (0.4, 0.6, 3.0)  # Between 40% and 60% of the run, dispatches come three times as fast
+FEED_LAG = 2.0  # Seconds between a hospital's bed count changing and the service hearing about it
+CLIENT_PROCESSES = 4
+SAMPLE_INTERVAL = 1.0
+
+
+#Time-stamped events for a run of the given length, sorted by time
+def generate_events(rate, seconds, hospitals, seed=0, surge=SURGE, discharge_rate=DISCHARGE_RATE):
+    generator = random.Random(seed)
+    places = [f'place {number}' for number in range(PLACES)]
+    towns = list(load_gazetteer(GAZETTEER_PATH)) or places
+    events = []
+    now = 0.0
+    number = 0
+    while True:
+        surge_start, surge_end, factor = surge
+        current_rate = rate * factor if surge_start * seconds <= now < surge_end * seconds else rate
+        now += generator.expovariate(current_rate)
+        if now >= seconds:
+            break
+        number += 1
+        # Most dispatches come from the towns everyone knows, the rest from anywhere in the country
+        location = generator.choice(towns) if generator.random() < 0.7 else generator.choice(places)
+        vitals = {'patient_name': f'{generator.choice(FIRST_NAMES)} {generator.choice(SURNAMES)} {number}',
+                  'bp': f'{generator.randint(90, 180)}/{generator.randint(50, 110)}',
+                  'temperature': f'{generator.uniform(35.5, 40.5):.1f}',
+                  'pulse_rate': str(generator.randint(45, 160)),
+                  'oxygen_sat': str(generator.randint(82, 100)),
+                  'respiratory_rate': str(generator.randint(8, 35)),
+                  'summary': 'Simulated dispatch'}
+        events.append({'t': now, 'type': 'dispatch', 'location': location, 'vitals': vitals})
+        if generator.random() < discharge_rate:
+            events.append({'t': now, 'type': 'discharge', 'hospital': generator.choice(hospitals)[0],
+                           'patients': generator.choice([1, 1, 1, 2, 3])})
+    return events
+
+
+def save_events(events, path):
+    with open(path, 'w') as file:
+        for event in events:
+            file.write(json.dumps(event) + '\n')
+
+
+def load_events(path):
+    with open(path) as file:
+        return sorted((json.loads(line) for line in file if line.strip()), key=lambda event: event['t'])
+
+
+#The stand-in places, reproducible in every process from the same seed
+def stand_in_places(seed=0):
+    generator = random.Random(seed)
+    return {f'place {number}': (generator.uniform(*GHANA_LATITUDES), generator.uniform(*GHANA_LONGITUDES))
+            for number in range(PLACES)}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+#The dispatch service process
+def run_service(port, hospitals, directory, nominatim_domain):
+    from aiohttp import web
+    from dispatch import DispatchCore
+    from geocoding import GeocodingResolver
+    from service import make_app
+
+    geocoder = GeocodingResolver(os.path.join(directory, 'geocode_cache.sqlite3'),
+                                 geocoder=stand_in_geocoder(nominatim_domain))
+    core = DispatchCore(hospitals, records_path=os.path.join(directory, 'patient_records.sqlite3'),
+                        outbox_path=os.path.join(directory, 'outbox.sqlite3'), routing_path=None, geocoder=geocoder,
+                        tiles_path=os.path.join(directory, 'coverage_tiles.npz'))
+    web.run_app(make_app(core), host='127.0.0.1', port=port, print=None, handle_signals=True)
+
+
+#A client process: sends its dispatches when they are due and returns one result per dispatch
+#(due at, latency in seconds, HTTP status, hospital) through the queue
+def run_client(url, events, start_at, in_flight, results):
+    from aiohttp import ClientSession, TCPConnector
+
+    async def send(session, event):
+        due = start_at + event['t']
+        with in_flight.get_lock():
+            in_flight.value += 1
+        try:
+            async with session.post(f'{url}/vitals', json={'vitals': event['vitals'], 'location': event['location']}) as response:
+                body = await response.json()
+                status = response.status
+        except Exception as error:
+            body, status = {}, type(error).__name__
+        with in_flight.get_lock():
+            in_flight.value -= 1
+        return event['t'], time.time() - due, status, body.get('hospital')
+
+    async def replay():
+        async with ClientSession(connector=TCPConnector(limit=0)) as session:
+            tasks = []
+            for event in events:
+                delay = start_at + event['t'] - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(send(session, event)))
+            return await asyncio.gather(*tasks)
+
+    results.put(asyncio.run(replay()))
+
+
+def wait_for_service(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f'{url}/stats', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f'The dispatch service at {url} did not start')
+
+
+#Applies the discharges at the stand-in hospitals when they are due, and sends each hospital's
+#new bed count to the service feed_lag seconds later
+def run_hospitals(url, forms, form_ids, events, start_at, feed_lag, stopping):
+    session = requests.Session()
+    reports = []  # (send at, hospital, free beds, counted at)
+    pending = iter(events)
+    event = next(pending, None)
+    while not stopping.is_set() and (event is not None or reports):
+        now = time.time()
+        while event is not None and start_at + event['t'] <= now:
+            free = forms.discharge(form_ids[event['hospital']], event['patients'])
+            reports.append((now + feed_lag, event['hospital'], free, now))
+            event = next(pending, None)
+        while reports and reports[0][0] <= now:
+            send_at, hospital, free, counted_at = reports.pop(0)
+            session.post(f'{url}/beds', json={'hospital': hospital, 'available_beds': free, 'updated_at': counted_at})
+        stopping.wait(0.01)
+
+
+def simulate(events, client_processes=CLIENT_PROCESSES, feed_lag=FEED_LAG, hospitals=None, verbose=True):
+    hospitals = hospitals or synthetic_registry(HOSPITALS)
+    dispatches = [event for event in events if event['type'] == 'dispatch']
+    discharges = [event for event in events if event['type'] == 'discharge']
+    duration = events[-1]['t'] if events else 0
+
+    with tempfile.TemporaryDirectory() as directory, StandInFormServer() as forms, \
+            StandInNominatim(stand_in_places()) as nominatim:
+        # Every hospital is a stand-in form that knows how many beds it really has free
+        form_ids = {}
+        for number, hospital in enumerate(hospitals):
+            form_ids[hospital[0]] = f'hospital-{number}'
+            hospital[4] = forms.form_link(form_ids[hospital[0]])
+            forms.set_beds(form_ids[hospital[0]], hospital[3])
+
+        # Fresh interpreters for the service and the clients, rather than forks of this threaded process
+        context = multiprocessing.get_context('spawn')
+        port = free_port()
+        url = f'http://127.0.0.1:{port}'
+        service = context.Process(target=run_service, args=(port, hospitals, directory, nominatim.domain))
+        service.start()
+        try:
+            wait_for_service(url)
+            in_flight = context.Value('i', 0)
+            results = context.Queue()
+            start_at = time.time() + 1.0
+            clients = [context.Process(target=run_client,
+                                               args=(url, dispatches[number::client_processes], start_at, in_flight, results))
+                       for number in range(client_processes)]
+            for client in clients:
+                client.start()
+            stopping = threading.Event()
+            feed = threading.Thread(target=run_hospitals,
+                                    args=(url, forms, form_ids, discharges, start_at, feed_lag, stopping), daemon=True)
+            feed.start()
+
+            # Every second: how many dispatches are waiting for an answer, and how the outbox is doing
+            timeline = []
+            finished = []
+            while len(finished) < client_processes:
+                try:
+                    finished.append(results.get(timeout=SAMPLE_INTERVAL))
+                    continue
+                except queue.Empty:
+                    pass
+                stats = requests.get(f'{url}/stats', timeout=10).json()
+                timeline.append((time.time() - start_at, in_flight.value, stats['outbox']['depth'],
+                                 stats['beds']['held'], len(forms.responses)))
+                if verbose:
+                    second, waiting, depth, held, delivered = timeline[-1]
+                    print(f'{second:7.1f} s  waiting for the service {waiting:6}  outbox {depth:6}  '
+                          f'beds held {held:5}  forms delivered {delivered:7}', flush=True)
+            for client in clients:
+                client.join()
+            elapsed = time.time() - start_at
+
+            # Let the outbox deliver what it has queued, so every patient has arrived before counting
+            deadline = time.time() + 60
+            while time.time() < deadline and requests.get(f'{url}/stats', timeout=10).json()['outbox']['depth'] > 0:
+                time.sleep(0.2)
+            stopping.set()
+            feed.join()
+            final = requests.get(f'{url}/stats', timeout=10).json()
+        finally:
+            service.terminate()
+            service.join()
+
+        outcomes = [outcome for result in finished for outcome in result]
+        report = {
+            'dispatches': len(dispatches),
+            'events_seconds': duration,
+            'elapsed_seconds': elapsed,
+            'throughput': len(outcomes) / elapsed if elapsed else 0.0,
+            'statuses': dict(Counter(str(outcome[2]) for outcome in outcomes)),
+            'latency_ms': {point: value * 1000 for point, value in
+                           percentiles([outcome[1] for outcome in outcomes], (50, 90, 99, 99.9)).items()},
+            'overcommit_incidents': sum(forms.overcommitted.values()),
+            'overcommitted_hospitals': len(forms.overcommitted),
+            'forms_delivered': len(forms.responses),
+            'outbox': final['outbox'],
+            'bed_update_latency': final['beds']['update_latency'],
+            'timeline': timeline,
+        }
+    return report
+
+
+def print_report(report):
+    print()
+    print(f"Dispatches        {report['dispatches']} over {report['events_seconds']:.1f} s of events, "
+          f"done in {report['elapsed_seconds']:.1f} s")
+    print(f"Throughput        {report['throughput']:.1f} dispatches/s")
+    print(f"Responses         {report['statuses']}  (201 dispatched, 404 place unknown, 409 no free bed)")
+    print('Latency           ' + '  '.join(f'{point} {value:.1f} ms' for point, value in report['latency_ms'].items()))
+    print(f"Over-commits      {report['overcommit_incidents']} patients arrived to no free bed, "
+          f"at {report['overcommitted_hospitals']} hospitals")
+    print(f"Forms delivered   {report['forms_delivered']}, outbox latency {report['outbox']['latency']}")
+    depths = [sample[2] for sample in report['timeline']]
+    waiting = [sample[1] for sample in report['timeline']]
+    print(f"Queues            most waiting for the service {max(waiting, default=0)}, "
+          f"deepest outbox {max(depths, default=0)}")
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    if arguments[:1] == ['generate'] and len(arguments) >= 2:
+        rate = float(arguments[2]) if len(arguments) > 2 else 50
+        seconds = float(arguments[3]) if len(arguments) > 3 else 30
+        save_events(generate_events(rate, seconds, synthetic_registry(HOSPITALS)), arguments[1])
+    elif arguments[:1] == ['replay'] and len(arguments) >= 2:
+        print_report(simulate(load_events(arguments[1]),
+                              int(arguments[2]) if len(arguments) > 2 else CLIENT_PROCESSES,
+                              float(arguments[3]) if len(arguments) > 3 else FEED_LAG))
+    elif not arguments or arguments[0].replace('.', '', 1).isdigit():
+        rate = float(arguments[0]) if len(arguments) > 0 else 50
+        seconds = float(arguments[1]) if len(arguments) > 1 else 30
+        print_report(simulate(generate_events(rate, seconds, synthetic_registry(HOSPITALS)),
+                              int(arguments[2]) if len(arguments) > 2 else CLIENT_PROCESSES,
+                              float(arguments[3]) if len(arguments) > 3 else FEED_LAG))
+    else:
+        print('usage: python simulator.py [rate] [seconds] [clients] [feed lag] | '
+              'generate events.jsonl [rate] [seconds] | replay events.jsonl [clients] [feed lag]')
@@ -0,0 +1,227 @@
+# Local stand-ins for the outside services the app talks to.
+# They let the submission code, the benchmarks and the simulators run without a network or
+# real Google Forms. Nothing in the app itself uses this module.
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+STAND_IN_ENTRY_IDS = [1000001 + number for number in range(7)]
+
+
+class _FormHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real Google Forms endpoint
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', content_type='text/html'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not re.search(r'/forms/d/e/[^/]+/viewform', self.path):
+            self._reply(404)
+            return
+        # Google Forms lists its questions as entry.<id>; the order matches the order on the page
+        form_id = self.path.split('/')[-2]
+        entry_ids = STAND_IN_ENTRY_IDS[:self.server.questions.get(form_id, len(STAND_IN_ENTRY_IDS))]
+        inputs = ''.join(f'<input type="text" name="entry.{entry_id}">' for entry_id in entry_ids)
+        self._reply(200, f'<html><body><form id="mG61Hd">{inputs}</form></body></html>'.encode())
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode()
+        if not re.search(r'/forms/d/e/[^/]+/formResponse', self.path):
+            self._reply(404)
+            return
+        if self.server.fail_next > 0:
+            with self.server.lock:
+                self.server.fail_next -= 1
+            self._reply(503)
+            return
+        form_id = self.path.split('/')[-2]
+        with self.server.lock:
+            self.server.responses.append({
+                'path': self.path,
+                'fields': {key: values[0] for key, values in parse_qs(body).items()},
+                'idempotency_key': self.headers.get('Idempotency-Key'),
+                'received_at': time.time(),
+            })
+            # The patient arrives at the hospital: takes a free bed, or is one too many
+            if form_id in self.server.free_beds:
+                if self.server.free_beds[form_id] > 0:
+                    self.server.free_beds[form_id] -= 1
+                else:
+                    self.server.overcommitted[form_id] = self.server.overcommitted.get(form_id, 0) + 1
+        self._reply(200, b'<html><body>Your response has been recorded.</body></html>')
+
+
+class StandInFormServer:
+    #A Google Forms look-alike on localhost. form_link(name) gives a viewform link for a fake form,
+    #every POST to formResponse is kept in .responses, and fail_next makes the next N posts fail with 503.
+    #set_questions(name, n) makes a form show only its first n questions.
+    #Forms can also stand for hospitals with beds: set_beds(name, n) gives the hospital n free beds,
+    #every submission then takes one, and submissions that find no free bed are counted in .overcommitted.
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), _FormHandler)
+        self.server.daemon_threads = True
+        self.server.responses = []
+        self.server.fail_next = 0
+        self.server.questions = {}
+        self.server.free_beds = {}
+        self.server.overcommitted = {}
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def responses(self):
+        return self.server.responses
+
+    @property
+    def overcommitted(self):
+        return self.server.overcommitted
+
+    def set_beds(self, form_id, beds):
+        with self.server.lock:
+            self.server.free_beds[form_id] = beds
+
+    #Patients left the hospital. Returns how many beds it has free now.
+    def discharge(self, form_id, patients=1):
+        with self.server.lock:
+            self.server.free_beds[form_id] = self.server.free_beds.get(form_id, 0) + patients
+            return self.server.free_beds[form_id]
+
+    def free_beds(self, form_id):
+        with self.server.lock:
+            return self.server.free_beds.get(form_id, 0)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def form_link(self, form_id='stand-in'):
+        return f'{self.url}/forms/d/e/{form_id}/viewform'
+
+    def fail(self, count):
+        self.server.fail_next = count
+
+    def set_questions(self, form_id, questions):
+        self.server.questions[form_id] = questions
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+#A geopy client for a StandInNominatim at domain ("host:port"), for example in another process
+def stand_in_geocoder(domain):
+    from geopy.geocoders import Nominatim
+
+    return Nominatim(user_agent='stand-in', domain=domain, scheme='http').geocode
+
+
+class _NominatimHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != '/search':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        query = parse_qs(url.query).get('q', [''])[0]
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.queries += 1
+            failing = self.server.fail_next > 0
+            if failing:
+                self.server.fail_next -= 1
+        if failing:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        coordinates = self.server.places.get(query.strip().lower())
+        places = []
+        if coordinates is not None:
+            places.append({'lat': str(coordinates[0]), 'lon': str(coordinates[1]), 'display_name': query})
+        body = json.dumps(places).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInNominatim:
+    #A Nominatim look-alike on localhost that knows the places it is given ({name: (lat, long)}, names
+    #in lower case). delay adds a fixed wait to every answer, like a slow network, and fail_next makes the
+    #next N queries fail with 503. Use geocoder() as the geocoder of a GeocodingResolver.
+    def __init__(self, places=None, delay=0.0, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), _NominatimHandler)
+        self.server.daemon_threads = True
+        self.server.places = dict(places or {})
+        self.server.delay = delay
+        self.server.queries = 0
+        self.server.fail_next = 0
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def places(self):
+        return self.server.places
+
+    @property
+    def queries(self):
+        return self.server.queries
+
+    @property
+    def domain(self):
+        host, port = self.server.server_address[:2]
+        return f'{host}:{port}'
+
+    def fail(self, count):
+        self.server.fail_next = count
+
+    #A geopy client pointed at this server, without the rate limit the real Nominatim needs
+    def geocoder(self):
+        return stand_in_geocoder(self.domain)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,34 @@
+# Startup profiling for the Vital Signs app.
+# Cold start matters most on low-end Android phones, where every import is several times slower than
+# on a laptop. Start the app with VITALS_PROFILE_STARTUP=1 and it prints how long each startup stage
+# took (imports, dispatch core, first screen, first frame), then quits, with exit code 1 if the
+# total went over the budget (VITALS_STARTUP_BUDGET seconds, 1.5 by default).
+# For a module-by-module breakdown of the imports, run python -X importtime on the app.
+# This module must stay tiny and only use the standard library, since it is imported first.
+
+import os
+import time
+
+PROFILE = os.environ.get('VITALS_PROFILE_STARTUP') == '1'
+STARTUP_BUDGET = float(os.environ.get('VITALS_STARTUP_BUDGET', 1.5))
+
+started = time.perf_counter()
+marks = []
+
+
+#Records that a startup stage has just finished
+def mark(stage):
+    marks.append((stage, time.perf_counter()))
+
+
+#Prints every stage and the total, and returns True if startup stayed within the budget
+def report(budget=STARTUP_BUDGET):
+    previous = started
+    print('Startup profile')
+    for stage, at in marks:
+        print(f'  {stage:28} {(at - previous) * 1000:8.1f} ms   (at {(at - started) * 1000:8.1f} ms)')
+        previous = at
+    total = (marks[-1][1] if marks else previous) - started
+    within = total <= budget
+    print(f'  {"total":28} {total * 1000:8.1f} ms   budget {budget * 1000:.0f} ms: {"ok" if within else "OVER BUDGET"}')
+    return within
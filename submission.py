@@ -0,0 +1,229 @@
+# Sending a patient's vitals to the hospital's Google Form.
+# The app used to start a headless Chrome for every patient, wait a fixed 2 seconds, fill seven
+# inputs found by absolute XPaths, click submit and wait again. That costs seconds and hundreds of MB
+# of memory per patient. A Google Form is just an HTML form, so HttpFormSubmitter posts the fields
+# straight to its formResponse endpoint over one pooled keep-alive session instead.
+# Selenium is kept as an optional fallback (SeleniumFormSubmitter) for forms whose questions the HTTP
+# path cannot find. It is not used when the form cannot be reached or refuses the post: Chrome would
+# not do better, and starting it for every retry during an outage costs more than the retry.
+# The Idempotency-Key header is sent for endpoints that honour it, but Google Forms ignores it: a post
+# that reached the form and then timed out is posted again on retry, and the form gets the response twice.
+
+import re
+import threading
+import time
+
+from instrumentation import count, timed
+
+#The vitals in the same order as the questions on the hospital's form
+VITALS_FIELDS = ['patient_name', 'bp', 'temperature', 'pulse_rate', 'oxygen_sat', 'respiratory_rate', 'summary']
+POOL_SIZE = 16
+REQUEST_TIMEOUT = 10
+
+
+class SubmissionError(Exception):
+    pass
+
+
+#The form page was read, but its questions could not be matched to the vitals
+class FormNotUnderstood(SubmissionError):
+    pass
+
+
+#Turns the link people share (…/viewform) into the link the form posts to (…/formResponse)
+def form_response_url(google_form_link):
+    link = google_form_link.split('?')[0].rstrip('/')
+    if link.endswith('/formResponse'):
+        return link
+    if link.endswith('/viewform'):
+        link = link[:-len('/viewform')]
+    return link + '/formResponse'
+
+
+#Reads the form page and returns {vitals field: "entry.<id>"}. The entry ids appear in the page in
+#the same order as the questions, which is the order of VITALS_FIELDS.
+def discover_field_mapping(session, google_form_link, timeout=REQUEST_TIMEOUT):
+    try:
+        response = session.get(google_form_link, timeout=timeout)
+        response.raise_for_status()
+    except OSError as error:  # requests.RequestException is an OSError, and so is a link that is not a URL
+        raise SubmissionError(f'Could not read the form {google_form_link}: {error}') from error
+    entry_ids = []
+    for entry_id in re.findall(r'entry\.(\d+)', response.text):
+        if entry_id not in entry_ids:
+            entry_ids.append(entry_id)
+    if len(entry_ids) < len(VITALS_FIELDS):
+        raise FormNotUnderstood(f'Expected {len(VITALS_FIELDS)} questions on {google_form_link}, found {len(entry_ids)}')
+    return {field: f'entry.{entry_id}' for field, entry_id in zip(VITALS_FIELDS, entry_ids)}
+
+
+class HttpFormSubmitter:
+    def __init__(self, pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # Requests is only imported and the session only opened when the first form is sent,
+        # so they cost nothing while the app starts
+        self._session = None
+        # Field mappings are looked up once per form and then reused
+        self.field_mappings = {}
+        self.lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is not None:
+            return self._session
+        with self.lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    #field_mapping is the hospital's cached mapping. If it is empty it is filled in place, so the
+    #hospital entry keeps it for next time.
+    def mapping_for(self, google_form_link, field_mapping=None):
+        if field_mapping:
+            return field_mapping
+        with self.lock:
+            mapping = self.field_mappings.get(google_form_link)
+        if mapping is None:
+            mapping = discover_field_mapping(self.session, google_form_link, self.timeout)
+            with self.lock:
+                self.field_mappings[google_form_link] = mapping
+        if field_mapping is not None:
+            field_mapping.update(mapping)
+        return mapping
+
+    @timed('submission.http')
+    def submit(self, google_form_link, vitals, field_mapping=None, idempotency_key=None):
+        mapping = self.mapping_for(google_form_link, field_mapping)
+        data = {mapping[field]: vitals.get(field, '') for field in VITALS_FIELDS if field in mapping}
+        headers = {'Idempotency-Key': idempotency_key} if idempotency_key else {}
+        session = self.session
+        try:
+            response = session.post(form_response_url(google_form_link), data=data, headers=headers,
+                                    timeout=self.timeout)
+        except OSError as error:  # requests.RequestException is an OSError
+            raise SubmissionError(f'Could not reach {google_form_link}: {error}') from error
+        if response.status_code >= 400:
+            raise SubmissionError(f'{google_form_link} answered {response.status_code}')
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+class SeleniumFormSubmitter:
+    #The original way of filling the form: a headless Chrome and the XPaths of each question.
+    #Selenium is only imported when this fallback is actually used.
+    XPATHS = [
+        '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[1]/div/div/div[2]/div/div[1]/div/div[1]/input',
+        '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[2]/div/div/div[2]/div/div[1]/div/div[1]/input',
+        '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[3]/div/div/div[2]/div/div[1]/div/div[1]/input',
+        '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[4]/div/div/div[2]/div/div[1]/div/div[1]/input',
+        '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[5]/div/div/div[2]/div/div[1]/div/div[1]/input',
+        '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[6]/div/div/div[2]/div/div[1]/div/div[1]/input',
+        '//*[@id="mG61Hd"]/div[2]/div/div[2]/div[7]/div/div/div[2]/div/div[1]/div[2]/textarea',
+    ]
+    SUBMIT_XPATH = '//*[@id="mG61Hd"]/div[2]/div/div[3]/div[1]/div[1]/div/span/span'
+
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+
+    @timed('submission.selenium')
+    def submit(self, google_form_link, vitals, field_mapping=None, idempotency_key=None):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        options = Options()
+        options.add_argument("--headless")
+        options.add_argument("--disable-gpu")
+
+        web = None
+        try:
+            #Initialize web browser (fails here when Chrome or its driver is missing)
+            web = webdriver.Chrome(options=options)
+            web.get(google_form_link)
+            # Wait until the form is there instead of sleeping a fixed 2 seconds
+            WebDriverWait(web, self.timeout).until(lambda driver: driver.find_elements("xpath", self.XPATHS[0]))
+
+            #Enter details
+            for field, xpath in zip(VITALS_FIELDS, self.XPATHS):
+                web.find_element("xpath", xpath).send_keys(vitals.get(field, ''))
+
+            #Submit form
+            web.find_element("xpath", self.SUBMIT_XPATH).click()
+            WebDriverWait(web, self.timeout).until(lambda driver: 'formResponse' in driver.current_url)
+        except Exception as error:
+            raise SubmissionError(f'Chrome could not fill {google_form_link}: {error}') from error
+        finally:
+            if web is not None:
+                web.quit()
+
+    def close(self):
+        pass
+
+
+class FormSubmitter:
+    #Tries the next backend only when one could not understand the form, so Selenium runs for forms
+    #the direct HTTP post cannot fill, and not for network errors or a form that is down
+    def __init__(self, backends=None, use_selenium_fallback=True):
+        if backends is None:
+            backends = [HttpFormSubmitter()]
+            if use_selenium_fallback:
+                backends.append(SeleniumFormSubmitter())
+        self.backends = backends
+
+    def submit(self, google_form_link, vitals, field_mapping=None, idempotency_key=None):
+        errors = []
+        for backend in self.backends:
+            try:
+                backend.submit(google_form_link, vitals, field_mapping, idempotency_key)
+                return
+            except FormNotUnderstood as error:
+                count('submission.fallback')
+                errors.append(str(error))
+            except SubmissionError as error:
+                errors.append(str(error))
+                break
+        raise SubmissionError('; '.join(errors))
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+
+
+#Submits the same patient many times against the local stand-in form and prints submissions per second
+#for each backend. Selenium is only measured when Chrome is installed.
+def compare_throughput(submissions=200):
+    from concurrent.futures import ThreadPoolExecutor
+    from stand_ins import StandInFormServer
+
+    vitals = {'patient_name': 'Test Patient', 'bp': '120/80', 'temperature': '36.8', 'pulse_rate': '72',
+              'oxygen_sat': '98', 'respiratory_rate': '16', 'summary': 'Benchmark'}
+    with StandInFormServer() as server:
+        link = server.form_link()
+        backends = [('http (1 thread)', HttpFormSubmitter(), 1), ('http (8 threads)', HttpFormSubmitter(), 8),
+                    ('selenium', SeleniumFormSubmitter(), 1)]
+        for name, backend, threads in backends:
+            count = submissions if name.startswith('http') else 5
+            try:
+                backend.submit(link, vitals)  # Warm up (and look up the field mapping)
+                start = time.perf_counter()
+                with ThreadPoolExecutor(threads) as pool:
+                    list(pool.map(lambda number: backend.submit(link, vitals), range(count)))
+                elapsed = time.perf_counter() - start
+                print(f'{name:18} {count / elapsed:10.1f} submissions/s  {elapsed / count * 1000:8.2f} ms each')
+            except Exception as error:
+                print(f'{name:18} skipped ({type(error).__name__})')
+            backend.close()
+
+
+if __name__ == '__main__':
+    compare_throughput()
@@ -0,0 +1,93 @@
+# Checks the mass-casualty batch assignment (assignment.py) against every possible assignment of small
+# batches, and that it respects bed counts and triage priority.
+# Run with: python -m pytest test_assignment.py
+
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+from assignment import assign_greedy, assign_patients, PRIORITY_WEIGHTS, UNASSIGNED_KM
+from matching import haversine_distance, haversine_matrix
+
+
+def random_batch(generator, patients, hospitals):
+    places = [(generator.uniform(5.4, 5.8), generator.uniform(-0.4, 0.0)) for number in range(patients)]
+    latitudes = [generator.uniform(5.4, 5.8) for number in range(hospitals)]
+    longitudes = [generator.uniform(-0.4, 0.0) for number in range(hospitals)]
+    beds = [generator.choice([0, 1, 1, 2, 3]) for number in range(hospitals)]
+    priorities = [generator.choice([1, 2, 3]) for number in range(patients)]
+    return places, latitudes, longitudes, beds, priorities
+
+
+def cost(assignments, places, latitudes, longitudes, priorities):
+    total = 0.0
+    for (hospital, distance), place, priority in zip(assignments, places, priorities):
+        weight = PRIORITY_WEIGHTS[priority]
+        if hospital is None:
+            total += UNASSIGNED_KM * weight
+        else:
+            total += haversine_distance(place[0], place[1], latitudes[hospital], longitudes[hospital]) * weight
+    return total
+
+
+#The best assignment the slow way: every way of giving each patient a bed or no bed
+def best_cost(places, latitudes, longitudes, beds, priorities):
+    slots = [hospital for hospital, count in enumerate(beds) for bed in range(count)]
+    options = slots + [None] * len(places)
+    best = None
+    for chosen in itertools.permutations(range(len(options)), len(places)):
+        assignments = [(options[option], 0) for option in chosen]
+        total = cost(assignments, places, latitudes, longitudes, priorities)
+        best = total if best is None else min(best, total)
+    return best
+
+
+def check_beds(assignments, beds):
+    used = [hospital for hospital, distance in assignments if hospital is not None]
+    for hospital, count in enumerate(beds):
+        assert used.count(hospital) <= count
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_every_possible_assignment(seed):
+    generator = random.Random(seed)
+    places, latitudes, longitudes, beds, priorities = random_batch(generator, generator.randint(1, 4), 4)
+    assignments = assign_patients(places, latitudes, longitudes, beds, priorities, candidate_hospitals=2)
+    check_beds(assignments, beds)
+    assert cost(assignments, places, latitudes, longitudes, priorities) == pytest.approx(
+        best_cost(places, latitudes, longitudes, beds, priorities))
+
+
+def test_distances_and_greedy():
+    generator = random.Random(7)
+    places, latitudes, longitudes, beds, priorities = random_batch(generator, 60, 40)
+    assignments = assign_patients(places, latitudes, longitudes, beds, priorities)
+    greedy = assign_greedy(places, latitudes, longitudes, beds)
+    check_beds(assignments, beds)
+    check_beds(greedy, beds)
+    for (hospital, distance), place in zip(assignments, places):
+        if hospital is not None:
+            assert distance == pytest.approx(haversine_distance(*place, latitudes[hospital], longitudes[hospital]))
+    assert cost(assignments, places, latitudes, longitudes, priorities) <= cost(
+        greedy, places, latitudes, longitudes, priorities) + 1e-6
+
+
+def test_least_urgent_left_without_a_bed():
+    places = [(5.60, -0.20), (5.61, -0.20), (5.62, -0.20)]
+    assignments = assign_patients(places, [5.60], [-0.19], [2], priorities=[3, 1, 2])
+    assert assignments[0] == (None, None)
+    assert assignments[1][0] == 0 and assignments[2][0] == 0
+
+
+def test_no_beds_or_no_patients():
+    assert assign_patients([(5.6, -0.2)], [5.6], [-0.2], [0]) == [(None, None)]
+    assert assign_patients([], [5.6], [-0.2], [3]) == []
+
+
+def test_haversine_matrix():
+    matrix = haversine_matrix([5.6, 9.4], [-0.2, -0.8], [5.5, 6.7, 10.0], [-0.3, -1.6, -2.5])
+    assert matrix.shape == (2, 3)
+    assert matrix[1, 2] == pytest.approx(haversine_distance(9.4, -0.8, 10.0, -2.5))
+    assert np.all(matrix > 0)
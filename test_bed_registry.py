@@ -0,0 +1,237 @@
+# Checks the live bed registry (bed_registry.py): reservations, their expiry, feed updates, reloads of the
+# hospital list, and that dispatches racing for the last beds never get more beds than there are.
+# Run with: python -m pytest test_bed_registry.py
+
+import json
+import threading
+import time
+
+import pytest
+
+from bed_registry import BedRegistry, RegistryRetired
+from dispatch import DispatchCore
+from geocoding import GeocodingResolver
+from hospital_registry import capability_mask
+from matching import HospitalIndex
+
+
+def make_hospitals():
+    return [['Ridge', 5.5600, -0.2000, 2, 'Google Form Link 1'],
+            ['Korle Bu', 5.5364, -0.2275, 1, 'Google Form Link 2'],
+            ['Tamale Teaching', 9.4034, -0.8424, 5, 'Google Form Link 3']]
+
+
+@pytest.fixture
+def registry():
+    return BedRegistry(make_hospitals())
+
+
+def test_reserve_confirm_release(registry):
+    first = registry.reserve(0)
+    second = registry.reserve(0)
+    assert first and second and first != second
+    assert registry.available(0) == 0
+    assert registry.reserve(0) is None
+
+    assert registry.release(first)
+    assert registry.available(0) == 1
+    assert registry.confirm(second)
+    assert registry.beds[0] == 1 and registry.available(0) == 1  # The confirmed bed is taken for good
+    assert not registry.confirm(second) and not registry.release(first)  # Only once
+    stats = registry.registry_stats()
+    assert (stats['reservations'], stats['rejected'], stats['confirmed'], stats['released']) == (2, 1, 1, 1)
+
+
+def test_reservations_expire(registry):
+    registry.reserve(1, ttl=0.05)
+    assert registry.reserve(1) is None
+    time.sleep(0.1)
+    late = registry.reserve(1)
+    assert late is not None  # The unconfirmed hold gave its bed back
+    assert registry.registry_stats()['expired'] == 1
+    assert registry.confirm(late)
+    assert registry.available(1) == 0
+
+
+def test_expired_holds_are_given_back_before_matching():
+    hospitals = make_hospitals()
+    registry = BedRegistry(hospitals)
+    index = HospitalIndex(hospitals)
+    registry.add_listener(index.set_available_beds)
+    registry.reserve(1, ttl=0.05)
+    assert index.nearest(5.5364, -0.2275)[0][0] == 0  # Korle Bu looks full while its bed is held
+    time.sleep(0.1)
+    # The index is only asked after the expired hold has been dropped, so Korle Bu is found again
+    assert registry.reserve_nearest(index, 5.5364, -0.2275)[0] == 1
+
+
+def test_reports_older_than_a_confirmation(registry):
+    registry.confirm(registry.reserve(2))
+    registry.confirm(registry.reserve(2))
+    assert registry.beds[2] == 3
+
+    # Tamale sent "5 free" before our two patients arrived: they are not counted in it yet
+    assert registry.apply_update('Tamale Teaching', 5, sent_at=time.time() - 60)
+    assert registry.beds[2] == 3
+    # A report sent after them already counts them
+    assert registry.apply_update('Tamale Teaching', 4, sent_at=time.time())
+    assert registry.beds[2] == 4
+    # Without a time the report is taken as it is
+    registry.apply_update('Tamale Teaching', 6)
+    assert registry.beds[2] == 6
+
+
+def test_listeners_keep_the_index_in_step():
+    hospitals = make_hospitals()
+    registry = BedRegistry(hospitals)
+    index = HospitalIndex(hospitals)
+    registry.add_listener(index.set_available_beds)
+
+    # Korle Bu is nearest to this patient, but has one bed
+    first = registry.reserve_nearest(index, 5.5364, -0.2275)
+    second = registry.reserve_nearest(index, 5.5364, -0.2275)
+    assert (first[0], second[0]) == (1, 0)
+    assert index.nearest(5.5364, -0.2275)[0][0] == 0
+    registry.release(first[2])
+    assert index.nearest(5.5364, -0.2275)[0][0] == 1
+
+
+def test_racing_dispatches_never_overcommit():
+    hospitals = make_hospitals()
+    registry = BedRegistry(hospitals)
+    index = HospitalIndex(hospitals)
+    registry.add_listener(index.set_available_beds)
+    results = []
+
+    def dispatch():
+        result = registry.reserve_nearest(index, 5.55, -0.21)
+        results.append(result)
+
+    threads = [threading.Thread(target=dispatch) for number in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    taken = [result[0] for result in results if result is not None]
+    assert len(taken) == 8  # Every bed once, and nobody got a bed that was not there
+    assert taken.count(0) == 2 and taken.count(1) == 1 and taken.count(2) == 5
+    assert sum(registry.held) == 8
+
+
+def test_feed_updates(registry, tmp_path):
+    assert registry.apply_update('Ridge', 7, sent_at=time.time())
+    assert registry.available(0) == 7
+    assert not registry.apply_update('Nowhere Clinic', 3)
+
+    csv_feed = tmp_path / 'beds.csv'
+    csv_feed.write_text('name,available_beds,updated_at\nKorle Bu,4,\nRidge,7,\nNowhere Clinic,9,\n')
+    assert registry.load_feed(str(csv_feed)) == 2  # The clinic is unknown
+    assert registry.beds == [7, 4, 5]
+    registry.confirm(registry.reserve(1))
+    assert registry.load_feed(str(csv_feed)) == 0  # Rows already applied are not applied again
+    assert registry.beds == [7, 3, 5]
+
+    jsonl_feed = tmp_path / 'beds.jsonl'
+    jsonl_feed.write_text(json.dumps({'name': 'Tamale Teaching', 'available_beds': 0}) + '\n')
+    assert registry.load_feed(str(jsonl_feed)) == 1
+    assert registry.available(2) == 0
+    assert registry.registry_stats()['update_latency']['p50'] is not None
+
+
+def test_watch_file(registry, tmp_path):
+    feed = tmp_path / 'beds.csv'
+    feed.write_text('name,available_beds\nRidge,9\n')
+    registry.watch_file(str(feed), interval=0.02)
+    try:
+        deadline = time.time() + 5
+        while registry.beds[0] != 9 and time.time() < deadline:
+            time.sleep(0.02)
+        assert registry.beds[0] == 9
+    finally:
+        registry.stop()
+
+
+def test_adopt_on_reload():
+    previous = BedRegistry(make_hospitals())
+    kept = previous.reserve(0)
+    dropped = previous.reserve(1)
+    previous.apply_update('Tamale Teaching', 3)
+
+    # The new list has Ridge and Tamale in another order, no Korle Bu, and a new clinic
+    reloaded = [['Tamale Teaching', 9.4034, -0.8424, 9, 'Google Form Link 3'],
+                ['Madina Polyclinic', 5.6685, -0.1657, 4, 'Google Form Link 4'],
+                ['Ridge', 5.5600, -0.2000, 9, 'Google Form Link 1']]
+    registry = BedRegistry(reloaded)
+    with previous.lock:
+        registry.adopt(previous)
+    assert registry.beds == [3, 4, 2]  # Live counts win over the reloaded list, new facilities keep theirs
+    assert registry.held == [0, 0, 1]
+    assert registry.confirm(kept) and registry.beds[2] == 1
+    assert not registry.confirm(dropped)  # Its facility is gone
+    assert registry.reserve(2) not in (kept, dropped)  # Reservation ids keep counting
+
+
+def test_replaced_registry_is_retired():
+    previous = BedRegistry(make_hospitals())
+    held = previous.reserve(0)
+    registry = BedRegistry(make_hospitals())
+    with previous.lock:
+        registry.adopt(previous)
+    # A dispatch still holding the old registry cannot take or settle a bed on it any more
+    for operation in (lambda: previous.reserve(1), lambda: previous.confirm(held), lambda: previous.release(held),
+                      lambda: previous.apply_update('Ridge', 5)):
+        with pytest.raises(RegistryRetired):
+            operation()
+    assert registry.confirm(held)
+
+
+def test_dispatch_core_reload(tmp_path):
+    core = DispatchCore(make_hospitals(), records_path=str(tmp_path / 'records.sqlite3'),
+                        outbox_path=str(tmp_path / 'outbox.sqlite3'), routing_path=None,
+                        geocoder=GeocodingResolver(None, None, geocoder=lambda name: None),
+                        tiles_path=str(tmp_path / 'tiles.npz'))
+    previous = core.bed_registry
+    held = previous.reserve(1)
+    core.reload_hospitals(make_hospitals()[::-1])
+    assert core.bed_registry is not previous and previous.retired
+    assert core.confirm(held)  # Confirmed on the registry that replaced the one it was made on
+    assert core.bed_registry.beds == [5, 0, 2]
+    assert sum(core.bed_registry.held) == 0
+    core.close()
+
+
+def test_hospitals_sharing_a_name(tmp_path):
+    hospitals = [['Ridge', 5.5600, -0.2000, 2, 'Google Form Link 1', {}, ['oxygen']],
+                 ['Korle Bu', 5.5364, -0.2275, 1, 'Google Form Link 2'],
+                 ['Ridge', 9.4000, -0.8500, 4, 'Google Form Link 4', {}, ['icu']]]
+    registry = BedRegistry(hospitals)
+    accra, tamale = registry.ids[0], registry.ids[2]
+    assert accra != tamale
+    assert registry.find(tamale) == 2 and registry.find('Korle Bu') == 1
+    assert registry.find('Ridge') is None  # Which Ridge is meant has to be said with its id
+    assert not registry.apply_update('Ridge', 7)
+    assert registry.apply_update(tamale, 7) and registry.beds == [2, 1, 7]
+
+    feed = tmp_path / 'bed_feed.jsonl'
+    feed.write_text(json.dumps({'id': accra, 'name': 'Ridge', 'available_beds': 0}) + '\n' +
+                    json.dumps({'name': 'Ridge', 'available_beds': 9}) + '\n', encoding='utf-8')
+    assert registry.load_feed(str(feed)) == 1 and registry.beds == [0, 1, 7]
+
+    # Each keeps its own beds and reservations through a reload
+    held = registry.reserve(2)
+    reloaded = BedRegistry(hospitals[::-1])
+    with registry.lock:
+        reloaded.adopt(registry)
+    assert reloaded.beds == [7, 1, 0] and reloaded.held == [1, 0, 0]
+
+    gazetteer = tmp_path / 'localities.csv'
+    gazetteer.write_text('name,latitude,longitude\nOsu,5.5560,-0.1820\n')
+    core = DispatchCore(hospitals, records_path=str(tmp_path / 'records.sqlite3'),
+                        outbox_path=str(tmp_path / 'outbox.sqlite3'), routing_path=None,
+                        geocoder=GeocodingResolver(None, str(gazetteer), geocoder=lambda name: None),
+                        tiles_path=str(tmp_path / 'tiles.npz'))
+    assert not core.offers(hospitals[0], capability_mask('icu')) and core.offers(hospitals[2], capability_mask('icu'))
+    [(location, name, distance, reason)] = core.assign_mass_casualty([('Osu', 1)])
+    assert (name, reason) == ('Ridge', None) and distance < 5
+    assert core.bed_registry.beds == [1, 1, 4]  # The bed was taken at the Ridge in Accra
+    core.close()
@@ -0,0 +1,98 @@
+# Checks the bulk export (bulk_export.py): which encounters a time window and a hospital select, the CSV
+# table, and the Word documents, which must read back like export_docx's.
+# Run with: python -m pytest test_bulk_export.py
+
+import csv
+import importlib.util
+import os
+
+import pytest
+
+from bulk_export import export_encounters, parse_time
+from records import RecordStore
+
+DAY = 86400
+START = 1790812800  # 2026-10-01 00:00 UTC
+
+
+@pytest.fixture
+def store(tmp_path):
+    records = RecordStore(str(tmp_path / 'records.sqlite3'))
+    for number in range(30):
+        vitals = {'patient_name': f'Patient {number}', 'bp': f'{100 + number}/70', 'temperature': '36.8',
+                  'pulse_rate': '72', 'oxygen_sat': '98', 'respiratory_rate': '16',
+                  'summary': 'Line one\nLine two\x07' if number == 0 else 'Stable'}
+        records.save_encounter(vitals, hospital='Ridge' if number % 3 else 'Korle Bu', location='Madina',
+                               recorded_at=START + number * DAY / 10)
+    yield records
+    records.close()
+
+
+def read_table(path):
+    with open(path, newline='', encoding='utf-8') as file:
+        return list(csv.DictReader(file))
+
+
+def test_parse_time():
+    now = START + 5 * DAY
+    assert parse_time('12h', now) == now - 12 * 3600
+    assert parse_time('1.5d', now) == now - 1.5 * DAY
+    assert parse_time('30d ago', now) == parse_time('30 d', now) == now - 30 * DAY
+    assert parse_time(START) == START
+    assert parse_time(None) is None and parse_time('') is None
+    assert parse_time('2026-10-01') == parse_time('2026-10-01 00:00')
+    with pytest.raises(ValueError):
+        parse_time('last week')
+
+
+def test_time_window_and_hospital(store, tmp_path):
+    # since is included and until is not: encounters 5 to 14
+    report = export_encounters(store, str(tmp_path / 'window'), START + DAY / 2, START + 1.5 * DAY, workers=1)
+    rows = read_table(report['table'])
+    assert report['total'] == report['encounters'] == len(rows) == 10
+    assert [row['patient_name'] for row in rows] == [f'Patient {number}' for number in range(5, 15)]
+
+    report = export_encounters(store, str(tmp_path / 'korle-bu'), hospital='Korle Bu', workers=1)
+    assert [row['patient_name'] for row in read_table(report['table'])] == [
+        f'Patient {number}' for number in range(0, 30, 3)]
+
+    report = export_encounters(store, str(tmp_path / 'empty'), START + 10 * DAY, workers=1)
+    assert report['encounters'] == 0 and report['files'] == [] and read_table(report['table']) == []
+
+
+def test_csv_table(store, tmp_path):
+    report = export_encounters(store, str(tmp_path / 'all'), per_file=8, workers=1)
+    rows = read_table(report['table'])
+    assert list(rows[0]) == ['id', 'patient_id', 'patient_name', 'recorded_at', 'bp', 'temperature', 'pulse_rate',
+                             'oxygen_sat', 'respiratory_rate', 'summary', 'hospital', 'location']
+    assert rows[0]['recorded_at'] == '2026-10-01T00:00:00Z'
+    assert rows[0]['summary'] == 'Line one\nLine two\x07'  # The table keeps the text as it was recorded
+    assert rows[1]['bp'] == '101/70' and rows[1]['hospital'] == 'Ridge'
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_documents(store, tmp_path, workers):
+    from docx import Document
+
+    progress = []
+    report = export_encounters(store, str(tmp_path / 'docs'), per_file=8, workers=workers,
+                               progress=lambda done, total: progress.append((done, total)))
+    assert [os.path.basename(path) for path in report['files']] == [
+        'encounters-0001.docx', 'encounters-0002.docx', 'encounters-0003.docx', 'encounters-0004.docx']
+    assert progress[-1] == (30, 30)
+    assert not [name for name in os.listdir(tmp_path / 'docs') if name.endswith('.part')]
+
+    first = [paragraph.text for paragraph in Document(report['files'][0]).paragraphs]
+    assert first[0] == 'Patient Vital Signs - Patient 0'
+    assert 'Summary of condition: Line one\nLine two' in first  # Control characters a .docx cannot hold are dropped
+    assert 'Blood pressure (mmHg): 107/70' in first and 'Sent to: Korle Bu' in first
+    last = [paragraph.text for paragraph in Document(report['files'][-1]).paragraphs]
+    assert sum(text.startswith('Patient Vital Signs') for text in last) == 6
+
+
+@pytest.mark.skipif(importlib.util.find_spec('pyarrow') is not None, reason='pyarrow is installed')
+def test_parquet_needs_pyarrow(store, tmp_path):
+    with pytest.raises(ValueError, match='pyarrow'):
+        export_encounters(store, str(tmp_path / 'parquet'), table_format='parquet')
+    with pytest.raises(ValueError, match='csv, parquet'):
+        export_encounters(store, str(tmp_path / 'xlsx'), table_format='xlsx')
@@ -0,0 +1,135 @@
+# Checks the layers of the geocoding resolver (geocoding.py): memory, the SQLite cache and its time-to-live,
+# the gazetteer, and the network, which is a small fake geocoder that counts its queries.
+# Run with: python -m pytest test_geocoding.py
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from geocoding import GeocodeCache, GeocodingResolver, load_gazetteer
+
+PLACES = {'madina': (5.6685, -0.1657), 'tamale central': (9.4034, -0.8424)}
+
+
+class FakeNominatim:
+    #Answers like geopy's geocode: an object with .latitude and .longitude, or None
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, location_name):
+        self.queries += 1
+        coordinates = PLACES.get(location_name.strip().lower())
+        if coordinates is None:
+            return None
+        return SimpleNamespace(latitude=coordinates[0], longitude=coordinates[1])
+
+
+@pytest.fixture
+def nominatim():
+    return FakeNominatim()
+
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    path = tmp_path / 'localities.csv'
+    path.write_text('name,latitude,longitude\nAccra,5.6037,-0.1870\nKejetia,6.6956,-1.6223\n', encoding='utf-8')
+    return str(path)
+
+
+def resolver(tmp_path, nominatim, gazetteer_path=None):
+    return GeocodingResolver(str(tmp_path / 'cache.sqlite3'), gazetteer_path, nominatim)
+
+
+def test_memory_then_disk(tmp_path, nominatim):
+    first = resolver(tmp_path, nominatim)
+    assert first.resolve('Madina') == pytest.approx(PLACES['madina'])
+    assert first.resolve('  madina, ') == pytest.approx(PLACES['madina'])
+    assert first.stats['network_hits'] == 1 and first.stats['memory_hits'] == 1
+
+    # A new resolver (the app started again) finds it on disk
+    second = resolver(tmp_path, nominatim)
+    assert second.resolve('Madina') == pytest.approx(PLACES['madina'])
+    assert second.stats['disk_hits'] == 1
+    assert nominatim.queries == 1
+
+
+def test_expired_entries_go_back_to_the_network(tmp_path, nominatim):
+    resolver(tmp_path, nominatim).resolve('Tamale Central')
+    later = resolver(tmp_path, nominatim)
+    later.cache.ttl = 0.01
+    time.sleep(0.05)
+    assert later.resolve('Tamale Central') == pytest.approx(PLACES['tamale central'])
+    assert later.stats['disk_hits'] == 0 and later.stats['network_hits'] == 1
+    assert nominatim.queries == 2
+
+
+def test_unknown_names_are_remembered(tmp_path, nominatim):
+    assert resolver(tmp_path, nominatim).resolve('Nowhere Junction') == (None, None)
+    again = resolver(tmp_path, nominatim)
+    assert again.resolve('Nowhere Junction') == (None, None)
+    assert again.stats['disk_hits'] == 1
+    assert nominatim.queries == 1
+
+    # Until they are older than not_found_ttl
+    later = resolver(tmp_path, nominatim)
+    later.cache.not_found_ttl = 0.01
+    time.sleep(0.05)
+    later.resolve('Nowhere Junction')
+    assert nominatim.queries == 2
+
+
+def test_gazetteer_before_network(tmp_path, nominatim, gazetteer):
+    places = resolver(tmp_path, nominatim, gazetteer)
+    assert places.resolve('ACCRA') == pytest.approx((5.6037, -0.1870))
+    assert places.resolve('Kejetiya') == pytest.approx((6.6956, -1.6223))  # Spelt differently
+    assert places.stats['gazetteer_hits'] == 2
+    assert nominatim.queries == 0
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = GeocodeCache(str(tmp_path / 'cache.sqlite3'), max_entries=2, last_used_slack=0)
+    cache.put('madina', PLACES['madina'])
+    cache.put('tamale central', PLACES['tamale central'])
+    time.sleep(0.01)
+    cache.get('madina')
+    cache.put('accra', (5.6037, -0.1870))
+    assert cache.get('madina')[0] and cache.get('accra')[0]
+    assert cache.get('tamale central') == (False, (None, None))
+    cache.close()
+
+
+def test_cache_hits_do_not_write(tmp_path):
+    cache = GeocodeCache(str(tmp_path / 'cache.sqlite3'))
+    cache.put('madina', PLACES['madina'])
+    changes = cache.connection.total_changes
+    for hit in range(100):
+        assert cache.get('madina') == (True, PLACES['madina'])
+    assert cache.connection.total_changes == changes
+
+    # last_used is still kept roughly up to date for eviction
+    cache.last_used_slack = 0
+    time.sleep(0.01)
+    cache.get('madina')
+    assert cache.connection.total_changes == changes + 1
+    cache.close()
+
+
+def test_bundled_gazetteer_from_another_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert load_gazetteer()['accra'] == pytest.approx((5.6037, -0.1870))
+
+
+def test_outages_are_not_remembered(tmp_path):
+    from stand_ins import StandInNominatim
+
+    with StandInNominatim({'madina': PLACES['madina']}) as nominatim:
+        places = resolver(tmp_path, nominatim.geocoder())
+        nominatim.fail(1)
+        assert places.resolve('Madina') == (None, None)
+        assert places.stats['network_errors'] == 1 and places.stats['misses'] == 0
+
+        # Nothing was cached, so the next lookup asks again and gets the answer
+        assert places.resolve('Madina') == pytest.approx(PLACES['madina'])
+        assert nominatim.queries == 2
+        assert resolver(tmp_path, None).resolve('Madina') == pytest.approx(PLACES['madina'])
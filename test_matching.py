@@ -0,0 +1,96 @@
+# Checks the spatial index (matching.py) and the coverage tiles in front of it against a plain scan
+# with haversine_distance, on random registries, random patients and random bed changes.
+# Run with: python -m pytest test_matching.py
+
+import random
+
+import pytest
+
+from coverage_tiles import CoverageTiles
+from hospital_registry import CAPABILITIES, capability_mask
+from matching import haversine_distance, HospitalIndex
+
+GHANA_LATITUDES = (4.7, 11.2)
+GHANA_LONGITUDES = (-3.3, 1.2)
+REQUIREMENTS = [[], ['icu'], ['icu', 'oxygen'], ['trauma', 'surgery'], ['maternity'], ['dialysis', 'ct_scan']]
+
+
+def random_hospitals(count, seed):
+    generator = random.Random(seed)
+    hospitals = []
+    for number in range(count):
+        hospital = [f'Facility {number}', generator.uniform(*GHANA_LATITUDES), generator.uniform(*GHANA_LONGITUDES),
+                    generator.choice([0, 0, 1, 2, 5]), f'Google Form Link {number}', {}]
+        if generator.random() < 0.9:  # The rest have no services listed and count as offering everything
+            hospital.append([service for service in CAPABILITIES if generator.random() < 0.3])
+        hospitals.append(hospital)
+    return hospitals
+
+
+def services_of(hospitals):
+    return [capability_mask(hospital[6] if len(hospital) > 6 else CAPABILITIES) for hospital in hospitals]
+
+
+#The nearest hospitals the slow way: every hospital, one haversine_distance at a time
+def scan(hospitals, services, latitude, longitude, k, min_beds, required):
+    found = []
+    for index, hospital in enumerate(hospitals):
+        if hospital[3] >= min_beds and services[index] & required == required:
+            found.append((haversine_distance(latitude, longitude, hospital[1], hospital[2]), index))
+    return sorted(found)[:k]
+
+
+def check_against_scan(index, hospitals, generator, queries):
+    services = services_of(hospitals)
+    for query in range(queries):
+        latitude, longitude = generator.uniform(*GHANA_LATITUDES), generator.uniform(*GHANA_LONGITUDES)
+        k = generator.randint(1, 8)
+        min_beds = generator.randint(0, 3)
+        required = capability_mask(generator.choice(REQUIREMENTS))
+        expected = scan(hospitals, services, latitude, longitude, k, min_beds, required)
+        found = index.nearest(latitude, longitude, k=k, min_beds=min_beds, required=required)
+        assert [hospital for hospital, distance in found] == [hospital for distance, hospital in expected]
+        for (hospital, distance), (expected_distance, expected_hospital) in zip(found, expected):
+            assert distance == pytest.approx(expected_distance, abs=1e-6)
+
+
+@pytest.mark.parametrize('count, seed', [(1, 1), (40, 2), (1000, 3), (20000, 4)])
+def test_index_matches_scan(count, seed):
+    hospitals = random_hospitals(count, seed)
+    check_against_scan(HospitalIndex(hospitals), hospitals, random.Random(seed), 300)
+
+
+def test_index_follows_bed_changes():
+    hospitals = random_hospitals(2000, 5)
+    index = HospitalIndex(hospitals)
+    generator = random.Random(5)
+    for round in range(5):
+        for change in range(200):
+            index.set_available_beds(generator.randrange(len(hospitals)), generator.choice([0, 1, 3]))
+        check_against_scan(index, hospitals, generator, 100)
+
+
+def test_coverage_tiles_match_scan():
+    hospitals = random_hospitals(5000, 6)
+    index = HospitalIndex(hospitals)
+    tiles = CoverageTiles(index)
+    services = services_of(hospitals)
+    generator = random.Random(6)
+    # Patients come back to the same places, so most answers come from tiles that are already computed
+    places = [(generator.uniform(*GHANA_LATITUDES), generator.uniform(*GHANA_LONGITUDES)) for number in range(50)]
+    for round in range(4):
+        for change in range(100):
+            hospital, beds = generator.randrange(len(hospitals)), generator.choice([0, 1, 3])
+            index.set_available_beds(hospital, beds)
+            tiles.set_available_beds(hospital, beds)
+        for latitude, longitude in places:
+            k = generator.randint(1, 5)
+            required = capability_mask(generator.choice(REQUIREMENTS))
+            expected = scan(hospitals, services, latitude, longitude, k, 1, required)
+            found = tiles.nearest(latitude, longitude, k=k, required=required)
+            assert [hospital for hospital, distance in found] == [hospital for distance, hospital in expected]
+    assert tiles.tile_stats()['hits'] > 0
+
+
+def test_empty_registry():
+    assert HospitalIndex([]).nearest(5.6, -0.2, k=3) == []
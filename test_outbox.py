@@ -0,0 +1,160 @@
+# Checks the store-and-forward outbox (outbox.py): delivery, retries with backoff, giving up, and records that
+# survive a restart. The submitter is a fake that fails as many times as it is told to.
+# Run with: python -m pytest test_outbox.py
+
+import json
+import time
+
+import pytest
+
+from outbox import Outbox
+
+LINK = 'https://docs.google.com/forms/d/e/ridge/viewform'
+VITALS = {'patient_name': 'Ama Mensah', 'bp': '85/50'}
+
+
+class FlakySubmitter:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+        self.attempts = 0
+
+    def submit(self, google_form_link, vitals, field_mapping=None, idempotency_key=None):
+        self.attempts += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('no signal')
+        self.sent.append((google_form_link, vitals, idempotency_key))
+
+
+def make_outbox(tmp_path, submitter, **options):
+    return Outbox(submitter, path=str(tmp_path / 'outbox.sqlite3'), **options)
+
+
+#The records still waiting to be sent (or given up on)
+def pending(outbox):
+    return outbox.connection.execute(
+        "SELECT status, attempts, next_attempt_at, last_error FROM outbox WHERE status != 'sent'").fetchall()
+
+
+def test_delivers_and_remembers(tmp_path):
+    submitter = FlakySubmitter()
+    outbox = make_outbox(tmp_path, submitter)
+    key = outbox.enqueue(LINK, VITALS, idempotency_key='encounter-1')
+    outbox.enqueue(LINK, VITALS, idempotency_key='encounter-1')  # The same record twice is sent once
+    assert outbox.stats['enqueued'] == 1 and outbox.status(key) == 'pending'
+    assert outbox.drain() == 1
+    assert submitter.sent == [(LINK, VITALS, key)]
+    assert pending(outbox) == []
+    assert outbox.queue_stats()['depth'] == 0
+
+    # The key is remembered as sent, without the vitals, and is not sent again
+    assert outbox.status(key) == 'sent' and outbox.status('encounter-2') == 'unknown'
+    assert outbox.connection.execute('SELECT payload FROM outbox').fetchall() == [(None,)]
+    outbox.enqueue(LINK, VITALS, idempotency_key='encounter-1', track=True)
+    assert outbox.drain() == 0 and outbox.wait(key, timeout=0) and outbox.waiters == {}
+    outbox.close()
+
+
+def test_sent_records_are_pruned(tmp_path):
+    submitter = FlakySubmitter()
+    outbox = make_outbox(tmp_path, submitter, sent_retention=0.05, base_backoff=10)
+    sent = outbox.enqueue(LINK, VITALS)
+    outbox.drain()
+    submitter.failures = 1
+    failing = outbox.enqueue(LINK, VITALS)
+    outbox.drain()
+    time.sleep(0.1)
+    assert outbox.prune() == 1
+    assert outbox.status(sent) == 'unknown' and outbox.status(failing) == 'pending'
+    outbox.close()
+
+
+def test_failures_back_off(tmp_path):
+    submitter = FlakySubmitter(failures=2)
+    outbox = make_outbox(tmp_path, submitter, base_backoff=0.2)
+    outbox.enqueue(LINK, VITALS)
+    started = time.time()
+    outbox.drain()
+    [(status, attempts, next_attempt_at, last_error)] = pending(outbox)
+    assert (status, attempts, last_error) == ('pending', 1, 'no signal')
+    assert started + 0.1 <= next_attempt_at <= time.time() + 0.2  # base_backoff with jitter
+
+    # Nothing is sent again before the retry is due
+    assert outbox.drain() == 0 and submitter.attempts == 1
+    time.sleep(0.25)
+    outbox.drain()
+    [(status, attempts, next_attempt_at, last_error)] = pending(outbox)
+    assert attempts == 2 and next_attempt_at - time.time() > 0.1  # The second wait is twice as long
+    time.sleep(0.45)
+    outbox.drain()
+    assert len(submitter.sent) == 1 and pending(outbox) == []
+    outbox.close()
+
+
+def test_gives_up(tmp_path):
+    submitter = FlakySubmitter(failures=10)
+    outbox = make_outbox(tmp_path, submitter, base_backoff=0, max_attempts=3)
+    key = outbox.enqueue(LINK, VITALS, idempotency_key='encounter-3', track=True)
+    for attempt in range(5):
+        outbox.drain()
+    assert submitter.attempts == 3
+    assert outbox.status(key) == 'failed' and not outbox.wait(key, timeout=0) and outbox.waiters == {}
+    assert [row[:2] for row in pending(outbox)] == [('failed', 3)]
+    stats = outbox.queue_stats()
+    assert stats['given_up'] == 1 and stats['failed'] == 1 and stats['depth'] == 0
+    outbox.close()
+
+
+def test_records_survive_a_restart(tmp_path):
+    outbox = make_outbox(tmp_path, FlakySubmitter(failures=1), base_backoff=0.05)
+    first = outbox.enqueue(LINK, VITALS)
+    outbox.drain()  # Fails once and stays queued
+    second = outbox.enqueue(LINK, dict(VITALS, patient_name='Kofi Boateng'))
+    outbox.close()
+
+    submitter = FlakySubmitter()
+    restarted = make_outbox(tmp_path, submitter)
+    time.sleep(0.05)
+    assert restarted.drain() == 2
+    assert sorted(key for link, vitals, key in submitter.sent) == sorted([first, second])
+    restarted.close()
+
+
+def test_background_flusher_and_wait(tmp_path):
+    submitter = FlakySubmitter()
+    outbox = make_outbox(tmp_path, submitter).start()
+    key = outbox.enqueue(LINK, VITALS, track=True)
+    assert outbox.wait(key, timeout=5)
+    assert outbox.queue_stats()['latency']['p50'] == pytest.approx(0, abs=5)
+    outbox.close()
+
+
+def test_discovered_field_mapping_is_kept(tmp_path):
+    discovered = {'patient_name': 'entry.1000001', 'bp': 'entry.1000002'}
+
+    class DiscoveringSubmitter(FlakySubmitter):
+        # Like HttpFormSubmitter: an empty mapping is filled in place from the form, then the post fails
+        def submit(self, google_form_link, vitals, field_mapping=None, idempotency_key=None):
+            self.sent.append(dict(field_mapping))
+            if not field_mapping:
+                field_mapping.update(discovered)
+            raise ConnectionError('no signal')
+
+    hospital_mapping = {}
+    outbox = make_outbox(tmp_path, DiscoveringSubmitter(), base_backoff=0.05)
+    outbox.enqueue(LINK, VITALS, hospital_mapping)
+    outbox.enqueue(LINK, VITALS)  # Queued with no mapping at all
+    outbox.drain()
+    assert hospital_mapping == discovered  # The hospital entry keeps it for its next patient
+    stored = outbox.connection.execute('SELECT field_mapping FROM outbox').fetchall()
+    assert [json.loads(row[0]) for row in stored] == [discovered, discovered]
+    outbox.close()
+
+    # After a restart the queued records are sent with it straight away
+    submitter = DiscoveringSubmitter()
+    restarted = make_outbox(tmp_path, submitter)
+    time.sleep(0.05)
+    restarted.drain()
+    assert submitter.sent[:2] == [discovered, discovered]
+    restarted.close()
@@ -0,0 +1,85 @@
+# Checks the patient name suggestions (patient_search.py): unfinished words, misspellings and the order the
+# names are suggested in.
+# Run with: python -m pytest test_patient_search.py
+
+import pytest
+
+from dispatch import DispatchCore
+from geocoding import GeocodingResolver
+from patient_search import edit_distance, PatientSearchIndex
+from records import RecordStore
+
+NAMES = ['Ama Mensah', 'Ama Mensah-Owusu', 'Kwame Mensah', 'Kwame Nkrumah', 'Abena Amankwah', 'Kofi Annan',
+         'Amarachi Okafor', 'Yaw Mensa']
+
+
+@pytest.fixture
+def index():
+    return PatientSearchIndex(NAMES)
+
+
+def test_edit_distance():
+    assert edit_distance('kwame', 'kwame') == 0
+    assert edit_distance('kwme', 'kwame') == 1
+    assert edit_distance('mensah', 'mnesah') == 2
+    assert edit_distance('', 'ama') == 3
+
+
+def test_unfinished_words(index):
+    assert index.search('ama mens')[:2] == ['Ama Mensah', 'Ama Mensah-Owusu']
+    assert index.search('kwame n') == ['Kwame Nkrumah']
+    assert index.search('kof') == ['Kofi Annan']
+    assert index.search('  AMA   MENSAH ')[0] == 'Ama Mensah'
+
+
+def test_ranking(index):
+    # Names that start with what was typed come first, then shorter names
+    assert index.search('ama') == ['Ama Mensah', 'Amarachi Okafor', 'Ama Mensah-Owusu', 'Abena Amankwah']
+    # Every name with the word typed comes before a misspelling of it ("mensa" is one letter short)
+    assert index.search('mensah') == ['Ama Mensah', 'Kwame Mensah', 'Ama Mensah-Owusu', 'Yaw Mensa']
+    assert len(index.search('a', limit=2)) == 2
+
+
+def test_typos(index):
+    assert index.search('kwme mensah') == ['Kwame Mensah']
+    assert index.search('kwame nkrumha') == ['Kwame Nkrumah']
+    assert index.search('abena amankwa') == ['Abena Amankwah']
+    # Short words must be typed exactly, and far-off words find nothing
+    assert index.search('yw') == []
+    assert index.search('zzzzzz') == []
+    assert index.search('') == []
+
+
+def test_names_added_later(index):
+    index.add('Efua Sutherland')
+    assert index.search('efua suth') == ['Efua Sutherland']
+    index.add('ama mensah')  # Already known: only how it is shown changes
+    assert len(index) == len(NAMES) + 1
+    assert index.search('ama mensah')[0] == 'ama mensah'
+
+
+def test_built_from_the_record_store(tmp_path):
+    store = RecordStore(str(tmp_path / 'records.sqlite3'))
+    store.save_encounter({'patient_name': 'ama mensah'}, recorded_at=1000)
+    store.save_encounter({'patient_name': 'Ama Mensah'}, recorded_at=2000)
+    store.save_encounter({'patient_name': 'Kofi Annan'}, recorded_at=1500)
+    # One entry per patient, spelt as at their latest encounter
+    assert sorted(store.patient_names()) == ['Ama Mensah', 'Kofi Annan']
+    assert PatientSearchIndex(store.patient_names()).search('ama') == ['Ama Mensah']
+    store.close()
+
+
+def test_no_suggestions_until_the_index_is_built(tmp_path):
+    core = DispatchCore([], records_path=str(tmp_path / 'records.sqlite3'),
+                        outbox_path=str(tmp_path / 'outbox.sqlite3'), routing_path=None,
+                        geocoder=GeocodingResolver(None, None, geocoder=lambda name: None),
+                        tiles_path=str(tmp_path / 'tiles.npz'))
+    core.record_store.save_many([({'patient_name': name}, None, None) for name in NAMES])
+    # The app's screen does not wait for it to be built...
+    assert core.suggest_patients('ama', wait=False) == [] and core.patient_index is None
+    core.build_patient_index()
+    assert core.suggest_patients('ama', limit=2, wait=False) == ['Ama Mensah', 'Amarachi Okafor']
+    # ...while the service's workers do
+    core.patient_index = None
+    assert core.suggest_patients('kwame')[0] == 'Kwame Mensah'
+    core.close()
@@ -0,0 +1,70 @@
+# Checks the patient record store (records.py): every encounter is kept, recall by name or id comes back
+# newest first, and export_docx writes the usual report.
+# Run with: python -m pytest test_records.py
+
+import pytest
+
+from records import export_docx, normalize_name, RecordStore
+
+
+def vitals(name, bp='120/80', summary='Stable'):
+    return {'patient_name': name, 'bp': bp, 'temperature': '36.8', 'pulse_rate': '72', 'oxygen_sat': '98',
+            'respiratory_rate': '16', 'summary': summary}
+
+
+@pytest.fixture
+def store(tmp_path):
+    records = RecordStore(str(tmp_path / 'records.sqlite3'))
+    yield records
+    records.close()
+
+
+def test_normalize_name():
+    assert normalize_name('  Ama   MENSAH ') == 'ama mensah'
+    assert normalize_name('Kwamé') == 'kwame'
+    assert normalize_name(None) == ''
+
+
+def test_history_keeps_every_encounter(store):
+    store.save_encounter(vitals('Ama Mensah', bp='150/95'), hospital='Ridge', recorded_at=1000)
+    store.save_encounter(vitals('Kofi Boateng'), recorded_at=1500)
+    store.save_encounter(vitals('ama  mensah', bp='130/85'), hospital='Korle Bu', location='Madina',
+                         recorded_at=2000)
+
+    history = store.history('AMA MENSAH')
+    assert [encounter['bp'] for encounter in history] == ['130/85', '150/95']
+    assert history[0]['hospital'] == 'Korle Bu' and history[0]['location'] == 'Madina'
+    assert store.latest('Ama Mensah')['recorded_at'] == 2000
+    assert store.latest('Yaw Owusu') is None
+    assert len(store.history('Ama Mensah', limit=1)) == 1
+    assert store.count() == 3
+
+
+def test_patient_ids(store):
+    # Two patients with the same name are told apart by their ids
+    store.save_encounter(vitals('Ama Mensah'), patient_id='GH-1', recorded_at=1000)
+    store.save_encounter(vitals('Ama Mensah', summary='Other Ama'), patient_id='GH-2', recorded_at=2000)
+    assert [encounter['summary'] for encounter in store.history_by_id('GH-1')] == ['Stable']
+    assert len(store.history('Ama Mensah')) == 2
+
+
+def test_save_many_and_reopen(tmp_path):
+    path = str(tmp_path / 'records.sqlite3')
+    store = RecordStore(path)
+    store.save_many([(vitals(f'Patient {number}'), 'Ridge', 'Madina') for number in range(50)])
+    store.close()
+
+    reopened = RecordStore(path)
+    assert reopened.count() == 50
+    assert reopened.latest('patient 7')['hospital'] == 'Ridge'
+    reopened.close()
+
+
+def test_export_docx(store, tmp_path):
+    from docx import Document
+
+    store.save_encounter(vitals('Ama Mensah', bp='150/95'), hospital='Ridge', recorded_at=1000)
+    path = export_docx(store.history('Ama Mensah'), str(tmp_path / 'ama.docx'))
+    text = [paragraph.text for paragraph in Document(path).paragraphs]
+    assert text[0] == 'Patient Vital Signs - Ama Mensah'
+    assert 'Blood pressure (mmHg): 150/95' in text and 'Sent to: Ridge' in text
@@ -0,0 +1,124 @@
+# Checks the HTTP service (service.py) end to end on a dispatch core with its own records and outbox, a small
+# gazetteer instead of Nominatim, and a fake form submitter: the answers and the status codes of each endpoint.
+# Run with: python -m pytest test_service.py
+
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from dispatch import DispatchCore
+from geocoding import GeocodingResolver
+from service import make_app
+
+VITALS = {'patient_name': 'Ama Mensah', 'bp': '85/50', 'temperature': '38.9', 'pulse_rate': '121',
+          'oxygen_sat': '86', 'respiratory_rate': '28', 'summary': 'Short of breath'}
+
+
+class RecordingSubmitter:
+    def __init__(self):
+        self.sent = []
+
+    def submit(self, google_form_link, vitals, field_mapping=None, idempotency_key=None):
+        self.sent.append((google_form_link, vitals, idempotency_key))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def core(tmp_path):
+    gazetteer = tmp_path / 'localities.csv'
+    gazetteer.write_text('name,latitude,longitude\nMadina,5.6685,-0.1657\nTamale,9.4034,-0.8424\n')
+    hospitals = [['Ridge Hospital', 5.5600, -0.2000, 1, 'Google Form Link 1', {}],
+                 ['Tamale Teaching Hospital', 9.3930, -0.8240, 0, 'Google Form Link 2', {}]]
+    return DispatchCore(hospitals, records_path=str(tmp_path / 'records.sqlite3'),
+                        outbox_path=str(tmp_path / 'outbox.sqlite3'), routing_path=None,
+                        geocoder=GeocodingResolver(None, str(gazetteer), geocoder=lambda name: None),
+                        submitter=RecordingSubmitter())
+
+
+#Runs test(client) against the service, started and stopped around it
+def with_client(core, test):
+    async def run():
+        async with TestClient(TestServer(make_app(core, threads=4, bed_feed_path=None))) as client:
+            await test(client)
+
+    asyncio.run(run())
+
+
+async def request(client, method, path, **options):
+    response = await client.request(method, path, **options)
+    return response.status, await response.json()
+
+
+def test_dispatch(core):
+    async def test(client):
+        status, body = await request(client, 'POST', '/vitals', json={'vitals': VITALS, 'location': 'Madina', 'wait': 2})
+        assert status == 201
+        assert body['hospital'] == 'Ridge Hospital' and body['delivered']
+        assert body['distance_km'] == pytest.approx(12.9, abs=0.5)
+
+        status, body = await request(client, 'GET', f"/submissions/{body['submission_key']}")
+        assert (status, body['status']) == (200, 'sent')
+        status, body = await request(client, 'GET', '/patients/ama mensah')
+        assert status == 200 and body['encounters'][0]['hospital'] == 'Ridge Hospital'
+        status, body = await request(client, 'GET', '/patients', params={'q': 'ama mens'})
+        assert body['patients'] == ['Ama Mensah']
+
+        # Ridge's only bed is taken and Tamale has none
+        status, body = await request(client, 'POST', '/vitals', json={'vitals': VITALS, 'location': 'Madina'})
+        assert (status, body['status']) == (409, 'no_free_bed')
+
+    with_client(core, test)
+    assert len(core.submitter.sent) == 1
+
+
+def test_match(core):
+    async def test(client):
+        status, body = await request(client, 'POST', '/match', json={'location': 'Tamale', 'k': 5})
+        assert status == 200
+        assert [hospital['hospital'] for hospital in body['hospitals']] == ['Ridge Hospital']
+        assert body['hospitals'][0]['available_beds'] == 1
+        status, body = await request(client, 'POST', '/beds', json={'id': body['hospitals'][0]['id'], 'available_beds': 3})
+        assert (status, body['available_beds']) == (200, 3)
+        status, body = await request(client, 'POST', '/beds', json={'hospital': 'Nowhere Clinic', 'available_beds': 3})
+        assert status == 404
+        status, body = await request(client, 'POST', '/match', json={'location': 'Atlantis'})
+        assert status == 404
+
+    with_client(core, test)
+
+
+@pytest.mark.parametrize('method, path, options', [
+    ('POST', '/vitals', {'data': 'not json'}),
+    ('POST', '/vitals', {'json': ['a', 'list']}),
+    ('POST', '/vitals', {'json': {'vitals': dict(VITALS, patient_name=''), 'location': 'Madina'}}),
+    ('POST', '/vitals', {'json': {'vitals': dict(VITALS, bp=['85', '50']), 'location': 'Madina'}}),
+    ('POST', '/vitals', {'json': {'vitals': VITALS, 'location': '  '}}),
+    ('POST', '/vitals', {'json': {'vitals': VITALS, 'location': 'Madina', 'wait': 'soon'}}),
+    ('POST', '/match', {'json': {'location': 'Madina', 'k': 'three'}}),
+    ('POST', '/match', {'json': {}}),
+    ('GET', '/patients/Ama Mensah?history=all', {}),
+])
+def test_bad_requests(core, method, path, options):
+    async def test(client):
+        status, body = await request(client, method, path, **options)
+        assert status == 400 and body['error']
+
+    with_client(core, test)
+    assert core.submitter.sent == []
+
+
+def test_not_found(core):
+    async def test(client):
+        status, body = await request(client, 'POST', '/vitals', json={'vitals': VITALS, 'location': 'Atlantis'})
+        assert (status, body['status']) == (404, 'location_not_found')
+        status, body = await request(client, 'GET', '/patients/Nobody Known')
+        assert status == 404
+        status, body = await request(client, 'GET', '/submissions/no-such-key')
+        assert status == 404 and body['error']
+        status, body = await request(client, 'GET', '/stats')
+        assert status == 200 and body['beds']['reservations'] == 0
+
+    with_client(core, test)
@@ -0,0 +1,116 @@
+# Checks sending vitals to a hospital's form (submission.py) against the StandInFormServer: the direct HTTP
+# post, its errors, and the fallback to the next backend for forms it cannot understand.
+# Run with: python -m pytest test_submission.py
+
+import socket
+
+import pytest
+
+from stand_ins import STAND_IN_ENTRY_IDS, StandInFormServer
+from submission import FormNotUnderstood, FormSubmitter, HttpFormSubmitter, SeleniumFormSubmitter, SubmissionError, VITALS_FIELDS
+
+VITALS = {'patient_name': 'Ama Mensah', 'bp': '85/50', 'temperature': '38.9', 'pulse_rate': '121',
+          'oxygen_sat': '86', 'respiratory_rate': '28', 'summary': 'Short of breath'}
+MAPPING = {field: f'entry.{entry_id}' for field, entry_id in zip(VITALS_FIELDS, STAND_IN_ENTRY_IDS)}
+
+
+class RecordingSubmitter:
+    def __init__(self):
+        self.sent = []
+
+    def submit(self, google_form_link, vitals, field_mapping=None, idempotency_key=None):
+        self.sent.append((google_form_link, vitals, idempotency_key))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server():
+    with StandInFormServer() as form_server:
+        yield form_server
+
+
+def refused_link():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+    return f'http://127.0.0.1:{port}/forms/d/e/closed/viewform'
+
+
+def test_http_submit(server):
+    submitter = HttpFormSubmitter()
+    field_mapping = {}
+    submitter.submit(server.form_link('ridge'), VITALS, field_mapping, idempotency_key='encounter-1')
+    submitter.close()
+
+    # The questions are found on the form page and the hospital's mapping is filled in for next time
+    assert field_mapping == MAPPING
+    [response] = server.responses
+    assert response['path'].endswith('/ridge/formResponse')
+    assert response['fields'] == {MAPPING[field]: VITALS[field] for field in VITALS_FIELDS}
+    assert response['idempotency_key'] == 'encounter-1'
+
+
+def test_http_errors(server):
+    submitter = HttpFormSubmitter()
+    server.fail(1)
+    with pytest.raises(SubmissionError, match='503'):
+        submitter.submit(server.form_link(), VITALS)
+    submitter.submit(server.form_link(), VITALS)
+    assert len(server.responses) == 1
+
+    with pytest.raises(SubmissionError, match='Could not reach'):
+        submitter.submit(refused_link(), VITALS, dict(MAPPING))
+    # Without a mapping the form page is read first, and that fails the same way
+    for link in ['Google Form Link 1', refused_link(), server.form_link().replace('viewform', 'missing')]:
+        with pytest.raises(SubmissionError, match='Could not read the form'):
+            submitter.submit(link, VITALS)
+    server.set_questions('short', 5)
+    with pytest.raises(FormNotUnderstood, match='Expected 7 questions.*found 5'):
+        submitter.submit(server.form_link('short'), VITALS)
+    submitter.close()
+
+
+def test_fallback_for_a_form_that_is_not_understood(server):
+    recording = RecordingSubmitter()
+    server.set_questions('short', 5)
+    FormSubmitter([HttpFormSubmitter(), recording]).submit(server.form_link('short'), VITALS, {}, 'encounter-2')
+    assert recording.sent == [(server.form_link('short'), VITALS, 'encounter-2')]
+    assert server.responses == []
+
+
+@pytest.mark.parametrize('link', ['Google Form Link 1', refused_link()])
+def test_no_fallback_when_the_form_cannot_be_reached(link):
+    recording = RecordingSubmitter()
+    with pytest.raises(SubmissionError, match='Could not read the form'):
+        FormSubmitter([HttpFormSubmitter(), recording]).submit(link, VITALS, {}, 'encounter-3')
+    assert recording.sent == []
+
+
+def test_no_fallback_when_the_post_fails(server):
+    recording = RecordingSubmitter()
+    submitter = FormSubmitter([HttpFormSubmitter(), recording])
+    server.fail(1)
+    with pytest.raises(SubmissionError, match='503'):
+        submitter.submit(server.form_link(), VITALS, {}, 'encounter-4')
+    with pytest.raises(SubmissionError, match='Could not reach'):
+        submitter.submit(refused_link(), VITALS, dict(MAPPING), 'encounter-5')
+    assert recording.sent == []
+
+
+def test_every_backend_fails(server):
+    server.set_questions('short', 5)
+    with pytest.raises(SubmissionError, match='Expected 7.*; .*Expected 7'):
+        FormSubmitter([HttpFormSubmitter(), HttpFormSubmitter()]).submit(server.form_link('short'), VITALS)
+
+
+def test_selenium_without_chrome(monkeypatch):
+    from selenium import webdriver
+
+    def no_chrome(*args, **kwargs):
+        raise OSError('chromedriver not found')
+
+    monkeypatch.setattr(webdriver, 'Chrome', no_chrome)
+    with pytest.raises(SubmissionError, match='chromedriver not found'):
+        SeleniumFormSubmitter().submit('Google Form Link 1', VITALS)
@@ -0,0 +1,112 @@
+# Checks the monitor streams (vitals_stream.py): parsing typed vitals, NEWS2 against the published scoring
+# bands and worked cases, and the rolling windows of many patients at once.
+# Run with: python -m pytest test_vitals_stream.py
+
+import numpy as np
+import pytest
+
+from hospital_registry import capability_mask, capability_names
+from vitals_stream import parse_vitals, required_capabilities, score_vitals, VitalsStreams
+
+#(typed vitals, NEWS2 points) at both sides of every band edge of the NEWS2 chart
+BANDS = [
+    ({'respiratory_rate': 8}, 3), ({'respiratory_rate': 9}, 1), ({'respiratory_rate': 11}, 1),
+    ({'respiratory_rate': 12}, 0), ({'respiratory_rate': 20}, 0), ({'respiratory_rate': 21}, 2),
+    ({'respiratory_rate': 24}, 2), ({'respiratory_rate': 25}, 3),
+    ({'oxygen_sat': 91}, 3), ({'oxygen_sat': 92}, 2), ({'oxygen_sat': 93}, 2), ({'oxygen_sat': 94}, 1),
+    ({'oxygen_sat': 95}, 1), ({'oxygen_sat': 96}, 0),
+    ({'bp': '90/60'}, 3), ({'bp': '91/60'}, 2), ({'bp': '100/60'}, 2), ({'bp': '101/60'}, 1),
+    ({'bp': '110/70'}, 1), ({'bp': '111/70'}, 0), ({'bp': '219/100'}, 0), ({'bp': '220/100'}, 3),
+    ({'pulse_rate': 40}, 3), ({'pulse_rate': 41}, 1), ({'pulse_rate': 50}, 1), ({'pulse_rate': 51}, 0),
+    ({'pulse_rate': 90}, 0), ({'pulse_rate': 91}, 1), ({'pulse_rate': 110}, 1), ({'pulse_rate': 111}, 2),
+    ({'pulse_rate': 130}, 2), ({'pulse_rate': 131}, 3),
+    ({'temperature': 35.0}, 3), ({'temperature': 35.1}, 1), ({'temperature': 36.0}, 1), ({'temperature': 36.1}, 0),
+    ({'temperature': 38.0}, 0), ({'temperature': 38.1}, 1), ({'temperature': 39.0}, 1), ({'temperature': 39.1}, 2),
+]
+
+HEALTHY = {'bp': '120/80', 'temperature': '36.8', 'pulse_rate': '72', 'oxygen_sat': '98%', 'respiratory_rate': '16'}
+SEPTIC = {'bp': '85/50', 'temperature': '38.9', 'pulse_rate': '121', 'oxygen_sat': '86', 'respiratory_rate': '28'}
+
+
+@pytest.mark.parametrize('vitals, points', BANDS)
+def test_news2_bands(vitals, points):
+    assert score_vitals(vitals)[0] == points
+
+
+@pytest.mark.parametrize('vitals, on_oxygen, confused, expected', [
+    (HEALTHY, False, False, (0, 'low')),
+    (SEPTIC, False, False, (12, 'high')),  # 3 + 3 + 3 + 2 + 1
+    (dict(HEALTHY, respiratory_rate='7'), False, False, (3, 'low-medium')),  # A 3 in a single parameter
+    (HEALTHY, False, True, (3, 'low-medium')),  # New confusion
+    (dict(HEALTHY, respiratory_rate='22', oxygen_sat='94', pulse_rate='95'), True, False, (6, 'medium')),
+    (dict(HEALTHY, respiratory_rate='22', oxygen_sat='94', pulse_rate='95'), True, True, (9, 'high')),
+])
+def test_news2_cases(vitals, on_oxygen, confused, expected):
+    assert score_vitals(vitals, on_oxygen, confused) == expected
+
+
+def test_parse_vitals():
+    values, problems = parse_vitals({'bp': '118 / 76', 'temperature': '101.3°F', 'pulse_rate': '72 bpm',
+                                     'oxygen_sat': '98%', 'respiratory_rate': ''})
+    assert values['systolic'] == 118 and values['diastolic'] == 76
+    assert values['temperature'] == pytest.approx(38.5)
+    assert values['pulse_rate'] == 72 and values['oxygen_sat'] == 98 and values['respiratory_rate'] is None
+    assert problems == []
+
+    values, problems = parse_vitals({'bp': '120', 'pulse_rate': 'fast', 'oxygen_sat': '140'})
+    assert values['systolic'] is None and values['pulse_rate'] is None and values['oxygen_sat'] is None
+    assert len(problems) == 3
+
+
+def test_required_capabilities():
+    assert required_capabilities(HEALTHY) == (capability_mask([]), [])
+    required, reasons = required_capabilities(dict(SEPTIC, summary='Crash on the Accra-Kumasi road'))
+    assert sorted(capability_names(required)) == sorted(['oxygen', 'icu', 'emergency', 'trauma', 'surgery'])
+    assert reasons == ['oxygen saturation 86%', 'systolic pressure 85', 'NEWS2 score 12',
+                       'summary mentions "Crash"']
+    required, reasons = required_capabilities(dict(HEALTHY, summary='In labour, contractions 3 minutes apart'))
+    assert capability_names(required) == ['maternity']
+
+
+def test_rolling_window():
+    streams = VitalsStreams(max_patients=4, window=3)
+    for pulse in [60, 70, 80, 90, 100]:
+        streams.ingest([{'patient_id': 'amb-1', 'pulse_rate': pulse, 'oxygen_sat': 97}], now=1000)
+    summary = streams.summary('amb-1')
+    # Only the last three readings are in the window
+    assert summary['mean']['pulse_rate'] == 90
+    assert (summary['min']['pulse_rate'], summary['max']['pulse_rate']) == (80, 100)
+    assert summary['latest']['pulse_rate'] == 100 and summary['readings'] == 3
+    assert summary['news2'] == 1  # Pulse 100
+    assert streams.summary('amb-2') is None
+
+
+def test_batches_match_one_at_a_time():
+    generator = np.random.default_rng(3)
+    batch, single = VitalsStreams(max_patients=10, window=7), VitalsStreams(max_patients=10, window=7)
+    readings = [{'patient_id': f'amb-{generator.integers(5)}', 'pulse_rate': int(generator.integers(40, 140)),
+                 'respiratory_rate': int(generator.integers(8, 30))} for number in range(60)]
+    batch.ingest(readings, now=1000)  # The same patient many times in one batch
+    for reading in readings:
+        single.ingest([reading], now=1000)
+    for patient in {reading['patient_id'] for reading in readings}:
+        assert batch.summary(patient) == single.summary(patient)
+
+
+def test_at_risk_and_out_of_range():
+    streams = VitalsStreams(max_patients=4, window=5)
+    streams.ingest([{'patient_id': 'calm', **HEALTHY}, {'patient_id': 'septic', **SEPTIC},
+                    {'patient_id': 'breathless', **dict(HEALTHY, respiratory_rate='26', oxygen_sat='93'), 'alert': False}])
+    assert streams.at_risk(5) == [('septic', 12), ('breathless', 8)]
+    streams.ingest([{'patient_id': 'calm', 'pulse_rate': 400}])  # A loose probe, not a real pulse
+    assert streams.summary('calm')['latest']['pulse_rate'] == 72
+    assert streams.stats['rejected_values'] == 1
+
+
+def test_idle_patients_make_room():
+    streams = VitalsStreams(max_patients=2, window=5, idle_seconds=60)
+    streams.ingest([{'patient_id': 'a', 'pulse_rate': 80}, {'patient_id': 'b', 'pulse_rate': 80}], now=1000)
+    assert streams.ingest([{'patient_id': 'c', 'pulse_rate': 80}], now=1030) == 0  # Nobody is idle yet
+    assert streams.ingest([{'patient_id': 'c', 'pulse_rate': 80}], now=1100) == 1
+    assert streams.summary('a') is None and streams.summary('c')['readings'] == 1
+    assert streams.discharge('c') and len(streams) == 0
@@ -0,0 +1,349 @@
+# Streaming vitals for the Vital Signs app.
+# Vitals used to be five free-text boxes, stored as typed and never read again. Ambulance monitors
+# send a reading every second, so this module:
+# - parses and checks readings (typed text such as "120/80" or "98%", or numbers from a monitor);
+#   values outside what a living patient can have are dropped and counted
+# - keeps the last `window` readings of every patient in one preallocated NumPy array (a ring buffer
+#   per patient), so memory is fixed however long the streams run
+# - keeps running sums per patient, so rolling means are updated in place as readings arrive
+# - scores every patient with the NEWS2 early-warning score, for all patients at once with array
+#   operations instead of a loop per patient
+# Patients whose monitor has gone quiet are dropped after a while to make room for new ones.
+# required_capabilities() turns the same parsed vitals into the services the receiving hospital needs.
+
+import re
+import threading
+import time
+
+import numpy as np
+
+from hospital_registry import capability_mask
+
+#The measured channels, in the order they are stored
+CHANNELS = ['pulse_rate', 'oxygen_sat', 'respiratory_rate', 'systolic', 'diastolic', 'temperature']
+PULSE, OXYGEN, RESPIRATORY, SYSTOLIC, DIASTOLIC, TEMPERATURE = range(len(CHANNELS))
+
+#Values outside these ranges are treated as sensor or typing errors
+VALID_RANGES = {
+    'pulse_rate': (20, 250),
+    'oxygen_sat': (50, 100),
+    'respiratory_rate': (3, 70),
+    'systolic': (50, 260),
+    'diastolic': (20, 160),
+    'temperature': (30, 44),
+}
+
+MAX_PATIENTS = 4096
+WINDOW = 300  # Readings kept per patient: five minutes at one reading a second
+IDLE_SECONDS = 600  # A patient whose monitor sent nothing for this long is dropped
+
+#NEWS2 (Royal College of Physicians, 2017). For each parameter, a value up to edges[0] scores
+#points[0], up to edges[1] scores points[1], and so on; above the last edge scores points[-1].
+NEWS2_TABLES = {
+    RESPIRATORY: ([8, 11, 20, 24], [3, 1, 0, 2, 3]),
+    OXYGEN: ([91, 93, 95], [3, 2, 1, 0]),  # SpO2 scale 1
+    SYSTOLIC: ([90, 100, 110, 219], [3, 2, 1, 0, 3]),
+    PULSE: ([40, 50, 90, 110, 130], [3, 1, 0, 1, 2, 3]),
+    TEMPERATURE: ([35.0, 36.0, 38.0, 39.0], [3, 1, 0, 1, 2]),
+}
+NEWS2_OXYGEN_POINTS = 2  # On supplemental oxygen
+NEWS2_CONSCIOUSNESS_POINTS = 3  # New confusion, or responds only to voice or pain, or unresponsive
+RISK_LEVELS = ['low', 'low-medium', 'medium', 'high']
+
+#Words in the summary that mean the patient needs a particular service
+SUMMARY_CAPABILITIES = [
+    (re.compile(r'\b(accident|crash|collision|fracture|gunshot|stab|trauma|injur|bleeding|fell|fall)', re.I),
+     ['trauma', 'surgery']),
+    (re.compile(r'\b(pregnan|labou?r|contraction|deliver)', re.I), ['maternity']),
+    (re.compile(r'\b(child|infant|baby|newborn|toddler)', re.I), ['pediatrics']),
+]
+
+NUMBER = re.compile(r'[-+]?\d+(?:\.\d+)?')
+LOWEST = np.array([VALID_RANGES[channel][0] for channel in CHANNELS], dtype=np.float64)
+HIGHEST = np.array([VALID_RANGES[channel][1] for channel in CHANNELS], dtype=np.float64)
+
+
+#Reads a number out of text such as "98%", "72 bpm" or "36.8°C". Returns None if there is none.
+def parse_number(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    match = NUMBER.search(str(value or ''))
+    return float(match.group()) if match else None
+
+
+#Turns typed or monitor vitals into {channel: number}. Returns (values, problems): values has
+#None for anything missing or out of range, and problems says what was wrong, for the operator.
+def parse_vitals(vitals):
+    values = {channel: None for channel in CHANNELS}
+    problems = []
+    raw = {channel: vitals.get(channel) for channel in CHANNELS}
+    if vitals.get('bp') not in (None, ''):
+        # Blood pressure is typed as systolic/diastolic
+        numbers = NUMBER.findall(str(vitals['bp']))
+        if len(numbers) == 2:
+            raw['systolic'], raw['diastolic'] = numbers
+        else:
+            problems.append(f"blood pressure {vitals['bp']!r} is not systolic/diastolic")
+    for channel in CHANNELS:
+        if raw[channel] in (None, ''):
+            continue
+        number = parse_number(raw[channel])
+        if number is None:
+            problems.append(f'{channel} {raw[channel]!r} is not a number')
+            continue
+        if channel == 'temperature' and 86 <= number <= 111:
+            number = (number - 32) * 5 / 9  # Typed in Fahrenheit
+        low, high = VALID_RANGES[channel]
+        if not low <= number <= high:
+            problems.append(f'{channel} {number:g} is outside {low}-{high}')
+            continue
+        values[channel] = number
+    return values, problems
+
+
+#NEWS2 points per parameter, for many patients at once. values is an (N, channels) array with NaN
+#where a value is missing (it scores 0); on_oxygen and confused are boolean arrays of length N.
+#Returns (total scores, highest single-parameter points), both of length N.
+def news2_scores(values, on_oxygen, confused):
+    values = np.asarray(values, dtype=np.float64)
+    total = np.zeros(len(values), dtype=np.int64)
+    highest = np.zeros(len(values), dtype=np.int64)
+    for channel, (edges, points) in NEWS2_TABLES.items():
+        column = values[:, channel]
+        scored = np.asarray(points)[np.searchsorted(edges, column, side='left')]
+        scored = np.where(np.isnan(column), 0, scored)
+        total += scored
+        np.maximum(highest, scored, out=highest)
+    total += np.where(on_oxygen, NEWS2_OXYGEN_POINTS, 0)
+    total += np.where(confused, NEWS2_CONSCIOUSNESS_POINTS, 0)
+    np.maximum(highest, np.where(confused, NEWS2_CONSCIOUSNESS_POINTS, 0), out=highest)
+    return total, highest
+
+
+#NEWS2 clinical risk: 7 or more is high, 5-6 medium, a 3 in any single parameter low-medium
+def news2_risk(total, highest):
+    if total >= 7:
+        return 'high'
+    if total >= 5:
+        return 'medium'
+    if highest >= 3:
+        return 'low-medium'
+    return 'low'
+
+
+#The NEWS2 score of one set of typed vitals. Returns (score, risk).
+def score_vitals(vitals, on_oxygen=False, confused=False):
+    values, problems = parse_vitals(vitals)
+    row = np.array([[np.nan if values[channel] is None else values[channel] for channel in CHANNELS]])
+    total, highest = news2_scores(row, np.array([on_oxygen]), np.array([confused]))
+    return int(total[0]), news2_risk(total[0], highest[0])
+
+
+#The services the receiving hospital must offer for these vitals: oxygen for low saturation, an ICU for
+#very low saturation, shock, a respiratory rate out of range or a high NEWS2 score, and trauma, maternity
+#or pediatric care when the summary says so. Returns (capability bitmask, reasons for the operator).
+def required_capabilities(vitals):
+    values, problems = parse_vitals(vitals)
+    needed, reasons = [], []
+
+    def need(services, reason):
+        needed.extend(services)
+        reasons.append(reason)
+
+    oxygen, respiratory, systolic = values['oxygen_sat'], values['respiratory_rate'], values['systolic']
+    if oxygen is not None and oxygen < 85:
+        need(['oxygen', 'icu'], f'oxygen saturation {oxygen:g}%')
+    elif oxygen is not None and oxygen < 92:
+        need(['oxygen'], f'oxygen saturation {oxygen:g}%')
+    if respiratory is not None and (respiratory >= 30 or respiratory <= 8):
+        need(['oxygen', 'icu'], f'respiratory rate {respiratory:g}')
+    if systolic is not None and systolic <= 90:
+        need(['emergency', 'icu'], f'systolic pressure {systolic:g}')
+    score, risk = score_vitals(vitals)
+    if risk == 'high':
+        need(['icu'], f'NEWS2 score {score}')
+    elif risk == 'medium':
+        need(['emergency'], f'NEWS2 score {score}')
+    for pattern, services in SUMMARY_CAPABILITIES:
+        match = pattern.search(str(vitals.get('summary') or ''))
+        if match:
+            need(services, f'summary mentions "{match.group()}"')
+    return capability_mask(needed), reasons
+
+
+class VitalsStreams:
+    def __init__(self, max_patients=MAX_PATIENTS, window=WINDOW, idle_seconds=IDLE_SECONDS):
+        self.max_patients = max_patients
+        self.window = window
+        self.idle_seconds = idle_seconds
+        channels = len(CHANNELS)
+        # Everything is allocated here, once: the readings of every patient slot and the running totals
+        self.readings = np.full((max_patients, window, channels), np.nan, dtype=np.float32)
+        self.position = np.zeros(max_patients, dtype=np.int64)  # Where the next reading of each slot goes
+        self.sums = np.zeros((max_patients, channels), dtype=np.float64)
+        self.counts = np.zeros((max_patients, channels), dtype=np.int64)
+        self.latest = np.full((max_patients, channels), np.nan, dtype=np.float64)
+        self.on_oxygen = np.zeros(max_patients, dtype=bool)
+        self.confused = np.zeros(max_patients, dtype=bool)
+        self.scores = np.zeros(max_patients, dtype=np.int64)
+        self.highest = np.zeros(max_patients, dtype=np.int64)
+        self.last_seen = np.zeros(max_patients, dtype=np.float64)
+        self.slots = {}  # patient id -> slot
+        self.patient_ids = [None] * max_patients
+        self.free_slots = list(range(max_patients - 1, -1, -1))
+        self.lock = threading.Lock()
+        self.stats = {'readings': 0, 'rejected_values': 0, 'dropped_readings': 0, 'evicted': 0}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _clear(self, slot):
+        self.readings[slot] = np.nan
+        self.position[slot] = 0
+        self.sums[slot] = 0
+        self.counts[slot] = 0
+        self.latest[slot] = np.nan
+        self.on_oxygen[slot] = self.confused[slot] = False
+        self.scores[slot] = self.highest[slot] = 0
+
+    def _slot(self, patient_id, now):
+        slot = self.slots.get(patient_id)
+        if slot is not None:
+            return slot
+        if not self.free_slots:
+            self._evict_idle(now)
+            if not self.free_slots:
+                return None
+        slot = self.free_slots.pop()
+        self._clear(slot)
+        self.slots[patient_id] = slot
+        self.patient_ids[slot] = patient_id
+        return slot
+
+    def _evict_idle(self, now):
+        for patient_id, slot in list(self.slots.items()):
+            if now - self.last_seen[slot] > self.idle_seconds:
+                del self.slots[patient_id]
+                self.patient_ids[slot] = None
+                self.free_slots.append(slot)
+                self.stats['evicted'] += 1
+
+    #Adds one reading per row: slots is an array of patient slots, values an (N, channels) array with
+    #NaN for channels the reading did not have. Rows for the same slot are applied in order.
+    #Out-of-range values are dropped here as well, for monitors that send arrays directly.
+    def ingest_arrays(self, slots, values, now=None):
+        now = time.time() if now is None else now
+        slots = np.asarray(slots, dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            invalid = (values < LOWEST) | (values > HIGHEST)
+        values[invalid] = np.nan
+        # A patient may appear more than once in a batch. Numbering each row by how many earlier rows
+        # had the same patient splits the batch into rounds in which every patient appears at most once.
+        order = np.argsort(slots, kind='stable')
+        sorted_slots = slots[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(sorted_slots)) + 1]
+        occurrence = np.arange(len(slots)) - np.repeat(starts, np.diff(np.r_[starts, len(slots)]))
+        with self.lock:
+            for round_number in range(int(occurrence.max()) + 1 if len(slots) else 0):
+                rows = order[occurrence == round_number]
+                self._write(slots[rows], values[rows])
+            touched = np.unique(slots)
+            self.last_seen[touched] = now
+            self.scores[touched], self.highest[touched] = news2_scores(
+                self.latest[touched], self.on_oxygen[touched], self.confused[touched])
+            self.stats['readings'] += len(slots)
+            self.stats['rejected_values'] += int(invalid.sum())
+
+    def _write(self, slots, values):
+        positions = self.position[slots]
+        old = self.readings[slots, positions].astype(np.float64)
+        # The reading that falls out of the window leaves the running totals, the new one enters them
+        old_present = ~np.isnan(old)
+        new_present = ~np.isnan(values)
+        self.sums[slots] += np.where(new_present, values, 0) - np.where(old_present, old, 0)
+        self.counts[slots] += new_present.astype(np.int64) - old_present
+        self.readings[slots, positions] = values
+        self.latest[slots] = np.where(new_present, values, self.latest[slots])
+        self.position[slots] = (positions + 1) % self.window
+
+    #Adds readings given as dictionaries, as a monitor or the HTTP service sends them:
+    #{"patient_id": ..., "pulse_rate": 88, "oxygen_sat": "94%", "bp": "118/76", ..., "on_oxygen": false,
+    # "alert": true}. Returns how many readings were taken.
+    def ingest(self, readings, now=None):
+        now = time.time() if now is None else now
+        slots, rows = [], []
+        with self.lock:
+            for reading in readings:
+                slot = self._slot(reading.get('patient_id'), now)
+                if slot is None:
+                    self.stats['dropped_readings'] += 1
+                    continue
+                values, problems = parse_vitals(reading)
+                self.stats['rejected_values'] += len(problems)
+                if 'on_oxygen' in reading:
+                    self.on_oxygen[slot] = bool(reading['on_oxygen'])
+                if 'alert' in reading:
+                    self.confused[slot] = not reading['alert']
+                self.last_seen[slot] = now
+                slots.append(slot)
+                rows.append([np.nan if values[channel] is None else values[channel] for channel in CHANNELS])
+        if slots:
+            self.ingest_arrays(slots, rows, now)
+        return len(slots)
+
+    #Rolling means of every channel over the window, for the given slots (all slots by default)
+    def rolling_means(self, slots=None):
+        slots = slice(None) if slots is None else slots
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts[slots] > 0, self.sums[slots] / np.maximum(self.counts[slots], 1), np.nan)
+
+    #Latest values, rolling mean, minimum and maximum, and the NEWS2 score of one patient, or None
+    def summary(self, patient_id):
+        with self.lock:
+            slot = self.slots.get(patient_id)
+            if slot is None:
+                return None
+            window = self.readings[slot].astype(np.float64)
+            means = self.rolling_means(slot)
+            present = self.counts[slot] > 0
+            with np.errstate(all='ignore'):
+                lowest = np.where(present, np.nanmin(np.where(np.isnan(window), np.inf, window), axis=0), np.nan)
+                highest_values = np.where(present, np.nanmax(np.where(np.isnan(window), -np.inf, window), axis=0), np.nan)
+
+            def as_dict(row):
+                return {channel: None if np.isnan(value) else round(float(value), 2) for channel, value in zip(CHANNELS, row)}
+
+            return {
+                'patient_id': patient_id,
+                'latest': as_dict(self.latest[slot]),
+                'mean': as_dict(means),
+                'min': as_dict(lowest),
+                'max': as_dict(highest_values),
+                'readings': int(self.counts[slot].max()),
+                'news2': int(self.scores[slot]),
+                'risk': news2_risk(self.scores[slot], self.highest[slot]),
+            }
+
+    #Patients whose NEWS2 score is at least the threshold, highest first: [(patient id, score)]
+    def at_risk(self, threshold=5):
+        with self.lock:
+            slots = np.array(list(self.slots.values()), dtype=np.int64)
+            if len(slots) == 0:
+                return []
+            slots = slots[self.scores[slots] >= threshold]
+            slots = slots[np.argsort(-self.scores[slots], kind='stable')]
+            return [(self.patient_ids[slot], int(self.scores[slot])) for slot in slots]
+
+    #Drops the patient's stream, for example once they have been handed over at the hospital
+    def discharge(self, patient_id):
+        with self.lock:
+            slot = self.slots.pop(patient_id, None)
+            if slot is not None:
+                self.patient_ids[slot] = None
+                self.free_slots.append(slot)
+            return slot is not None
+
+    def memory_bytes(self):
+        return sum(array.nbytes for array in (self.readings, self.position, self.sums, self.counts, self.latest,
+                                              self.on_oxygen, self.confused, self.scores, self.highest, self.last_seen))